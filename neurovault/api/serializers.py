@@ -25,6 +25,7 @@ from neurovault.apps.statmaps.models import (
     StatisticMap
 )
 
+from neurovault.apps.statmaps.storage import get_file_url
 from neurovault.utils import strip, logical_xor
 from neurovault.apps.statmaps.utils import get_paper_properties
 
@@ -34,7 +35,7 @@ class HyperlinkedFileField(serializers.FileField):
     def to_representation(self, value):
         if value:
             request = self.context.get('request', None)
-            return request.build_absolute_uri(urlquote(value.url))
+            return request.build_absolute_uri(urlquote(get_file_url(value)))
 
 
 class HyperlinkedDownloadURL(serializers.RelatedField):
@@ -108,6 +109,9 @@ class ImageSerializer(serializers.HyperlinkedModelSerializer,
             )
 
     def get_file_size(self, obj):
+        # stored on save, saves a stat per listed image
+        if obj.file_size is not None:
+            return obj.file_size
         return obj.file.size
 
     def to_representation(self, obj):
@@ -178,7 +182,7 @@ class EditableStatisticMapSerializer(ImageSerializer):
     class Meta:
         model = StatisticMap
         read_only_fields = ('collection',)
-        exclude = ['polymorphic_ctype', 'ignore_file_warning', 'data']
+        exclude = ['polymorphic_ctype', 'ignore_file_warning', 'data', 'is_search_eligible', 'data_hash']
 
 
 class StatisticMapSerializer(ImageSerializer):
@@ -200,7 +204,7 @@ class StatisticMapSerializer(ImageSerializer):
 
     class Meta:
         model = StatisticMap
-        exclude = ['polymorphic_ctype', 'ignore_file_warning', 'data']
+        exclude = ['polymorphic_ctype', 'ignore_file_warning', 'data', 'is_search_eligible', 'data_hash']
 
     def value_to_python(self, value):
         if not value:
@@ -239,7 +243,7 @@ class NIDMResultStatisticMapSerializer(ImageSerializer):
 
     class Meta:
         model = NIDMResultStatisticMap
-        exclude = ['polymorphic_ctype']
+        exclude = ['polymorphic_ctype', 'is_search_eligible', 'data_hash']
 
     def to_representation(self, obj):
         return super(ImageSerializer, self).to_representation(obj)
@@ -251,7 +255,7 @@ class AtlasSerializer(ImageSerializer):
 
     class Meta:
         model = Atlas
-        exclude = ['polymorphic_ctype']
+        exclude = ['polymorphic_ctype', 'is_search_eligible']
 
     def to_representation(self, obj):
         return super(ImageSerializer, self).to_representation(obj)
@@ -325,6 +329,10 @@ class CollectionSerializer(serializers.ModelSerializer):
 
 
     def num_im(self, obj):
+        # annotated by the collection viewsets
+        n_images = getattr(obj, 'n_images', None)
+        if n_images is not None:
+            return n_images
         return obj.basecollectionitem_set.count()
 
     def get_owner_name(self, obj):
@@ -144,6 +144,43 @@ class TestAtlas(APITestCase):
                 responseText = eval(response.content)
                 self.assertEqual(responseText, region)
 
+    def test_batch_query_voxels_json(self):
+        print "\nChecking batch coordinate query with JSON..."
+        coordinates = [[58, -4, 18], [56, 20, 24], [0, 0, 0], [1000, 0, 0]]
+        response = self.client.post('/api/atlases/atlas_query_voxels/', {
+            'coordinates': coordinates,
+            'atlases': [{'atlas': 'orderedAtlas', 'collection': 'Collection1'},
+                        {'atlas': 'unorderedAtlas', 'collection': 'Collection1'}]
+        }, format='json')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        data = json.loads(''.join(response.streaming_content))
+        self.assertEqual(data['columns'], ['x', 'y', 'z', 'orderedAtlas', 'unorderedAtlas'])
+        self.assertEqual([row[3:] for row in data['results']],
+                         [['6v', '6v'], ['fop', 'fop'], ['none', 'none'], [None, None]])
+        for row in data['results'][:3]:
+            single = self.client.get('/api/atlases/atlas_query_voxel/?x=%s&y=%s&z=%s&atlas=orderedAtlas&collection=Collection1' % tuple(row[:3]))
+            self.assertEqual(json.loads(single.content), row[3])
+
+    def test_batch_query_voxels_csv(self):
+        print "\nChecking batch coordinate query with CSV..."
+        response = self.client.post(
+            '/api/atlases/atlas_query_voxels/?atlas=orderedAtlas&collection=Collection1',
+            'x,y,z,stat\n58,-4,18,5.2\n34,18,30,4.1\n', content_type='text/csv')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        lines = ''.join(response.streaming_content).splitlines()
+        self.assertEqual(lines, ['x,y,z,orderedAtlas', '58.0,-4.0,18.0,6v', '34.0,18.0,30.0,fop'])
+
+    def test_batch_query_voxels_errors(self):
+        url = '/api/atlases/atlas_query_voxels/'
+        atlases = [{'atlas': 'orderedAtlas', 'collection': 'Collection1'}]
+        for body in [{'coordinates': [], 'atlases': atlases},
+                     {'coordinates': [[1, 2]], 'atlases': atlases},
+                     {'coordinates': [['a', 2, 3]], 'atlases': atlases},
+                     {'coordinates': [[1, 2, 3]]},
+                     {'coordinates': [[1, 2, 3]], 'atlases': [{'atlas': 'missing', 'collection': 'Collection1'}]}]:
+            response = self.client.post(url, body, format='json')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
     # General API Tests
 
     def test_atlases(self):
@@ -0,0 +1,38 @@
+from django.contrib.auth.models import User
+
+from neurovault.apps.statmaps.models import Collection
+from neurovault.apps.statmaps.tests.utils import clearDB, save_statmap_form, QueryBudgetMixin
+from .base import APITestCase
+
+
+class TestQueryBudgets(QueryBudgetMixin, APITestCase):
+    """List endpoints make a fixed number of queries and do not touch the files of the images."""
+
+    def setUp(self):
+        self.user = User.objects.create_user('NeuroGuy')
+        self.coll = Collection(owner=self.user, name="Test Collection", DOI='10.3389/fninf.2015.00008')
+        self.coll.save()
+        save_statmap_form(self.abs_data_path('statmaps/motor_lips.nii.gz'), self.coll)
+
+    def tearDown(self):
+        clearDB()
+
+    def add_collections(self, n=3):
+        for i in range(n):
+            coll = Collection(owner=self.user, name="Test Collection %d" % i)
+            coll.save()
+            coll.contributors.add(self.user)
+            save_statmap_form(self.abs_data_path('statmaps/motor_lips.nii.gz'), coll)
+
+    def test_collections_list(self):
+        self.assertDoesNotGrow('/api/collections/', self.add_collections)
+        self.assertWithinBudget('/api/collections/', max_queries=5)
+
+    def test_images_list(self):
+        self.assertDoesNotGrow('/api/images/', self.add_collections)
+        self.assertWithinBudget('/api/images/', max_queries=5)
+
+    def test_my_collections_list(self):
+        self.client.force_authenticate(user=self.user)
+        self.assertDoesNotGrow('/api/my_collections/', self.add_collections)
+        self.assertWithinBudget('/api/my_collections/', max_queries=8)
@@ -0,0 +1,91 @@
+import os
+import shutil
+import tempfile
+
+import nibabel as nib
+import numpy as np
+from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from rest_framework import status
+
+from neurovault.apps.statmaps.models import Collection, Comparison, Image
+from neurovault.apps.statmaps.tests.utils import clearDB, save_statmap_form
+from neurovault.apps.statmaps.vector_store import get_store
+from neurovault.api.tests.base import APITestCase
+
+
+class TestSimilaritySearch(APITestCase):
+
+    def setUp(self):
+        self.user = User.objects.create(username='neurovault')
+        self.collection1 = Collection(name='Collection1', owner=self.user,
+                                      DOI='10.3389/fninf.2015.00099')
+        self.collection1.save()
+        self.collection2 = Collection(name='Collection2', owner=self.user,
+                                      DOI='10.3389/fninf.2015.00089')
+        self.collection2.save()
+        self.image1 = save_statmap_form(image_path=self.abs_data_path('statmaps/motor_lips.nii.gz'),
+                                        collection=self.collection1,
+                                        image_name="image1")
+        self.image2 = save_statmap_form(image_path=self.abs_data_path('statmaps/all.nii.gz'),
+                                        collection=self.collection2,
+                                        image_name="image2")
+
+    def tearDown(self):
+        clearDB()
+
+    def upload(self, rel_path):
+        return SimpleUploadedFile(rel_path.split('/')[-1], open(self.abs_data_path(rel_path)).read())
+
+    def test_search_by_upload(self):
+        n_images = Image.objects.count()
+        n_comparisons = Comparison.objects.count()
+
+        response = self.client.post('/api/similarity_search/',
+                                    {'file': self.upload('statmaps/motor_lips.nii.gz'), 'q': 10},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['partial'])
+        self.assertEqual(response.data['results'][0]['image_id'], self.image1.pk)
+        self.assertAlmostEqual(response.data['results'][0]['score'], 1.0, places=5)
+
+        # nothing is stored
+        self.assertEqual(Image.objects.count(), n_images)
+        self.assertEqual(Comparison.objects.count(), n_comparisons)
+
+    def test_invalid_upload(self):
+        response = self.client.post('/api/similarity_search/', {}, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+        response = self.client.post('/api/similarity_search/',
+                                    {'file': SimpleUploadedFile('map.txt', 'not a map')},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_invalid_number_of_results(self):
+        for q in ['0', '-5', '1.5', 'ten']:
+            response = self.client.post('/api/similarity_search/',
+                                        {'file': self.upload('statmaps/motor_lips.nii.gz'), 'q': q},
+                                        format='multipart')
+            self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_maps_missing_from_store_are_partial(self):
+        get_store().remove(self.image2.pk)
+        response = self.client.post('/api/similarity_search/',
+                                    {'file': self.upload('statmaps/motor_lips.nii.gz'), 'q': 10},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response.data['partial'])
+
+    def test_map_which_cannot_be_resampled(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'singular.nii.gz')
+            # singular affine
+            nib.save(nib.Nifti1Image(np.ones((10, 10, 10)), np.diag([2., 0., 2., 1.])), path)
+            response = self.client.post('/api/similarity_search/',
+                                        {'file': SimpleUploadedFile('singular.nii.gz', open(path, 'rb').read())},
+                                        format='multipart')
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
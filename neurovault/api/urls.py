@@ -3,7 +3,8 @@ from rest_framework import routers
 
 from .views import (
     AuthUserView, ImageViewSet, AtlasViewSet,
-    CollectionViewSet, NIDMResultsViewSet, MyCollectionsViewSet
+    CollectionViewSet, NIDMResultsViewSet, MyCollectionsViewSet,
+    SimilaritySearchView
 )
 
 router = routers.DefaultRouter()
@@ -14,4 +15,6 @@ router.register(r'my_collections', MyCollectionsViewSet, '')
 router.register(r'nidm_results', NIDMResultsViewSet)
 
 api_urls = router.urls + [url(r'^user/?$', AuthUserView.as_view(),
-                          name='api-auth-user')]
+                          name='api-auth-user'),
+                          url(r'^similarity_search/?$', SimilaritySearchView.as_view(),
+                          name='api-similarity-search')]
@@ -1,5 +1,14 @@
+from rest_framework.parsers import BaseParser
 from rest_framework.renderers import JSONRenderer
 
 
 class ExplicitUnicodeJSONRenderer(JSONRenderer):
-    charset = 'utf-8'
\ No newline at end of file
+    charset = 'utf-8'
+
+
+class CSVTextParser(BaseParser):
+    """Passes text/csv request bodies through as a string, views parse them themselves."""
+    media_type = 'text/csv'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream.read()
@@ -1,24 +1,38 @@
-import cPickle as pickle
-import os
+import csv
+import json
 import re
+import time
 import xml.etree.ElementTree as ET
-from django.http import HttpResponse
+from cStringIO import StringIO
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Count
+from django.db.models.query import prefetch_related_objects
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework import mixins, permissions, status, viewsets
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.filters import DjangoFilterBackend
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
 from rest_framework.renderers import JSONRenderer
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from taggit.models import Tag
 
+from neurovault.apps.statmaps.ann_index import get_ann_index
+from neurovault.apps.statmaps.atlas_index import get_atlas_index
 from neurovault.apps.statmaps.models import (Atlas, Collection, Image,
                                              StatisticMap, NIDMResults)
+from neurovault.apps.statmaps.ontology import get_ontology_graph
+from neurovault.apps.statmaps.resampling import make_reduced_representation
+from neurovault.apps.statmaps.similarity import search_vector
+from neurovault.apps.statmaps.synonyms import get_synonym_store
+from neurovault.apps.statmaps.utils import (get_searchable_image_pks,
+                                            load_uploaded_nifti)
 from neurovault.apps.statmaps.views import (get_collection, get_image,
                                             owner_or_contrib)
 from neurovault.apps.statmaps.voxel_query_functions import (getAtlasVoxels,
-                                                            getSynonyms,
-                                                            toAtlas,
-                                                            voxelToRegion)
+                                                            toAtlas)
 from .serializers import (UserSerializer, AtlasSerializer,
                           CollectionSerializer, EditableAtlasSerializer,
                           EditableNIDMResultsSerializer,
@@ -29,6 +43,7 @@ from .permissions import (ObjectOnlyPermissions,
                           ObjectOnlyPolymorphicPermissions)
 
 from .pagination import StandardResultPagination
+from .utils import CSVTextParser
 
 
 class JSONResponse(HttpResponse):
@@ -76,16 +91,96 @@ class AuthUserView(APIView):
         return Response(serializer.data)
 
 
+class SimilaritySearchView(APIView):
+
+    """
+    Finds public maps similar to an uploaded map. The upload is only resampled
+    in memory and searched against the stored maps, nothing is saved.\n
+    Parameters (POST, multipart): file (.nii or .nii.gz), q (number of results,
+    max 500), mode (exact or approximate), time_budget (seconds)
+    """
+    permission_classes = (permissions.AllowAny,)
+    parser_classes = (MultiPartParser, FormParser)
+    limit = 500
+
+    def post(self, request):
+        uploaded_file = request.data.get('file')
+        if not uploaded_file:
+            return Response('error: no file uploaded', status=400)
+        try:
+            max_results = min(int(request.data.get('q', 100)), self.limit)
+            time_budget = min(float(request.data.get('time_budget', settings.SIMILARITY_SEARCH_TIME_BUDGET)),
+                              settings.SIMILARITY_SEARCH_TIME_BUDGET)
+        except ValueError:
+            return Response('error: q and time_budget have to be numbers', status=400)
+        if max_results < 1:
+            return Response('error: q has to be a positive integer', status=400)
+        mode = request.data.get('mode', 'exact')
+        if mode not in ['exact', 'approximate']:
+            return Response('error: mode has to be exact or approximate', status=400)
+
+        start = time.time()
+        try:
+            nii = load_uploaded_nifti(uploaded_file)
+        except ValueError, e:
+            return Response('error: %s' % e, status=400)
+        # same transformation as save_resampled_transformation_single
+        try:
+            query = make_reduced_representation(nii, [4, 4, 4])
+        except Exception, e:
+            return Response('error: could not resample the map: %s' % e, status=400)
+        resampled = time.time()
+
+        candidate_pks = get_searchable_image_pks()
+        index = get_ann_index() if mode == 'approximate' else None
+        if index is not None:
+            result_pks, scores = index.search(query, max_results=max_results, allowed_pks=candidate_pks)
+            partial = False
+        else:
+            result_pks, scores, scanned, available = search_vector(
+                query, candidate_pks, max_results=max_results,
+                time_budget=max(time_budget - (resampled - start), 0))
+            partial = scanned < available
+
+        images = dict((image.pk, image) for image in
+                      Image.objects.filter(pk__in=result_pks).select_related('collection'))
+        results = []
+        for image_pk, score in zip(result_pks, scores):
+            image = images.get(image_pk)
+            if image is None:
+                continue
+            results.append({'image_id': image.pk,
+                            'score': score,
+                            'name': image.name,
+                            'collection_name': image.collection.name,
+                            'map_type': getattr(image, 'map_type', None),
+                            'url': request.build_absolute_uri(image.get_absolute_url()),
+                            'png_img_path': image.get_thumbnail_url()})
+
+        return Response({'results': results,
+                         'mode': 'approximate' if index is not None else 'exact',
+                         'partial': partial,
+                         'elapsed': time.time() - start})
+
+
 class ImageViewSet(mixins.RetrieveModelMixin,
                    mixins.ListModelMixin,
                    mixins.UpdateModelMixin,
                    mixins.DestroyModelMixin,
                    viewsets.GenericViewSet):
 
-    queryset = Image.objects.filter(collection__private=False)
+    queryset = Image.objects.filter(collection__private=False).select_related('collection')
     serializer_class = ImageSerializer
     permission_classes = (ObjectOnlyPolymorphicPermissions,)
 
+    def paginate_queryset(self, queryset):
+        page = super(ImageViewSet, self).paginate_queryset(queryset)
+        if page is not None:
+            # the pages are mixed image types, only statistic maps have cognitive atlas terms
+            prefetch_related_objects([image for image in page if isinstance(image, StatisticMap)],
+                                     ['cognitive_paradigm_cogatlas', 'cognitive_contrast_cogatlas'])
+        return page
+
     def _get_api_image(self, request, pk=None):
         private_url = re.match(r'^[A-Z]{8}\-\d+$', pk)
         if private_url:
@@ -131,7 +226,7 @@ class ImageViewSet(mixins.RetrieveModelMixin,
 
 
 class AtlasViewSet(ImageViewSet):
-    queryset = Atlas.objects.filter(collection__private=False)
+    queryset = Atlas.objects.filter(collection__private=False).select_related('collection')
     serializer_class = AtlasSerializer
     permission_classes = (ObjectOnlyPolymorphicPermissions,)
 
@@ -182,8 +277,6 @@ class AtlasViewSet(ImageViewSet):
         search = request.GET.get('region', '')
         atlas = request.GET.get('atlas', '').replace('\'', '')
         collection = request.GET.get('collection', '')
-        neurovault_root = os.path.dirname(
-            os.path.dirname(os.path.realpath(__file__)))
         try:
             collection_object = Collection.objects.filter(name=collection)[0]
         except IndexError:
@@ -194,27 +287,18 @@ class AtlasViewSet(ImageViewSet):
         try:
             atlas_object = Atlas.objects.filter(
                 name=atlas, collection=collection_object)[0]
-            atlas_image = atlas_object.file
-            atlas_xml = atlas_object.label_description_file
         except IndexError:
             return JSONResponse('could not find %s' % atlas, status=400)
         if request.method == 'GET':
-            atlas_xml.open()
-            root = ET.fromstring(atlas_xml.read())
-            atlas_xml.close()
-            atlasRegions = [x.text.lower()
-                            for x in root.find('data').findall('label')]
+            atlas_index = get_atlas_index(atlas_object)
+            atlasRegions = atlas_index.regions
             if search in atlasRegions:
                 searchList = [search]
             else:
-                synonymsDict = {}
-                with open(os.path.join(neurovault_root, 'neurovault/apps/statmaps/NIFgraph.pkl'), 'rb') as input:
-                    graph = pickle.load(input)
-                for atlasRegion in atlasRegions:
-                    synonymsDict[atlasRegion] = getSynonyms(atlasRegion)
+                synonymIndex = get_synonym_store().index(atlasRegions)
                 try:
                     searchList = toAtlas(
-                        search, graph, atlasRegions, synonymsDict)
+                        search, get_ontology_graph(), atlasRegions, synonymIndex)
                 except ValueError:
                     return Response(
                         'error: region not in atlas or ontology',
@@ -227,7 +311,7 @@ class AtlasViewSet(ImageViewSet):
                     )
             try:
                 data = {
-                    'voxels': getAtlasVoxels(searchList, atlas_image, atlas_xml)}
+                    'voxels': getAtlasVoxels(searchList, atlas_index).tolist()}
             except ValueError:
                 return Response('error: region not in atlas', status=400)
 
@@ -254,18 +338,13 @@ class AtlasViewSet(ImageViewSet):
                 status=400
             )
         try:
-            print atlas
-            print[x.name
-                  for x in Atlas.objects.filter(collection=collection_object)]
             atlas_object = Atlas.objects.filter(
                 name=atlas, collection=collection_object)[0]
-            atlas_image = atlas_object.file
-            atlas_xml = atlas_object.label_description_file
         except IndexError:
             return JSONResponse('error: could not find atlas: %s' % atlas,
                                 status=400)
         try:
-            data = voxelToRegion(X, Y, Z, atlas_image, atlas_xml)
+            data = get_atlas_index(atlas_object).voxel_to_region(X, Y, Z)
         except IndexError:
             return JSONResponse(
                 'error: one or more coordinates are out of range',
@@ -273,9 +352,138 @@ class AtlasViewSet(ImageViewSet):
             )
         return Response(data)
 
+    @list_route(methods=['post'], parser_classes=(JSONParser, CSVTextParser),
+                permission_classes=(permissions.AllowAny,))
+    def atlas_query_voxels(self, request, pk=None):
+        """
+        Returns the regions at many coordinates in one or more atlases.\n
+        Body: JSON {"coordinates": [[x, y, z], ...], "atlases": [{"atlas": ..., "collection": ...}, ...]}
+        or CSV (Content-Type: text/csv) with x, y, z in the first three columns. Atlases can also be
+        given as atlas and collection parameters, one collection is used for all atlases.
+        The response has the format of the request: a row of x, y, z and the region in every atlas
+        per coordinate (null / empty outside of the atlas volume).\n
+        Example: curl -H 'Content-Type: text/csv' --data-binary @peaks.csv '/api/atlases/atlas_query_voxels/?collection=Harvard-Oxford cortical and subcortical structural atlases&atlas=HarvardOxford cort maxprob thr25 1mm'
+        """
+        as_csv = isinstance(request.data, basestring)
+        try:
+            coordinates = parse_coordinates(request.data)
+        except ValueError, e:
+            return Response('error: %s' % e, status=400)
+        if len(coordinates) > settings.ATLAS_QUERY_MAX_COORDINATES:
+            return Response('error: at most %d coordinates can be queried at once'
+                            % settings.ATLAS_QUERY_MAX_COORDINATES, status=400)
+
+        try:
+            atlas_names = get_queried_atlases(request)
+        except ValueError, e:
+            return Response('error: %s' % e, status=400)
+        regions = []
+        for collection, atlas in atlas_names:
+            try:
+                atlas_object = Atlas.objects.filter(
+                    name=atlas, collection__name=collection)[0]
+            except IndexError:
+                return Response('error: could not find atlas: %s' % atlas,
+                                status=400)
+            regions.append(get_atlas_index(atlas_object).voxels_to_regions(coordinates))
+
+        columns = ['x', 'y', 'z'] + [atlas for _, atlas in atlas_names]
+        rows = (xyz + list(row_regions) for xyz, row_regions in
+                zip(coordinates.tolist(), zip(*regions)))
+        if as_csv:
+            return StreamingHttpResponse(stream_csv(columns, rows), content_type='text/csv')
+        return StreamingHttpResponse(stream_json(columns, rows), content_type='application/json')
+
+
+def parse_coordinates(data):
+    """(n, 3) array of a JSON list of (x, y, z), or of the first three columns of a CSV text."""
+    if isinstance(data, basestring):
+        rows = [row[:3] for row in csv.reader(StringIO(data)) if any(value.strip() for value in row)]
+        try:
+            float(rows[0][0])
+        except IndexError:
+            raise ValueError('no coordinates given')
+        except ValueError:
+            # header
+            rows = rows[1:]
+        data = rows
+    elif isinstance(data, dict):
+        data = data.get('coordinates')
+    if not data:
+        raise ValueError('no coordinates given')
+    try:
+        coordinates = np.asarray(data, dtype=np.float64)
+    except (TypeError, ValueError):
+        raise ValueError('coordinates have to be numbers')
+    if coordinates.ndim != 2 or coordinates.shape[1] != 3:
+        raise ValueError('coordinates have to be (x, y, z) triples')
+    return coordinates
+
+
+def get_queried_atlases(request):
+    """(collection name, atlas name) of the atlases of a batch query."""
+    if isinstance(request.data, dict) and request.data.get('atlases'):
+        pairs = [(item.get('collection', ''), item.get('atlas', '')) for item in request.data['atlases']]
+    else:
+        atlases = request.query_params.getlist('atlas')
+        collections = request.query_params.getlist('collection')
+        if len(collections) == 1:
+            collections = collections * len(atlases)
+        if len(collections) != len(atlases):
+            raise ValueError('give one collection, or one collection per atlas')
+        pairs = zip(collections, atlases)
+    if not pairs:
+        raise ValueError('no atlas given')
+    return [(collection, atlas.replace('\'', '')) for collection, atlas in pairs]
+
+
+def _chunks(rows, size=1000):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def stream_json(columns, rows):
+    yield '{"columns": %s, "results": [' % json.dumps(columns)
+    separator = '\n'
+    for chunk in _chunks(rows):
+        yield separator + ',\n'.join(json.dumps(row) for row in chunk)
+        separator = ',\n'
+    yield ']}'
+
+
+def stream_csv(columns, rows):
+    def encode(value):
+        if value is None:
+            return ''
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return value
+
+    output = StringIO()
+    writer = csv.writer(output)
+    writer.writerow([encode(value) for value in columns])
+    yield output.getvalue()
+    for chunk in _chunks(rows):
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerows([[encode(value) for value in row] for row in chunk])
+        yield output.getvalue()
+
+
+def with_collection_relations(queryset):
+    """Loads what CollectionSerializer needs for every collection in a fixed number of queries."""
+    return queryset.select_related('owner').prefetch_related('contributors')\
+        .annotate(n_images=Count('basecollectionitem'))
+
 
 class CollectionViewSet(viewsets.ModelViewSet):
-    queryset = Collection.objects.filter(private=False)
+    queryset = with_collection_relations(Collection.objects.filter(private=False))
     filter_fields = ('name', 'DOI', 'owner')
     serializer_class = CollectionSerializer
     filter_backends = (DjangoFilterBackend,)
@@ -353,7 +561,7 @@ class MyCollectionsViewSet(CollectionViewSet):
 
     def get_queryset(self):
         user = self.request.user
-        return Collection.objects.filter(owner=user)
+        return with_collection_relations(Collection.objects.filter(owner=user))
 
 
 class NIDMResultsViewSet(mixins.RetrieveModelMixin,
@@ -6,8 +6,9 @@ from ..statmaps.models import Collection
 
 def index_view(request):
     recent_collections = Collection.objects.exclude(DOI__isnull=True).exclude(private=True).order_by('-doi_add_date')
-    #this is faster than using annotate and count!
-    recent_collections = [col for col in recent_collections if col.basecollectionitem_set.count() > 0][:10]
+    # non empty collections with their number of images in one query, not a count per collection
+    recent_collections = recent_collections.annotate(n_images=Count('basecollectionitem'))
+    recent_collections = list(recent_collections.filter(n_images__gt=0)[:10])
     
     context = {'recent_collections': recent_collections}
     return render(request, 'index.html.haml', context)
\ No newline at end of file
@@ -0,0 +1,167 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from sklearn.cluster import MiniBatchKMeans
+
+from neurovault.apps.statmaps.similarity import pearson_against_matrix
+from neurovault.apps.statmaps.vector_store import get_store
+
+
+INDEX_FILENAME = "ann_index.npz"
+
+# rows used to estimate the principal components
+PCA_SAMPLE_SIZE = 2000
+
+
+def _standardize(block):
+    """z-score every row over its usable (non zero, not nan) voxels, zero elsewhere.
+
+    Rows are scaled to unit norm, so that dot products approximate the masked Pearson score.
+    """
+    block = np.array(block, dtype=np.float64, ndmin=2)
+    valid = np.logical_and(block != 0, np.logical_not(np.isnan(block)))
+    block[np.logical_not(valid)] = 0
+    n = np.maximum(valid.sum(axis=1), 1)[:, np.newaxis]
+    mean = block.sum(axis=1)[:, np.newaxis] / n
+    block = np.where(valid, block - mean, 0)
+    norm = np.sqrt((block * block).sum(axis=1))[:, np.newaxis]
+    norm[norm == 0] = 1
+    return block / norm
+
+
+class ANNIndex(object):
+    """Approximate nearest neighbour index over the reduced representation store.
+
+    Vectors are standardized and projected onto their first principal components, the
+    embeddings are partitioned with k-means (inverted file). A query visits the n_probe
+    partitions with the highest absolute similarity to it, keeps the best candidates by
+    embedding similarity and re-ranks them with the exact masked Pearson score.
+    Images added to the store after the index was built are always scored exactly.
+    """
+
+    def __init__(self, pks, mean, components, centroids, labels, embeddings):
+        self.pks = np.asarray(pks, dtype=np.int64)
+        self.mean = mean
+        self.components = components
+        self.centroids = centroids
+        self.labels = labels
+        self.embeddings = embeddings
+
+    @classmethod
+    def build(cls, store, n_components=64, n_clusters=None, block_size=1024, random_state=0):
+        pks = np.array(store.live_pks(), dtype=np.int64)
+        if len(pks) == 0:
+            raise ValueError("The reduced representation store is empty")
+        rows, _ = store.rows_for(pks.tolist())
+        matrix = store.matrix
+
+        rng = np.random.RandomState(random_state)
+        sample = np.sort(rng.permutation(len(rows))[:PCA_SAMPLE_SIZE])
+        data = _standardize(matrix[rows[sample]])
+        mean = data.mean(axis=0)
+        data -= mean
+
+        # principal components from the (sample x sample) gram matrix
+        n_components = min(n_components, len(sample))
+        eigenvalues, eigenvectors = np.linalg.eigh(np.dot(data, data.T))
+        order = np.argsort(eigenvalues)[::-1][:n_components]
+        eigenvalues = np.maximum(eigenvalues[order], 1e-12)
+        components = (np.dot(data.T, eigenvectors[:, order]) / np.sqrt(eigenvalues)).T
+        del data
+
+        embeddings = np.empty((len(rows), n_components), dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            embeddings[start:start + block_size] = cls._embed(matrix[rows[start:start + block_size]],
+                                                              mean, components)
+
+        if n_clusters is None:
+            n_clusters = int(np.sqrt(len(rows)))
+        n_clusters = max(1, min(n_clusters, len(rows)))
+        kmeans = MiniBatchKMeans(n_clusters=n_clusters, random_state=random_state).fit(embeddings)
+        return cls(pks, mean.astype(np.float32), components.astype(np.float32),
+                   kmeans.cluster_centers_.astype(np.float32), kmeans.labels_.astype(np.int32), embeddings)
+
+    @staticmethod
+    def _embed(block, mean, components):
+        embedding = np.dot(_standardize(block) - mean, components.T)
+        norm = np.sqrt((embedding * embedding).sum(axis=1))[:, np.newaxis]
+        norm[norm == 0] = 1
+        return embedding / norm
+
+    def embed(self, vectors):
+        return self._embed(vectors, self.mean, self.components)
+
+    def save(self, path):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, pks=self.pks, mean=self.mean, components=self.components,
+                     centroids=self.centroids, labels=self.labels, embeddings=self.embeddings)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            return cls(data['pks'], data['mean'], data['components'], data['centroids'],
+                       data['labels'], data['embeddings'])
+
+    def candidates(self, query, n_candidates, n_probe, allowed_pks=None):
+        """pks of the n_candidates indexed images closest to the query in the probed partitions."""
+        embedding = self.embed(query)[0]
+        n_probe = max(1, min(n_probe, len(self.centroids)))
+        probed = np.argsort(-np.abs(np.dot(self.centroids, embedding)))[:n_probe]
+        members = np.flatnonzero(np.in1d(self.labels, probed))
+        if allowed_pks is not None:
+            members = members[np.in1d(self.pks[members], list(allowed_pks))]
+        similarity = np.abs(np.dot(self.embeddings[members], embedding))
+        if len(members) > n_candidates:
+            members = members[np.argpartition(-similarity, n_candidates - 1)[:n_candidates]]
+        return self.pks[members]
+
+    def search(self, query, max_results=100, n_probe=None, rerank_factor=None, allowed_pks=None, store=None):
+        """Approximate top matches of a query vector, re-ranked with the exact masked Pearson.
+
+        Returns the pks and scores ordered by decreasing absolute score.
+        """
+        if n_probe is None:
+            n_probe = settings.SIMILARITY_ANN_N_PROBE
+        if rerank_factor is None:
+            rerank_factor = settings.SIMILARITY_ANN_RERANK_FACTOR
+        if store is None:
+            store = get_store()
+
+        candidate_pks = set(self.candidates(query, max_results * rerank_factor, n_probe,
+                                            allowed_pks=allowed_pks).tolist())
+        # images added since the index was built are scored exactly
+        candidate_pks.update(set(store.live_pks()) - set(self.pks.tolist()))
+        if allowed_pks is not None:
+            candidate_pks.intersection_update(allowed_pks)
+
+        rows, row_pks = store.rows_for(sorted(candidate_pks))
+        if not row_pks:
+            return [], []
+        scores = pearson_against_matrix(query, store.matrix, rows=rows)
+        order = [i for i in np.argsort(-np.abs(scores)) if not np.isnan(scores[i])][:max_results]
+        return [row_pks[i] for i in order], [float(scores[i]) for i in order]
+
+
+def get_index_path():
+    return os.path.join(get_store().path, INDEX_FILENAME)
+
+
+_index = None
+_index_mtime = None
+
+
+def get_ann_index():
+    """Index shared by the process, reloaded when it is rebuilt. None if it has not been built."""
+    global _index, _index_mtime
+    path = get_index_path()
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        _index, _index_mtime = None, None
+        return None
+    if mtime != _index_mtime:
+        _index, _index_mtime = ANNIndex.load(path), mtime
+    return _index
@@ -0,0 +1,144 @@
+import os
+import threading
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+
+import nibabel
+import numpy as np
+import numpy.linalg as npl
+
+MAX_CACHED_ATLASES = 16
+MAX_CACHED_REGIONS = 64
+
+
+def clean_region_name(name):
+    return name.replace("'", '').rstrip(' ').lower()
+
+
+def parse_atlas_labels(xml_string):
+    """(label value, lower case name) of every region of an FSL style atlas description.
+
+    Regions have either an index attribute (label value - 1) or index and name children.
+    """
+    labels = []
+    for line in ET.fromstring(xml_string).find('data').findall('label'):
+        if line.get('index') is not None:
+            labels.append((int(line.get('index')) + 1, line.text.lower()))
+        else:
+            labels.append((int(line.find('index').text), line.find('name').text.lower()))
+    return labels
+
+
+class AtlasIndex(object):
+    """Label volume and regions of an atlas, held in memory for point and region lookups."""
+
+    def __init__(self, label_data, affine, labels):
+        self.label_data = label_data
+        self.affine = affine
+        self.inverse_affine = npl.inv(affine)
+        self.regions = [name for _, name in labels]
+        self.label_names = dict(labels)
+        self.region_labels = dict((clean_region_name(name), value) for value, name in labels)
+        self._region_voxels = OrderedDict()
+        self._region_voxels_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, image_path, xml_string):
+        atlas = nibabel.load(image_path)
+        label_data = np.asarray(atlas.get_data())
+        label_data = label_data.reshape(label_data.shape[:3]).astype(np.int32)
+        return cls(label_data, atlas.get_affine(), parse_atlas_labels(xml_string))
+
+    def voxels_to_regions(self, coordinates):
+        """Region names at an (n, 3) array of mm coordinates.
+
+        'none' where no region is labelled, None where the coordinates are outside of
+        the atlas volume. Raises ValueError if the coordinates are not numbers.
+        """
+        coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 3)
+        # truncated like the voxel indices have always been
+        ijk = nibabel.affines.apply_affine(self.inverse_affine, coordinates).astype(np.int64)
+        inside = np.all((ijk >= 0) & (ijk < self.label_data.shape), axis=1)
+        values = np.zeros(len(ijk), dtype=np.int64)
+        values[inside] = self.label_data[tuple(ijk[inside].T)]
+        return [self.label_names.get(value, 'none') if is_inside else None
+                for value, is_inside in zip(values.tolist(), inside.tolist())]
+
+    def label_voxels(self, value):
+        """(3, n) array of the mm coordinates of the voxels with a label value, cached per label."""
+        with self._region_voxels_lock:
+            voxels = self._region_voxels.pop(value, None)
+            if voxels is not None:
+                self._region_voxels[value] = voxels
+                return voxels
+
+        ijk = np.column_stack(np.nonzero(self.label_data == value))
+        voxels = nibabel.affines.apply_affine(self.affine, ijk).T
+        voxels.setflags(write=False)
+
+        with self._region_voxels_lock:
+            self._region_voxels[value] = voxels
+            while len(self._region_voxels) > MAX_CACHED_REGIONS:
+                self._region_voxels.popitem(last=False)
+        return voxels
+
+    def region_voxels(self, regions):
+        """(3, n) array of the mm coordinates of all voxels of the named regions.
+
+        Raises ValueError if none of the regions has any voxels.
+        """
+        values = sorted(set(self.region_labels[region.lower()] for region in regions
+                            if region.lower() in self.region_labels))
+        voxels = [self.label_voxels(value) for value in values]
+        voxels = [v for v in voxels if v.shape[1]]
+        if not voxels:
+            raise ValueError('%s not in the atlas' % ', '.join('"%s"' % region for region in regions))
+        if len(voxels) == 1:
+            return voxels[0]
+        return np.concatenate(voxels, axis=1)
+
+    def voxel_to_region(self, x, y, z):
+        """Name of the region at the given mm coordinates, 'none' outside of all regions.
+
+        Raises IndexError if the coordinates are outside of the atlas volume.
+        """
+        region = self.voxels_to_regions([[x, y, z]])[0]
+        if region is None:
+            raise IndexError("(%s, %s, %s) is outside of the atlas" % (x, y, z))
+        return region
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+
+
+def _files_key(atlas):
+    return (os.stat(atlas.file.path).st_mtime, os.stat(atlas.label_description_file.path).st_mtime)
+
+
+def get_atlas_index(atlas):
+    """AtlasIndex of an Atlas shared by the process, reloaded when one of its files changes."""
+    key = _files_key(atlas)
+    with _indexes_lock:
+        cached = _indexes.pop(atlas.pk, None)
+        if cached is not None and cached[0] == key:
+            _indexes[atlas.pk] = cached
+            return cached[1]
+
+    atlas.label_description_file.open()
+    try:
+        xml_string = atlas.label_description_file.read()
+    finally:
+        atlas.label_description_file.close()
+    index = AtlasIndex.load(atlas.file.path, xml_string)
+
+    with _indexes_lock:
+        _indexes[atlas.pk] = (key, index)
+        while len(_indexes) > MAX_CACHED_ATLASES:
+            _indexes.popitem(last=False)
+    return index
+
+
+def clear_atlas_indexes():
+    with _indexes_lock:
+        _indexes.clear()
@@ -0,0 +1,133 @@
+import json
+import resource
+import timeit
+import traceback
+from collections import OrderedDict
+
+import numpy as np
+
+
+def _proc_status_mb(field):
+    """A memory field of /proc/self/status (in kilobytes there), None where it does not exist."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024.0
+    except IOError:
+        pass
+    return None
+
+
+def current_rss_mb():
+    return _proc_status_mb('VmRSS')
+
+
+def reset_peak_rss():
+    """Restarts the peak RSS (VmHWM) of the process from its current RSS, False where Linux does not allow it."""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except IOError:
+        return False
+
+
+def peak_rss_mb():
+    """Peak resident set size since the last reset_peak_rss, else since the process started."""
+    peak = _proc_status_mb('VmHWM')
+    if peak is None:
+        # ru_maxrss is in kilobytes on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return peak
+
+
+def summarize(durations):
+    """Latency percentiles (in ms) and throughput (calls per second) of a list of durations in seconds."""
+    durations = np.asarray(durations, dtype=np.float64)
+    if len(durations) == 0:
+        return {'n': 0}
+    total = durations.sum()
+    p50, p95, p99 = np.percentile(durations, [50, 95, 99]) * 1000
+    return {'n': len(durations),
+            'mean_ms': durations.mean() * 1000,
+            'p50_ms': p50,
+            'p95_ms': p95,
+            'p99_ms': p99,
+            'max_ms': durations.max() * 1000,
+            'throughput_per_s': len(durations) / total if total > 0 else None}
+
+
+class BenchmarkSuite(object):
+    """Runs named cases, each a function called once per argument, and collects their statistics.
+
+    A failing call is counted and reported but does not stop the case, so that one broken
+    component (e.g. missing gene expression data) does not hide the results of the others.
+    """
+
+    def __init__(self, verbose=True):
+        self.results = OrderedDict()
+        self.verbose = verbose
+
+    def run(self, name, func, arguments):
+        durations = []
+        errors = []
+        rss_before = current_rss_mb()
+        peak_is_per_case = reset_peak_rss()
+        for argument in arguments:
+            start = timeit.default_timer()
+            try:
+                func(argument)
+            except Exception:
+                errors.append(traceback.format_exc().strip().split('\n')[-1])
+                continue
+            durations.append(timeit.default_timer() - start)
+
+        result = summarize(durations)
+        result['errors'] = len(errors)
+        if errors:
+            result['first_error'] = errors[0]
+        # memory the case kept, and the peak while it ran where the peak could be reset
+        rss_after = current_rss_mb()
+        result['rss_delta_mb'] = rss_after - rss_before if rss_before is not None and rss_after is not None else None
+        result['peak_rss_mb'] = peak_rss_mb()
+        result['peak_rss_scope'] = 'case' if peak_is_per_case else 'process'
+        self.results[name] = result
+        if self.verbose:
+            print format_result(name, result)
+        return result
+
+    def to_json(self, metadata=None):
+        return json.dumps({'metadata': metadata or {}, 'results': self.results}, indent=2)
+
+
+def format_result(name, result):
+    if not result['n']:
+        return "%-24s no successful calls (%d errors: %s)" % (name, result['errors'], result.get('first_error'))
+    line = "%-24s n=%-5d p50=%9.2fms p95=%9.2fms p99=%9.2fms %8.2f/s %s peak rss=%.0fMB" % (
+        name, result['n'], result['p50_ms'], result['p95_ms'], result['p99_ms'],
+        result['throughput_per_s'] or 0, result['peak_rss_scope'], result['peak_rss_mb'])
+    if result['rss_delta_mb'] is not None:
+        line += " rss delta=%+.0fMB" % result['rss_delta_mb']
+    if result['errors']:
+        line += " (%d errors)" % result['errors']
+    return line
+
+
+def load_baseline(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, metric='p95_ms'):
+    """Cases whose metric got worse than the baseline by more than tolerance (a fraction).
+
+    Returns a list of (name, baseline value, current value) tuples.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline or metric not in result or metric not in baseline[name]:
+            continue
+        if result[metric] > baseline[name][metric] * (1 + tolerance):
+            regressions.append((name, baseline[name][metric], result[metric]))
+    return regressions
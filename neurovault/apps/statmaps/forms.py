@@ -28,7 +28,7 @@ import tempfile
 from neurovault.apps.statmaps.utils import (
     split_filename, get_paper_properties,
     detect_4D, split_4D_to_3D, memory_uploadfile,
-    is_thresholded, not_in_mni,
+    is_thresholded, not_in_mni, infer_map_type, get_missing_mask, get_data_hash,
     splitext_nii_gz)
 from neurovault.apps.statmaps.nidm_results import NIDMUpload
 from django import forms
@@ -617,6 +617,8 @@ class StatisticMapForm(ImageForm):
         cleaned_data = super(StatisticMapForm, self).clean()
         django_file = cleaned_data.get("file")
 
+        self.data_hash = None
+        self.mni_check = None
         cleaned_data["is_valid"] = True #This will be only saved if the form will validate
         cleaned_data["tags"] = clean_tags(cleaned_data)
         print cleaned_data
@@ -634,7 +636,10 @@ class StatisticMapForm(ImageForm):
                 filename=django_file.name, mode='rb', fileobj=fileobj)
             nii = nb.Nifti1Image.from_file_map(
                 {'image': nb.FileHolder(django_file.name, gzfileobj)})
-            cleaned_data["is_thresholded"], ratio_bad = is_thresholded(nii)
+            # the checks share the missing-voxel mask; their results and the hash spare save() loading the file again
+            missing_mask = get_missing_mask(nii.get_data())
+            self.data_hash = get_data_hash(nii)
+            cleaned_data["is_thresholded"], ratio_bad = is_thresholded(nii, missing_mask=missing_mask)
             cleaned_data["perc_bad_voxels"] = ratio_bad*100.0
 
             if cleaned_data["is_thresholded"] and not cleaned_data.get("ignore_file_warning") and cleaned_data.get("map_type") != "R":
@@ -646,8 +651,9 @@ class StatisticMapForm(ImageForm):
                 self.fields[
                     "ignore_file_warning"].widget = forms.CheckboxInput()
             else:
+                self.mni_check = not_in_mni(nii, missing_mask=missing_mask)
                 cleaned_data["not_mni"], cleaned_data["brain_coverage"], cleaned_data[
-                    "perc_voxels_outside"] = not_in_mni(nii)
+                    "perc_voxels_outside"] = self.mni_check
                 if cleaned_data["not_mni"] and not cleaned_data.get("ignore_file_warning") and cleaned_data.get(
                     "map_type") != "R":
                     self._errors["file"] = self.error_class(
@@ -664,6 +670,9 @@ class StatisticMapForm(ImageForm):
                 if "is_thresholded" in cleaned_data:
                     del cleaned_data["is_thresholded"]
 
+            if cleaned_data.get("map_type") == BaseStatisticMap.OTHER:
+                cleaned_data["map_type"] = infer_map_type(nii, missing_mask=missing_mask)
+
         return cleaned_data
 
     class Meta(ImageForm.Meta):
@@ -711,8 +720,16 @@ class StatisticMapForm(ImageForm):
     def save(self, commit=True):
         if self.afni_subbricks:
             return self.save_afni_slices(commit)
-        else:
-            return super(StatisticMapForm, self).save(commit=commit)
+        instance = super(StatisticMapForm, self).save(commit=False)
+        # results of clean() which are not form fields, so that the model does not load the file again
+        if self.mni_check is not None:
+            instance.not_mni, instance.brain_coverage, instance.perc_voxels_outside = self.mni_check
+        if self.data_hash is not None:
+            instance.data_hash = self.data_hash
+        if commit:
+            instance.save()
+            self.save_m2m()
+        return instance
 
 
 class AtlasForm(ImageForm):
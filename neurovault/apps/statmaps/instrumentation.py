@@ -0,0 +1,132 @@
+import threading
+import time
+from functools import wraps
+
+from django.core.cache import caches
+from django.db.backends.utils import CursorWrapper
+
+
+_local = threading.local()
+
+_MISSING = object()
+
+
+class RequestStats(object):
+    """Counters of one request, filled in by the instrumented cache backends, database cursors and
+    the MNI mask cache."""
+
+    def __init__(self):
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.db_queries = 0
+        self.db_time = 0.0
+        self.mni_mask_hits = 0
+        self.mni_mask_misses = 0
+
+
+def start_request_stats():
+    _local.stats = RequestStats()
+    return _local.stats
+
+
+def stop_request_stats():
+    stats = getattr(_local, 'stats', None)
+    _local.stats = None
+    return stats
+
+
+def current_request_stats():
+    return getattr(_local, 'stats', None)
+
+
+def _count_get(get):
+    @wraps(get)
+    def wrapper(self, key, default=None, *args, **kwargs):
+        value = get(self, key, _MISSING, *args, **kwargs)
+        stats = current_request_stats()
+        if stats is not None:
+            if value is _MISSING:
+                stats.cache_misses += 1
+            else:
+                stats.cache_hits += 1
+        return default if value is _MISSING else value
+    wrapper._counts_cache_hits = True
+    return wrapper
+
+
+def _count_get_many(get_many):
+    @wraps(get_many)
+    def wrapper(self, keys, *args, **kwargs):
+        keys = list(keys)
+        # the default get_many calls get for every key, those are not counted twice
+        stats = stop_request_stats()
+        try:
+            values = get_many(self, keys, *args, **kwargs)
+        finally:
+            _local.stats = stats
+        if stats is not None:
+            stats.cache_hits += len(values)
+            stats.cache_misses += len(keys) - len(values)
+        return values
+    wrapper._counts_cache_hits = True
+    return wrapper
+
+
+_install_lock = threading.Lock()
+
+
+def install_cache_counters():
+    """Counts hits and misses of get/get_many of every configured cache backend class."""
+    from django.conf import settings
+
+    with _install_lock:
+        for alias in settings.CACHES:
+            backend = type(caches[alias])
+            if not getattr(backend.get, '_counts_cache_hits', False):
+                backend.get = _count_get(backend.get)
+            if not getattr(backend.get_many, '_counts_cache_hits', False):
+                backend.get_many = _count_get_many(backend.get_many)
+
+
+def _count_execute(execute):
+    @wraps(execute)
+    def wrapper(self, *args, **kwargs):
+        stats = current_request_stats()
+        if stats is None:
+            return execute(self, *args, **kwargs)
+        start = time.time()
+        try:
+            return execute(self, *args, **kwargs)
+        finally:
+            stats.db_queries += 1
+            stats.db_time += time.time() - start
+    wrapper._counts_queries = True
+    return wrapper
+
+
+def install_query_counters():
+    """Counts the queries and their time of every database cursor.
+
+    Counted at the cursor, as the queries_log of a connection is capped and shared by the
+    requests the connection serves.
+    """
+    with _install_lock:
+        for method in ('execute', 'executemany'):
+            if not getattr(getattr(CursorWrapper, method), '_counts_queries', False):
+                setattr(CursorWrapper, method, _count_execute(getattr(CursorWrapper, method)))
+
+
+def read_io_counters():
+    """(bytes read by any read call, bytes read from storage) of the current thread, None if unknown.
+
+    Linux only. The first includes files served from the page cache and sockets, the second
+    only what had to come from disk.
+    """
+    for path in ('/proc/thread-self/io', '/proc/self/io'):
+        try:
+            with open(path) as f:
+                counters = dict(line.split(':') for line in f.read().splitlines() if ':' in line)
+            return int(counters['rchar']), int(counters['read_bytes'])
+        except (IOError, OSError, KeyError, ValueError):
+            continue
+    return None
@@ -1,83 +1,220 @@
+import datetime
+import glob
+import os
+import shutil
+import tempfile
+import urllib
+import xml.etree.ElementTree as ET
+
+import nibabel as nb
+import numpy as np
+from celery import current_app
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.core.management.base import BaseCommand, CommandError
-from neurovault.apps.statmaps.tests.utils import clearDB, save_statmap_form
+from django.test import Client
+
+from neurovault.apps import statmaps
+from neurovault.apps.statmaps.benchmarking import BenchmarkSuite, compare_to_baseline, load_baseline
+from neurovault.apps.statmaps.forms import AtlasForm, StatisticMapForm
 from neurovault.apps.statmaps.models import User, Collection
-from neurovault.apps.statmaps.utils import get_similar_images
+from neurovault.apps.statmaps.resampling import make_reduced_representation
+from neurovault.apps.statmaps.synthetic import load_manifest, write_synthetic_dataset, MANIFEST_FILENAME
+from neurovault.apps.statmaps.tasks import run_voxelwise_pearson_similarity
+from neurovault.apps.statmaps.tests.utils import clearDB
+from neurovault.apps.statmaps.utils import get_images_to_compare_with, count_existing_comparisons
 
-import os
-import gc
-import timeit, datetime, tarfile
-import numpy as np
+CASES = ['upload_validation', 'upload', 'reduced_representation', 'similarity_fanout', 'find_similar_json',
+         'compare_images', 'atlas_query_voxel', 'atlas_query_region', 'gene_decoding',
+         'collection_download', 'api_list']
+
+API_LIST_ENDPOINTS = ['/api/images/', '/api/collections/', '/api/atlases/']
+
+ATLAS_DATA = ('api/VentralFrontal_thr75_summaryimage_2mm.nii.gz', 'api/VentralFrontal_thr75_summaryimage_2mm.xml')
 
-class Timer:
-    def __init__(self, timer=None, disable_gc=False, verbose=True):
-        if timer is None:
-            timer = timeit.default_timer
-        self.timer = timer
-        self.disable_gc = disable_gc
-        self.verbose = verbose
-        self.start = self.end = self.interval = None
-    def __enter__(self):
-        if self.disable_gc:
-            self.gc_state = gc.isenabled()
-            gc.disable()
-        self.start = self.timer()
-        return self
-    def __exit__(self, *args):
-        self.end = self.timer()
-        if self.disable_gc and self.gc_state:
-            gc.enable()
-        self.interval = self.end - self.start
-        if self.verbose:
-            print('time taken: %f seconds' % self.interval)
-
-def down_data():
-    import urllib, json
-    if not os.path.isdir('/code/neurovault/apps/statmaps/tests/bench'):
-        os.makedirs('/code/neurovault/apps/statmaps/tests/bench')
-        os.makedirs('/code/neurovault/apps/statmaps/tests/bench/images')
-    if len(os.listdir('/code/neurovault/apps/statmaps/tests/bench/images')) == 0:
-        (path, _) = urllib.urlretrieve("https://ndownloader.figshare.com/files/5360999")
-        archive = tarfile.open(path)
-        archive.extractall('/code/neurovault/apps/statmaps/tests/bench')
-        archive.close()
-        os.remove(path)
+
+def load_dataset(path):
+    """(path, map_type) of the maps of a generated dataset, or of all nifti files in a directory."""
+    if os.path.exists(os.path.join(path, MANIFEST_FILENAME)):
+        return [(os.path.join(path, entry['path']), entry['map_type'])
+                for entry in load_manifest(path)['maps']]
+    return [(fname, 'T') for fname in sorted(glob.glob(os.path.join(path, '*.nii*')))]
+
+
+def statmap_form(path, collection, map_type):
+    post_dict = {'name': os.path.basename(path),
+                 'cognitive_paradigm_cogatlas': 'trm_4f24126c22011',
+                 'modality': 'fMRI-BOLD',
+                 'map_type': map_type,
+                 'collection': collection.pk,
+                 'ignore_file_warning': True}
+    with open(path, 'rb') as f:
+        file_dict = {'file': SimpleUploadedFile(os.path.basename(path), f.read())}
+    return StatisticMapForm(post_dict, file_dict)
+
+
+def get(client, url):
+    response = client.get(url)
+    if response.status_code != 200:
+        raise ValueError("%s returned %d" % (url, response.status_code))
+    # consume streamed responses (collection download) completely
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
 
 
 class Command(BaseCommand):
-    args = '<times_to_run>'
-    help = 'bench'
+    help = 'runs the benchmark suite against a fresh database, see --help for the options'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dataset', default=None,
+                            help='directory of maps (e.g. written by generate_synthetic_maps), '
+                                 'default: --count synthetic maps in a temporary directory')
+        parser.add_argument('--count', type=int, default=100, help='number of synthetic maps')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--queries', type=int, default=50, help='calls of every query case')
+        parser.add_argument('--cases', default=','.join(CASES),
+                            help='comma separated subset of %s' % ','.join(CASES))
+        parser.add_argument('--output', default=None, help='file the results are written to as JSON')
+        parser.add_argument('--baseline', default=None, help='results of an earlier run to compare to')
+        parser.add_argument('--tolerance', type=float, default=0.2,
+                            help='allowed increase of the p95 latency over the baseline')
 
     def handle(self, *args, **options):
-        down_data()
+        cases = options['cases'].split(',')
+        unknown = set(cases) - set(CASES)
+        if unknown:
+            raise CommandError("Unknown cases: %s" % ', '.join(sorted(unknown)))
+
+        tmp_dir = None
+        if options['dataset'] is None:
+            tmp_dir = tempfile.mkdtemp()
+            write_synthetic_dataset(tmp_dir, options['count'], seed=options['seed'])
+            options['dataset'] = tmp_dir
+        try:
+            suite = self.run_suite(load_dataset(options['dataset']), cases, options)
+        finally:
+            if tmp_dir:
+                shutil.rmtree(tmp_dir)
+
+        metadata = {'date': str(datetime.datetime.utcnow()), 'dataset': options['dataset'],
+                    'count': options['count'], 'seed': options['seed'], 'queries': options['queries']}
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(suite.to_json(metadata))
+
+        if options['baseline']:
+            regressions = compare_to_baseline(suite.results, load_baseline(options['baseline']),
+                                              tolerance=options['tolerance'])
+            for name, before, after in regressions:
+                print "REGRESSION %s: p95 %.2fms -> %.2fms" % (name, before, after)
+            if regressions:
+                raise CommandError("%d cases are slower than the baseline" % len(regressions))
+
+    def run_suite(self, dataset, cases, options):
+        # tasks run in this process, so that their cost is part of the measurements
+        current_app.conf.CELERY_ALWAYS_EAGER = True
 
         clearDB()
         User.objects.all().delete()
-        app_path = '/code/neurovault/apps/statmaps/tests/bench'
-        u1 = User.objects.create(username='neurovault3')
-
-        num_files = len(os.listdir(os.path.join(app_path, 'images/')))
-        index_table = np.zeros(num_files)
-        query_table = np.zeros(num_files)
-
-        for i, file in enumerate(os.listdir(os.path.join(app_path, 'images/'))):
-            #print 'Adding subject ' + file
-            randomCollection = Collection(name='random' + file, owner=u1, DOI='10.3389/fninf.2015.00008' + str(i))
-            randomCollection.save()
-
-            t = Timer()
-            with t:
-                image = save_statmap_form(
-                    image_path=os.path.join(app_path, 'images/', file),
-                    collection=randomCollection,
-                    image_name=file,
-                    ignore_file_warning=True)
-            index_table[i] = t.interval
-            np.savetxt(os.path.join(app_path, 'results_index'+ str(datetime.datetime.utcnow())[:10] + '.csv'),
-                       index_table, delimiter=",")
-
-            t = Timer()
-            with t:
-                _dummy = get_similar_images(int(image.pk))
-            query_table[i] = t.interval
-            np.savetxt(os.path.join(app_path, 'results_query' + str(datetime.datetime.utcnow())[:10] + '.csv'),
-                       query_table, delimiter=",")
\ No newline at end of file
+        user = User.objects.create(username='neurovault3')
+        client = Client()
+        rng = np.random.RandomState(options['seed'])
+        suite = BenchmarkSuite()
+
+        # one public collection per map, as maps are not compared with maps of their own collection
+        uploads = []
+        for i, (path, map_type) in enumerate(dataset):
+            if path.endswith('_4d.nii.gz'):
+                continue
+            collection = Collection(name='benchmark %d' % i, owner=user, DOI='10.3389/fninf.2015.%05d' % i)
+            collection.save()
+            uploads.append((path, map_type, collection))
+        if not uploads:
+            raise CommandError("The dataset has no 3D maps")
+
+        if 'upload_validation' in cases:
+            suite.run('upload_validation',
+                      lambda item: statmap_form(item[0], uploads[0][2], item[1]).is_valid(), dataset)
+
+        images = []
+
+        def upload(item):
+            form = statmap_form(item[0], item[2], item[1])
+            if not form.is_valid():
+                raise ValueError(form.errors.as_text())
+            images.append(form.save())
+
+        if 'upload' in cases:
+            suite.run('upload', upload, uploads)
+        else:
+            # later cases need the maps in the database
+            for item in uploads:
+                upload(item)
+        searchable = [image for image in images if image.is_search_eligible]
+        if not searchable:
+            raise CommandError("No searchable map of the dataset could be uploaded")
+        # otherwise the similarity cases would time empty searches
+        if not any(get_images_to_compare_with(image.pk, for_generation=True) or
+                   count_existing_comparisons(image.pk) for image in searchable):
+            raise CommandError("No searchable map of the dataset has anything to be compared with")
+
+        def sample(n=options['queries']):
+            return [searchable[i] for i in rng.randint(0, len(searchable), n)]
+
+        if 'reduced_representation' in cases:
+            suite.run('reduced_representation',
+                      lambda image: make_reduced_representation(nb.load(image.file.path)),
+                      [images[i] for i in rng.randint(0, len(images), options['queries'])])
+        if 'similarity_fanout' in cases:
+            suite.run('similarity_fanout', lambda image: run_voxelwise_pearson_similarity.apply([image.pk]).get(),
+                      sample(min(options['queries'], 10)))
+        if 'find_similar_json' in cases:
+            suite.run('find_similar_json',
+                      lambda image: get(client, '/images/%d/find_similar/json/' % image.pk), sample())
+        if 'compare_images' in cases:
+            suite.run('compare_images',
+                      lambda pair: get(client, '/images/compare/%d/%d' % (pair[0].pk, pair[1].pk)),
+                      zip(sample(), sample()))
+        if 'gene_decoding' in cases:
+            suite.run('gene_decoding',
+                      lambda image: get(client, '/images/%d/gene_expression/json' % image.pk),
+                      sample(min(options['queries'], 5)))
+        if 'collection_download' in cases:
+            suite.run('collection_download',
+                      lambda c: get(client, '/collections/%d/download' % c.pk),
+                      [image.collection for image in images[:3]])
+        if 'api_list' in cases:
+            suite.run('api_list', lambda url: get(client, url),
+                      [API_LIST_ENDPOINTS[i % len(API_LIST_ENDPOINTS)] for i in range(options['queries'])])
+
+        if 'atlas_query_voxel' in cases or 'atlas_query_region' in cases:
+            self.run_atlas_cases(suite, client, user, rng, cases, options['queries'])
+        return suite
+
+    def run_atlas_cases(self, suite, client, user, rng, cases, n_queries):
+        data_path = os.path.join(os.path.abspath(statmaps.__path__[0]), 'tests', 'test_data')
+        nii_path, xml_path = [os.path.join(data_path, path) for path in ATLAS_DATA]
+        atlas_collection = Collection(name='benchmark atlases', owner=user)
+        atlas_collection.save()
+        with open(nii_path, 'rb') as nii_file, open(xml_path, 'rb') as xml_file:
+            form = AtlasForm({'name': 'benchmark atlas', 'map_type': 'Atlas', 'collection': atlas_collection.pk},
+                             {'file': SimpleUploadedFile(os.path.basename(nii_path), nii_file.read()),
+                              'label_description_file': SimpleUploadedFile(os.path.basename(xml_path),
+                                                                           xml_file.read())})
+        atlas = form.save()
+        query = {'atlas': atlas.name, 'collection': atlas_collection.name}
+
+        if 'atlas_query_voxel' in cases:
+            # MNI coordinates inside the bounding box of the brain
+            coordinates = zip(rng.randint(-70, 70, n_queries), rng.randint(-100, 70, n_queries),
+                              rng.randint(-50, 80, n_queries))
+            suite.run('atlas_query_voxel',
+                      lambda xyz: get(client, '/api/atlases/atlas_query_voxel/?' + urllib.urlencode(
+                          dict(query, x=xyz[0], y=xyz[1], z=xyz[2]))), coordinates)
+
+        if 'atlas_query_region' in cases:
+            regions = [label.text.lower() for label in ET.parse(xml_path).getroot().find('data').findall('label')]
+            suite.run('atlas_query_region',
+                      lambda region: get(client, '/api/atlases/atlas_query_region/?' + urllib.urlencode(
+                          dict(query, region=region))),
+                      [regions[i] for i in rng.randint(0, len(regions), n_queries)])
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from neurovault.apps.statmaps.ann_index import ANNIndex, get_index_path
+from neurovault.apps.statmaps.vector_store import get_store
+
+
+class Command(BaseCommand):
+    help = 'builds the approximate nearest neighbour index used by find_similar_json?mode=approximate'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--components', type=int, default=64,
+                            help='number of principal components of the embedding')
+        parser.add_argument('--clusters', type=int, default=None,
+                            help='number of partitions (default: square root of the number of images)')
+
+    def handle(self, *args, **options):
+        store = get_store()
+        index = ANNIndex.build(store, n_components=options['components'], n_clusters=options['clusters'])
+        index.save(get_index_path())
+        print "Indexed %d images in %d partitions" % (len(index.pks), len(index.centroids))
@@ -0,0 +1,49 @@
+import os
+import urllib2
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from neurovault.apps.statmaps.atlas_index import parse_atlas_labels
+from neurovault.apps.statmaps.models import Atlas
+from neurovault.apps.statmaps.synonyms import SynonymStore
+from neurovault.apps.statmaps.voxel_query_functions import getSynonyms
+
+
+class Command(BaseCommand):
+    help = 'downloads the NIF synonyms of the region names of all atlases into the store used by atlas_query_region'
+
+    def add_arguments(self, parser):
+        parser.add_argument('xml_files', nargs='*',
+                            help='label description files of atlases which are not in the database')
+        parser.add_argument('--output', default=settings.SYNONYM_STORE_PATH)
+        parser.add_argument('--refresh', action='store_true', default=False,
+                            help='download the synonyms of terms which are already in the store again')
+
+    def handle(self, *args, **options):
+        xml_strings = [open(path).read() for path in options['xml_files']]
+        for atlas in Atlas.objects.all():
+            atlas.label_description_file.open()
+            xml_strings.append(atlas.label_description_file.read())
+            atlas.label_description_file.close()
+        terms = sorted(set(name for xml_string in xml_strings for _, name in parse_atlas_labels(xml_string)))
+
+        store = SynonymStore()
+        if os.path.exists(options['output']):
+            store = SynonymStore.load(options['output'])
+        if not options['refresh']:
+            terms = [term for term in terms if term not in store.synonyms]
+
+        failed = 0
+        for i, term in enumerate(terms):
+            try:
+                store.synonyms[term] = getSynonyms(term)
+            except (urllib2.URLError, IOError, SyntaxError), e:
+                # ElementTree parse errors are SyntaxErrors, the term is retried by the next run
+                print "Could not get the synonyms of %s: %s" % (term, e)
+                failed += 1
+            if (i + 1) % 50 == 0:
+                store.save(options['output'])
+        store.save(options['output'])
+        print "Downloaded the synonyms of %d terms (%d failed), %d terms in %s" % (
+            len(terms) - failed, failed, len(store.synonyms), options['output'])
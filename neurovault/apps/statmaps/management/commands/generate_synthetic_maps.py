@@ -0,0 +1,43 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from neurovault.apps.statmaps.synthetic import DEFAULT_MIX, KINDS, write_synthetic_dataset
+
+
+def parse_mix(value):
+    """'Z=0.5,T=0.3,roi=0.2' -> {'Z': 0.5, 'T': 0.3, 'roi': 0.2}"""
+    mix = {}
+    for item in value.split(','):
+        kind, _, weight = item.partition('=')
+        if kind not in KINDS:
+            raise CommandError("Unknown kind of map %s, use one of %s" % (kind, ', '.join(sorted(KINDS))))
+        try:
+            mix[kind] = float(weight)
+        except ValueError:
+            raise CommandError("Invalid weight for %s: %s" % (kind, weight))
+    return mix
+
+
+class Command(BaseCommand):
+    help = 'writes a reproducible dataset of synthetic statistic maps for benchmarks and load tests'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_dir')
+        parser.add_argument('--count', type=int, default=1000, help='number of maps in the dataset')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--one-mm-fraction', type=float, default=0.1,
+                            help='fraction of maps on the 1mm instead of the 2mm MNI grid')
+        parser.add_argument('--mix', default=None,
+                            help='weights of the kinds of maps, e.g. Z=0.5,T=0.3,roi=0.2 (default: %s)'
+                                 % ','.join('%s=%s' % item for item in sorted(DEFAULT_MIX.items())))
+        parser.add_argument('--start', type=int, default=0,
+                            help='first map written, to split a large dataset between processes')
+        parser.add_argument('--stop', type=int, default=None, help='map after the last one written')
+
+    def handle(self, *args, **options):
+        mix = parse_mix(options['mix']) if options['mix'] else None
+        manifest = write_synthetic_dataset(options['output_dir'], options['count'], seed=options['seed'],
+                                           mix=mix, one_mm_fraction=options['one_mm_fraction'],
+                                           start=options['start'], stop=options['stop'])
+        stop = options['stop'] if options['stop'] is not None else options['count']
+        print "Wrote maps %d to %d of %d to %s" % (options['start'], min(stop, len(manifest)) - 1,
+                                                   len(manifest), options['output_dir'])
@@ -0,0 +1,45 @@
+import os
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from neurovault.apps.statmaps.models import Image, StatisticMap, NIDMResultStatisticMap
+from neurovault.apps.statmaps.tasks import save_resampled_transformation_batch
+from neurovault.apps.statmaps.vector_store import get_store
+
+# images transformed per worker call when backfilling
+BACKFILL_BATCH_SIZE = 100
+
+
+class Command(BaseCommand):
+    args = '<build|backfill|compact>'
+    help = 'builds the shared matrix of reduced representations from the .npy files, queues the ' \
+           'transformation of statistic maps missing from it (backfill) or compacts it'
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in ['build', 'backfill', 'compact']:
+            raise CommandError('Usage: manage.py reduced_representation_store %s' % self.args)
+
+        store = get_store()
+        if args[0] == 'build':
+            images = Image.objects.exclude(reduced_representation__isnull=True)\
+                .exclude(reduced_representation='').only('id', 'reduced_representation')
+            added = 0
+            for image in images.iterator():
+                if image.pk in store or not os.path.exists(image.reduced_representation.path):
+                    continue
+                store.append(image.pk, np.load(image.reduced_representation.path))
+                added += 1
+            print "Added %d reduced representations, the store now holds %d" % (added, len(store))
+        elif args[0] == 'backfill':
+            pks = Image.objects.instance_of(StatisticMap, NIDMResultStatisticMap)\
+                .order_by('pk').values_list('pk', flat=True)
+            missing = [pk for pk in pks if pk not in store]
+            for start in range(0, len(missing), BACKFILL_BATCH_SIZE):
+                save_resampled_transformation_batch.apply_async([missing[start:start + BACKFILL_BATCH_SIZE]],
+                                                              priority=settings.BULK_TASK_PRIORITY)
+            print "Queued %d images in %d batches" % (len(missing), len(range(0, len(missing), BACKFILL_BATCH_SIZE)))
+        else:
+            removed = store.compact()
+            print "Removed %d stale rows, the store now holds %d" % (removed, len(store))
@@ -13,5 +13,6 @@ class Command(BaseCommand):
             for image in col.basecollectionitem_set.instance_of(Image).all():
                 if image.pk:
                     print "Generating glassbrain and similarity for %s" %image.name
+                    # in this process, as run_uwsgi.sh expects; the comparison chunks are queued
                     generate_glassbrain_image.apply([image.pk])
-                    run_voxelwise_pearson_similarity.apply([image.pk])
\ No newline at end of file
+                    run_voxelwise_pearson_similarity.apply([image.pk])
@@ -1,7 +1,88 @@
+import cProfile
+import json
+import logging
+import os
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
 from django.http import HttpResponseRedirect
+from neurovault.apps.statmaps.instrumentation import install_cache_counters, install_query_counters, \
+    read_io_counters, start_request_stats, stop_request_stats
 from neurovault.apps.statmaps.utils import HttpRedirectException
 
+logger = logging.getLogger('neurovault.instrumentation')
+
+
 class CollectionRedirectMiddleware:
     def process_exception(self, request, exception):
         if isinstance(exception, HttpRedirectException):
             return HttpResponseRedirect(exception.args[0])
+
+
+class RequestInstrumentationMiddleware:
+    """Logs wall time, SQL queries, cache and MNI mask cache hits and bytes read of every request
+    as one JSON line.
+
+    Enabled with REQUEST_INSTRUMENTATION. A REQUEST_PROFILE_SAMPLE_RATE fraction of the
+    requests is run under cProfile, their stats are written to REQUEST_PROFILE_DIR.
+    """
+
+    def __init__(self):
+        if not settings.REQUEST_INSTRUMENTATION:
+            raise MiddlewareNotUsed
+        install_cache_counters()
+        install_query_counters()
+
+    def process_request(self, request):
+        request._instrumentation = {'start': time.time(), 'io': read_io_counters(),
+                                    'stats': start_request_stats(), 'view': None, 'profile': None}
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        state = getattr(request, '_instrumentation', None)
+        if state is None:
+            return
+        view = getattr(view_func, '__name__', type(view_func).__name__)
+        state['view'] = "%s.%s" % (view_func.__module__, view)
+        if random.random() < settings.REQUEST_PROFILE_SAMPLE_RATE:
+            state['profile'] = cProfile.Profile()
+            state['profile'].enable()
+
+    def process_response(self, request, response):
+        state = getattr(request, '_instrumentation', None)
+        if state is None:
+            return response
+        del request._instrumentation
+
+        wall_time = time.time() - state['start']
+        if state['profile'] is not None:
+            state['profile'].disable()
+        stats = stop_request_stats()
+        io = read_io_counters()
+
+        record = {'method': request.method,
+                  'path': request.path,
+                  'view': state['view'],
+                  'status': response.status_code,
+                  'wall_time_ms': round(wall_time * 1000, 2),
+                  'db_queries': stats.db_queries,
+                  'db_time_ms': round(stats.db_time * 1000, 2),
+                  'cache_hits': stats.cache_hits,
+                  'cache_misses': stats.cache_misses,
+                  'mni_mask_cache_hits': stats.mni_mask_hits,
+                  'mni_mask_cache_misses': stats.mni_mask_misses}
+        if io is not None and state['io'] is not None:
+            record['bytes_read'] = io[0] - state['io'][0]
+            record['disk_bytes_read'] = io[1] - state['io'][1]
+        if state['profile'] is not None:
+            record['profile'] = self.save_profile(state['profile'], state['view'])
+        logger.info(json.dumps(record, sort_keys=True))
+        return response
+
+    def save_profile(self, profile, view):
+        if not os.path.isdir(settings.REQUEST_PROFILE_DIR):
+            os.makedirs(settings.REQUEST_PROFILE_DIR)
+        path = os.path.join(settings.REQUEST_PROFILE_DIR, "%s-%d-%d.prof" % (view, time.time() * 1000, os.getpid()))
+        profile.dump_stats(path)
+        return path
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Q
+
+
+def populate_search_eligibility(apps, schema_editor):
+    Image = apps.get_model("statmaps", "Image")
+    for model_name in ["StatisticMap", "NIDMResultStatisticMap"]:
+        cls = apps.get_model("statmaps", model_name)
+        eligible = cls.objects.filter(collection__private=False, collection__DOI__isnull=False,
+                                      is_thresholded=False)
+        eligible = eligible.filter(~Q(analysis_level='S') & ~Q(map_type__in=['R', 'Pa']))
+        Image.objects.filter(pk__in=eligible.values('pk')).update(is_search_eligible=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statmaps', '0073_auto_20161111_0033'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='is_search_eligible',
+            field=models.BooleanField(default=False, help_text=b'Can other maps be compared with this one (maintained on save)', db_index=True, editable=False),
+        ),
+        migrations.RunPython(populate_search_eligibility, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statmaps', '0074_image_is_search_eligible'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='nidmresultstatisticmap',
+            name='data_hash',
+            field=models.CharField(help_text=b'SHA1 of the voxel data and affine, unchanged data skips the comparisons update', max_length=40, null=True, editable=False, blank=True),
+        ),
+        migrations.AddField(
+            model_name='statisticmap',
+            name='data_hash',
+            field=models.CharField(help_text=b'SHA1 of the voxel data and affine, unchanged data skips the comparisons update', max_length=40, null=True, editable=False, blank=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def populate_file_size(apps, schema_editor):
+    Image = apps.get_model("statmaps", "Image")
+    for image in Image.objects.exclude(file='').only('pk', 'file').iterator():
+        try:
+            size = image.file.size
+        except (IOError, OSError):
+            continue
+        Image.objects.filter(pk=image.pk).update(file_size=size)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('statmaps', '0075_basestatisticmap_data_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='image',
+            name='file_size',
+            field=models.BigIntegerField(help_text=b'Size of the file in bytes (maintained on save)', null=True, editable=False, blank=True),
+        ),
+        migrations.RunPython(populate_file_size, migrations.RunPython.noop),
+    ]
@@ -5,6 +5,7 @@ from datetime import datetime
 from gzip import GzipFile
 
 import nibabel as nb
+from django.conf import settings
 from django.contrib.auth.models import User
 from django.core.files import File
 from django.core.urlresolvers import reverse
@@ -12,7 +13,7 @@ from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import models
 from django.db.models import Q
 from django.db.models.fields.files import FieldFile
-from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
 from django.dispatch.dispatcher import receiver
 from django_hstore import hstore
 from guardian.shortcuts import assign_perm, get_users_with_perms, remove_perm
@@ -22,7 +23,12 @@ from taggit.models import GenericTaggedItemBase, TagBase
 
 from neurovault.apps.statmaps.storage import DoubleExtensionStorage, NIDMStorage,\
     OverwriteStorage
-from neurovault.apps.statmaps.tasks import run_voxelwise_pearson_similarity, generate_glassbrain_image
+from neurovault.apps.statmaps.similarity_cache import invalidate_all_similar_images, invalidate_comparison_partners, \
+    invalidate_similar_images
+from neurovault.apps.statmaps.task_coalescing import enqueue_once
+from neurovault.apps.statmaps.tasks import run_voxelwise_pearson_similarity, generate_glassbrain_image, \
+    update_voxelwise_pearson_similarity
+from neurovault.apps.statmaps.vector_store import get_store
 from neurovault.settings import PRIVATE_MEDIA_ROOT
 
 
@@ -158,11 +164,14 @@ class Collection(models.Model):
 
         super(Collection, self).save(*args, **kwargs)
 
+        if privacy_changed or DOI_changed:
+            update_search_eligibility(collection=self)
+
         if (privacy_changed and not self.private) or (DOI_changed and self.DOI is not None):
             for image in self.basecollectionitem_set.instance_of(Image).all():
                 if image.pk:
-                    generate_glassbrain_image.apply_async([image.pk])
-                    run_voxelwise_pearson_similarity.apply_async([image.pk])
+                    enqueue_once(generate_glassbrain_image, image.pk)
+                    enqueue_once(run_voxelwise_pearson_similarity, image.pk)
 
     class Meta:
         app_label = 'statmaps'
@@ -259,6 +268,12 @@ def upload_img_to(instance, filename):
 upload_to = upload_img_to  # for migration backwards compat.
 
 
+def load_nii(field_file):
+    field_file.open()
+    gzfileobj = GzipFile(filename=field_file.name, mode='rb', fileobj=field_file.file)
+    return nb.Nifti1Image.from_file_map({'image': nb.FileHolder(field_file.name, gzfileobj)})
+
+
 class KeyValueTag(TagBase):
     value = models.CharField(max_length=200, blank=True)
 
@@ -325,6 +340,10 @@ class Image(BaseCollectionItem):
                                               null=True, blank=True, upload_to=upload_img_to,
                                               storage=OverwriteStorage())
     data = hstore.DictionaryField(blank=True, null=True)
+    is_search_eligible = models.BooleanField(default=False, db_index=True, editable=False,
+                                             help_text="Can other maps be compared with this one (maintained on save)")
+    file_size = models.BigIntegerField(null=True, blank=True, editable=False,
+                                       help_text="Size of the file in bytes (maintained on save)")
     hstore_objects = hstore.HStoreManager()
 
 
@@ -388,11 +407,16 @@ class Image(BaseCollectionItem):
 
         do_update = True if file_changed else False
         new_image = True if self.pk is None else False
+        if self.file and (file_changed or new_image or self.file_size is None):
+            try:
+                self.file_size = self.file.size
+            except (IOError, OSError):
+                self.file_size = None
         super(Image, self).save()
 
         if (do_update or new_image) and self.collection and self.collection.private == False:
             # Generate glass brain image
-            generate_glassbrain_image.apply_async([self.pk])
+            enqueue_once(generate_glassbrain_image, self.pk, priority=settings.INTERACTIVE_TASK_PRIORITY)
 
         if collection_changed:
             for field_name in self._meta.get_all_field_names():
@@ -463,56 +487,76 @@ class BaseStatisticMap(Image):
                     max_length=200, null=True, blank=True, choices=ANALYSIS_LEVEL_CHOICES)
     number_of_subjects = models.IntegerField(help_text="Number of subjects used to generate this map", null=True,
                                              verbose_name="No. of subjects", blank=True)
+    data_hash = models.CharField(max_length=40, null=True, blank=True, editable=False,
+                                 help_text="SHA1 of the voxel data and affine, unchanged data skips the comparisons update")
 
     def save(self):
-        if self.perc_bad_voxels == None and self.file:
-            import neurovault.apps.statmaps.utils as nvutils
-            self.file.open()
-            gzfileobj = GzipFile(filename=self.file.name, mode='rb', fileobj=self.file.file)
-            nii = nb.Nifti1Image.from_file_map({'image': nb.FileHolder(self.file.name, gzfileobj)})
-            self.is_thresholded, ratio_bad = nvutils.is_thresholded(nii)
-            self.perc_bad_voxels = ratio_bad*100.0
-
-        if self.brain_coverage == None and self.file:
-            import neurovault.apps.statmaps.utils as nvutils
-            self.file.open()
-            gzfileobj = GzipFile(filename=self.file.name, mode='rb', fileobj=self.file.file)
-            nii = nb.Nifti1Image.from_file_map({'image': nb.FileHolder(self.file.name, gzfileobj)})
-            self.not_mni, self.brain_coverage, self.perc_voxels_outside = nvutils.not_in_mni(nii)
-
-        if self.map_type == self.OTHER:
-            import neurovault.apps.statmaps.utils as nvutils
-            self.file.open()
-            gzfileobj = GzipFile(filename=self.file.name, mode='rb', fileobj=self.file.file)
-            nii = nb.Nifti1Image.from_file_map({'image': nb.FileHolder(self.file.name, gzfileobj)})
-            self.map_type = nvutils.infer_map_type(nii)
-
-        # Calculation of image reduced_representation and comparisons
+        import neurovault.apps.statmaps.utils as nvutils
         file_changed = False
+        existing = None
         if self.pk is not None:
             existing = Image.objects.get(pk=self.pk)
             if existing.file != self.file:
                 file_changed = True
-        do_update = True if file_changed else False
+
+        # A hash which differs from the stored one was computed for the new file by the caller (the
+        # upload form), which also ran the QA checks. Otherwise the file has not been looked at yet.
+        file_unchecked = self.data_hash is None or file_changed and self.data_hash == existing.data_hash
+        checks = []
+        if self.perc_bad_voxels == None:
+            checks.append('thresholded')
+        if self.brain_coverage == None:
+            checks.append('mni')
+        if self.map_type == self.OTHER and file_unchecked:
+            checks.append('map_type')
+        if file_unchecked:
+            checks.append('data_hash')
+        if self.file and checks:
+            # all missing metrics from a single load of the file
+            qa_metrics = nvutils.compute_qa_metrics(load_nii(self.file), checks)
+            for field, value in qa_metrics.items():
+                setattr(self, field, value)
+        self.is_search_eligible = self.get_search_eligibility()
+
+        # a new file with the same voxel data (e.g. uploaded again with a metadata edit) changes nothing
+        data_changed = False
+        if file_changed:
+            old_hash = getattr(existing, 'data_hash', None)
+            if old_hash is None and existing.file and os.path.exists(existing.file.path):
+                old_hash = nvutils.get_data_hash(load_nii(existing.file))
+            data_changed = old_hash != self.data_hash
+
+        eligibility_changed = existing is not None and existing.is_search_eligible != self.is_search_eligible
+        if data_changed or eligibility_changed:
+            invalidate_comparison_partners(self.pk)
         new_image = True if self.pk is None else False
 
-        # If we have an update, delete old pkl and comparisons first before saving
-        if do_update and self.collection:
+        # If the data changed, drop the old reduced representation; comparisons are overwritten in place
+        if data_changed and self.collection:
+            get_store().remove(self.pk)
             if self.reduced_representation: # not applicable for private collections
                 self.reduced_representation.delete()
-
-                # If more than one metric is added to NeuroVault, this must also filter based on metric
-                comparisons = Comparison.objects.filter(Q(image1=self) | Q(image2=self))
-                if comparisons:
-                    comparisons.delete()
         super(BaseStatisticMap, self).save()
 
         # Calculate comparisons
-        if do_update or new_image:
-            run_voxelwise_pearson_similarity.apply_async([self.pk])
+        if new_image:
+            enqueue_once(run_voxelwise_pearson_similarity, self.pk, priority=settings.INTERACTIVE_TASK_PRIORITY)
+        elif data_changed or eligibility_changed:
+            enqueue_once(update_voxelwise_pearson_similarity, self.pk, priority=settings.INTERACTIVE_TASK_PRIORITY)
 
         self.file.close()
 
+    # public, unthresholded, group level maps of published collections
+    @classmethod
+    def search_eligible_q(cls):
+        return Q(collection__private=False, collection__DOI__isnull=False, is_thresholded=False) & \
+            ~Q(analysis_level='S') & ~Q(map_type__in=[cls.R, cls.Pa])
+
+    def get_search_eligibility(self):
+        return bool(self.collection and not self.collection.private and self.collection.DOI is not None and
+                    self.is_thresholded == False and self.is_thresholded is not None and
+                    self.analysis_level != 'S' and self.map_type not in [self.R, self.Pa])
+
     @classmethod
     def get_fixed_fields(cls):
         return super(BaseStatisticMap, cls).get_fixed_fields() + (
@@ -572,6 +616,19 @@ class StatisticMap(BaseStatisticMap):
 
 post_save.connect(basecollectionitem_created, sender=StatisticMap, weak=True)
 
+
+# comparisons of deleted maps are removed with them, cached results of their partners are stale
+def basestatisticmap_deleting(sender, instance, **kwargs):
+    invalidate_comparison_partners(instance.pk)
+
+pre_delete.connect(basestatisticmap_deleting, sender=StatisticMap, weak=True)
+
+# drop deleted maps from the shared matrix of reduced representations
+def basestatisticmap_deleted(sender, instance, **kwargs):
+    get_store().remove(instance.pk)
+
+post_delete.connect(basestatisticmap_deleted, sender=StatisticMap, weak=True)
+
 class NIDMResults(BaseCollectionItem):
     ttl_file = models.FileField(upload_to=upload_nidm_to,
                     storage=NIDMStorage(),
@@ -610,6 +667,17 @@ class NIDMResultStatisticMap(BaseStatisticMap):
     nidm_results = models.ForeignKey(NIDMResults)
 
 post_save.connect(basecollectionitem_created, sender=NIDMResultStatisticMap, weak=True)
+pre_delete.connect(basestatisticmap_deleting, sender=NIDMResultStatisticMap, weak=True)
+post_delete.connect(basestatisticmap_deleted, sender=NIDMResultStatisticMap, weak=True)
+
+def update_search_eligibility(**filters):
+    """Recomputes Image.is_search_eligible of the images matching filters, e.g. collection=collection."""
+    Image.objects.filter(**filters).update(is_search_eligible=False)
+    for cls in [StatisticMap, NIDMResultStatisticMap]:
+        eligible = cls.objects.filter(**filters).filter(cls.search_eligible_q())
+        Image.objects.filter(pk__in=eligible.values('pk')).update(is_search_eligible=True)
+    invalidate_all_similar_images()
+
 
 class Atlas(Image):
     label_description_file = models.FileField(
@@ -655,3 +723,9 @@ class Comparison(models.Model):
 
         verbose_name = "pairwise image comparison"
         verbose_name_plural = "pairwise image comparisons"
+
+
+# bulk writes (similarity.save_similarity_scores) invalidate explicitly
+@receiver(post_save, sender=Comparison)
+def comparison_saved(sender, instance, **kwargs):
+    invalidate_similar_images([instance.image1_id, instance.image2_id])
@@ -0,0 +1,84 @@
+import cPickle as pickle
+import os
+import threading
+from collections import OrderedDict
+
+NIF_GRAPH_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'NIFgraph.pkl')
+
+MAX_MEMOIZED_ATLASES = 32
+
+
+class OntologyGraph(object):
+    """NIF anatomy graph with a name -> node index and memoized region matches.
+
+    Matches of a node are the atlas regions a synonym index maps its name to, or else the
+    matches of its children (or parents), as toAtlas has always searched them. They only
+    depend on the node and the synonym index, so they are kept per index.
+    """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.node_ids = {}
+        for node, data in graph.nodes_iter(data=True):
+            self.node_ids.setdefault(data['name'], node)
+        self._memos = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _memo(self, synonym_index, direction):
+        # the index is kept with its memo, so its id is not reused while the memo exists
+        key = (id(synonym_index), direction)
+        with self._lock:
+            entry = self._memos.pop(key, None)
+            if entry is None or entry[0] is not synonym_index:
+                entry = (synonym_index, {})
+            self._memos[key] = entry
+            while len(self._memos) > MAX_MEMOIZED_ATLASES * 2:
+                self._memos.popitem(last=False)
+        return entry[1]
+
+    def matches(self, node, synonym_index, direction='children'):
+        """Atlas regions matching node or its closest descendants ('children') or ancestors ('parents')."""
+        memo = self._memo(synonym_index, direction)
+        return list(self._matches(node, synonym_index, direction, memo, set())[0])
+
+    def _matches(self, node, synonym_index, direction, memo, visiting):
+        """(matches, cut), cut holds the nodes further up whose matches a cycle left out below node."""
+        if node in memo:
+            return memo[node], set()
+        if node in visiting:
+            # cycle, the matches of node are still being collected further up
+            return [], set([node])
+        visiting.add(node)
+        matches = synonym_index.get(self.graph.node[node]['name'], [])
+        cut = set()
+        if not matches:
+            if direction == 'parents':
+                relatives = self.graph.predecessors_iter(node)
+            else:
+                relatives = self.graph.successors_iter(node)
+            matches = []
+            for relative in relatives:
+                relative_matches, relative_cut = self._matches(relative, synonym_index, direction, memo, visiting)
+                matches += relative_matches
+                cut |= relative_cut
+        visiting.discard(node)
+        # node collects its own matches, results cut above it depend on where the search started
+        cut.discard(node)
+        if not cut:
+            memo[node] = matches
+        return matches, cut
+
+
+_graph = None
+_graph_lock = threading.Lock()
+
+
+def get_ontology_graph():
+    """OntologyGraph of NIFgraph.pkl, loaded once per process."""
+    global _graph
+    if _graph is None:
+        with _graph_lock:
+            if _graph is None:
+                with open(NIF_GRAPH_PATH, 'rb') as f:
+                    _graph = OntologyGraph(pickle.load(f))
+    return _graph
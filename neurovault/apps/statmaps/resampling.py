@@ -0,0 +1,97 @@
+import threading
+
+import numpy as np
+from scipy import ndimage
+from pybraincompare.mr.datasets import get_standard_mask
+from pybraincompare.mr.transformation import make_resampled_transformation_vector
+
+try:
+    # used by nilearn's resample_img to fill in non finite values before the spline fit
+    from nilearn.masking import _extrapolate_out_mask
+except ImportError:
+    _extrapolate_out_mask = None
+
+
+def _mni_affine(voxel_size):
+    return np.array([[-voxel_size, 0, 0, 90],
+                     [0, voxel_size, 0, -126],
+                     [0, 0, voxel_size, -72],
+                     [0, 0, 0, 1]], dtype=np.float64)
+
+
+# (affine, shape) of the MNI152 grids most public maps are uploaded on
+STANDARD_GRIDS = [(_mni_affine(1), (182, 218, 182)),
+                  (_mni_affine(2), (91, 109, 91))]
+
+
+def get_standard_grid(affine, shape):
+    """Index of the standard grid an image is on, None for any other grid."""
+    if len(shape) != 3:
+        return None
+    for i, (grid_affine, grid_shape) in enumerate(STANDARD_GRIDS):
+        if tuple(shape) == grid_shape and np.allclose(affine, grid_affine, atol=1e-4):
+            return i
+    return None
+
+
+class ResamplingOperator(object):
+    """Resampling of images on one source grid to the voxels of the standard brain mask.
+
+    The same transformation as pybraincompare's make_resampled_transformation_vector
+    (cubic spline resampling with nilearn, zeros treated as missing), but the source
+    coordinates of the masked voxels are computed once and the spline is only evaluated
+    at those voxels instead of the whole target grid.
+    """
+
+    def __init__(self, source_affine, resample_dim=4):
+        standard = get_standard_mask(voxdim=resample_dim)
+        mask = standard.get_data() != 0
+        self.output_size = mask.size
+        self.mask_indices = np.flatnonzero(mask)
+        voxels = np.array(np.nonzero(mask), dtype=np.float64)
+        transform = np.dot(np.linalg.inv(source_affine), standard.get_affine())
+        self.coordinates = np.dot(transform[:3, :3], voxels) + transform[:3, 3:]
+
+    def transform(self, data):
+        data = np.array(data, dtype=np.float64)
+        data[data == 0] = np.nan
+        not_finite = np.logical_not(np.isfinite(data))
+        has_not_finite = not_finite.any()
+        if has_not_finite:
+            data = _extrapolate_out_mask(data, np.logical_not(not_finite), iterations=2)[0]
+
+        values = ndimage.map_coordinates(data, self.coordinates, order=3)
+        if has_not_finite:
+            missing = ndimage.map_coordinates(not_finite.astype(np.uint8), self.coordinates, order=0)
+            values[missing.astype(bool)] = np.nan
+
+        vector = np.zeros(self.output_size)
+        vector[self.mask_indices] = values
+        return vector
+
+
+_operators = {}
+_operators_lock = threading.Lock()
+
+
+def get_resampling_operator(affine, shape, resample_dim=4):
+    """Cached operator for images on a standard grid, None if the generic path has to be used."""
+    grid = get_standard_grid(affine, shape)
+    if grid is None or _extrapolate_out_mask is None:
+        return None
+    key = (grid, resample_dim)
+    with _operators_lock:
+        if key not in _operators:
+            _operators[key] = ResamplingOperator(STANDARD_GRIDS[grid][0], resample_dim)
+        return _operators[key]
+
+
+def make_reduced_representation(nii_obj, resample_dim=[4, 4, 4]):
+    """Brain masked image vector at resample_dim resolution, see make_resampled_transformation_vector."""
+    operator = None
+    if len(set(resample_dim)) == 1:
+        operator = get_resampling_operator(nii_obj.get_affine(), nii_obj.shape, resample_dim[0])
+    if operator is None:
+        return make_resampled_transformation_vector(nii_obj, resample_dim)
+    return operator.transform(nii_obj.get_data())
+
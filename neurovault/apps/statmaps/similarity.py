@@ -0,0 +1,253 @@
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import connection, transaction
+from django.db.models import Q
+
+from neurovault.apps.statmaps.models import Image, Similarity, Comparison
+from neurovault.apps.statmaps.similarity_cache import invalidate_similar_images
+from neurovault.apps.statmaps.vector_store import get_store, get_reduced_representation
+
+
+PEARSON_METRIC = "pearson product-moment correlation coefficient"
+PEARSON_TRANSFORMATION = "voxelwise"
+
+# number of rows scored at once; bounds the float64 working copy
+BLOCK_SIZE = 1024
+
+
+def get_pearson_metric():
+    return Similarity.objects.get(similarity_metric=PEARSON_METRIC,
+                                  transformation=PEARSON_TRANSFORMATION)
+
+
+def pearson_against_matrix(query, matrix, rows=None, block_size=BLOCK_SIZE):
+    """Pearson correlation of one reduced representation against every row of a matrix.
+
+    Voxels are only used when they are non zero and not nan in both vectors, which
+    matches make_binary_deletion_vector + pearsonr for every pair. Instead of masking
+    pair by pair the sufficient statistics (n, sums, sums of squares and products) are
+    gathered with matrix-vector products, so the whole matrix is scored in one pass.
+    Rows with less than two shared voxels or no variance get nan. If rows is given only
+    those rows of the matrix are scored, so a memory mapped store is never copied as a whole.
+    """
+    query = np.asarray(query, dtype=np.float64).ravel()
+    n_rows = matrix.shape[0] if rows is None else len(rows)
+    if matrix.ndim != 2 or matrix.shape[1] != query.shape[0]:
+        raise ValueError("Query vector of length %d does not match matrix of shape %s"
+                         % (query.shape[0], str(matrix.shape)))
+
+    query_valid = np.logical_and(query != 0, np.logical_not(np.isnan(query)))
+    x = np.where(query_valid, query, 0.0)
+    x_valid = query_valid.astype(np.float64)
+    x_squared = x * x
+
+    scores = np.empty(n_rows, dtype=np.float64)
+    for start in range(0, n_rows, block_size):
+        if rows is None:
+            block = np.array(matrix[start:start + block_size], dtype=np.float64)
+        else:
+            block = np.array(matrix[rows[start:start + block_size]], dtype=np.float64)
+        block[np.isnan(block)] = 0.0
+        block_valid = (block != 0).astype(np.float64)
+
+        n = np.dot(block_valid, x_valid)
+        sum_x = np.dot(block_valid, x)
+        sum_xx = np.dot(block_valid, x_squared)
+        sum_y = np.dot(block, x_valid)
+        sum_xy = np.dot(block, x)
+        block *= block
+        sum_yy = np.dot(block, x_valid)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            cov = sum_xy - sum_x * sum_y / n
+            var_x = sum_xx - sum_x * sum_x / n
+            var_y = sum_yy - sum_y * sum_y / n
+            denominator = np.sqrt(var_x * var_y)
+            r = cov / denominator
+        r[np.logical_or(n < 2, np.logical_not(denominator > 0))] = np.nan
+        scores[start:start + block_size] = np.clip(r, -1.0, 1.0)
+
+    return scores
+
+
+def stack_reduced_representations(pks):
+    """Locate the reduced representations of the given images in the shared store.
+
+    Images missing from the store are added first. Returns the store matrix, the rows to
+    use and the pks matching those rows (images deleted in the meantime are skipped).
+    """
+    store = get_store()
+    _, found = store.rows_for(pks)
+    missing = set(pks) - set(found)
+    if missing:
+        for image in Image.objects.filter(pk__in=missing).only('id', 'reduced_representation'):
+            get_reduced_representation(image)
+    rows, row_pks = store.rows_for(pks)
+    return store.matrix, rows, row_pks
+
+
+def save_similarity_scores(pk, pks, scores, pearson_metric=None):
+    """Upsert the comparisons of image pk with the given candidates in one statement.
+
+    Comparisons are always stored with image1 being the lower pk. Pairs with a nan score
+    can not be compared, existing comparisons for them are removed.
+    """
+    if pearson_metric is None:
+        pearson_metric = get_pearson_metric()
+
+    rows = []
+    nan_pks = []
+    for other_pk, score in zip(pks, scores):
+        if other_pk == pk:
+            continue
+        if np.isnan(score):
+            nan_pks.append(other_pk)
+            continue
+        image1_id, image2_id = sorted([pk, other_pk])
+        rows.append((image1_id, image2_id, pearson_metric.pk, float(score)))
+
+    with transaction.atomic():
+        if nan_pks:
+            Comparison.objects.filter(Q(image1_id=pk, image2_id__in=nan_pks) |
+                                      Q(image2_id=pk, image1_id__in=nan_pks)).delete()
+        if rows:
+            if connection.vendor == 'postgresql':
+                _upsert_comparisons(rows)
+            else:
+                Comparison.objects.filter(Q(image1_id=pk, image2_id__in=pks) |
+                                          Q(image2_id=pk, image1_id__in=pks)).delete()
+                Comparison.objects.bulk_create([Comparison(image1_id=image1_id, image2_id=image2_id,
+                                                           similarity_metric_id=metric_id,
+                                                           similarity_score=score)
+                                                for image1_id, image2_id, metric_id, score in rows])
+    invalidate_similar_images([pk] + list(pks))
+    return len(rows)
+
+
+def delete_comparisons_except(pk, pks):
+    """Remove the comparisons of image pk with images which are not in pks, e.g. no longer candidates."""
+    pks = set(pks)
+    stale = Comparison.objects.filter(Q(image1_id=pk) & ~Q(image2_id__in=pks) |
+                                      Q(image2_id=pk) & ~Q(image1_id__in=pks))
+    partners = [image1_id if image2_id == pk else image2_id
+                for image1_id, image2_id in stale.values_list('image1_id', 'image2_id')]
+    if partners:
+        stale.delete()
+        invalidate_similar_images([pk] + partners)
+    return len(partners)
+
+
+def _upsert_comparisons(rows):
+    # INSERT ... ON CONFLICT needs postgres >= 9.5, relies on unique_together = ("image1","image2")
+    sql = "INSERT INTO %s (image1_id, image2_id, similarity_metric_id, similarity_score) VALUES %s " \
+          "ON CONFLICT (image1_id, image2_id) DO UPDATE SET " \
+          "similarity_metric_id = EXCLUDED.similarity_metric_id, " \
+          "similarity_score = EXCLUDED.similarity_score" \
+          % (Comparison._meta.db_table, ", ".join(["(%s, %s, %s, %s)"] * len(rows)))
+    params = [value for row in rows for value in row]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+
+
+def _rows_outside_top_k(pks, k):
+    # comparisons of the given images which are ranked below k for all of the given images they belong to
+    sql = "SELECT c.id, c.image1_id, c.image2_id FROM {table} c JOIN (" \
+          "  SELECT id FROM (" \
+          "    SELECT id, row_number() OVER (PARTITION BY image_id ORDER BY score DESC, id) AS rank FROM (" \
+          "      SELECT id, image1_id AS image_id, abs(similarity_score) AS score FROM {table} WHERE image1_id = ANY(%s)" \
+          "      UNION ALL" \
+          "      SELECT id, image2_id AS image_id, abs(similarity_score) AS score FROM {table} WHERE image2_id = ANY(%s)" \
+          "    ) sides" \
+          "  ) ranked GROUP BY id HAVING min(rank) > %s" \
+          ") outside ON c.id = outside.id".format(table=Comparison._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [list(pks), list(pks), k])
+        return dict((row[0], (row[1], row[2])) for row in cursor.fetchall())
+
+
+def prune_to_top_k(pks, k=None):
+    """Keep only comparisons which are among the k best (by absolute score) of one of their images.
+
+    Only the neighbour lists of the given images (the ones which just got new comparisons)
+    are looked at. A comparison is removed if it is outside the top k of both its images.
+    """
+    if k is None:
+        k = settings.SIMILARITY_TOP_K
+    if connection.vendor != 'postgresql':
+        raise ImproperlyConfigured("Top-k similarity storage requires PostgreSQL")
+
+    pks = set(pks)
+    outside = _rows_outside_top_k(pks, k)
+    others = set(pk for pair in outside.values() for pk in pair) - pks
+    if others:
+        # the other image of the pair might still have it among its own best k
+        outside_others = _rows_outside_top_k(others, k)
+        outside = dict((comparison_id, pair) for comparison_id, pair in outside.items()
+                       if pks.issuperset(pair) or comparison_id in outside_others)
+
+    ids = list(outside.keys())
+    for start in range(0, len(ids), 1000):
+        Comparison.objects.filter(id__in=ids[start:start + 1000]).delete()
+    invalidate_similar_images(pk for pair in outside.values() for pk in pair)
+    return len(ids)
+
+
+def get_pair_similarity(image1, image2):
+    """Similarity of two images, from the Comparison table or computed from their reduced representations.
+
+    With top-k storage most pairs are not stored, those are calculated on demand.
+    """
+    image1_id, image2_id = sorted([image1.pk, image2.pk])
+    scores = Comparison.objects.filter(image1_id=image1_id, image2_id=image2_id)\
+        .values_list('similarity_score', flat=True)
+    if scores:
+        return scores[0]
+    vector2 = np.asarray(get_reduced_representation(image2))
+    return pearson_against_matrix(get_reduced_representation(image1), vector2.reshape(1, -1))[0]
+
+
+def search_vector(query, candidate_pks, max_results=100, time_budget=None, block_size=BLOCK_SIZE):
+    """Best matches of a vector which is not stored in NeuroVault, by absolute masked Pearson score.
+
+    Only candidates already in the reduced representation store are scanned, block by block
+    until time_budget (in seconds) runs out (the first block is always scanned). Returns the pks and scores ordered by decreasing
+    absolute score, the number of candidates which were scanned and the number of candidates, which
+    is larger if some are missing from the store or were not scanned in time.
+    """
+    start = time.time()
+    candidate_pks = list(candidate_pks)
+    store = get_store()
+    rows, row_pks = store.rows_for(candidate_pks)
+    matrix = store.matrix
+
+    scores = np.empty(len(rows))
+    scores.fill(np.nan)
+    scanned = 0
+    while scanned < len(rows):
+        if scanned and time_budget is not None and time.time() - start > time_budget:
+            break
+        stop = min(scanned + block_size, len(rows))
+        scores[scanned:stop] = pearson_against_matrix(query, matrix, rows=rows[scanned:stop])
+        scanned = stop
+
+    order = [i for i in np.argsort(-np.abs(scores[:scanned])) if not np.isnan(scores[i])][:max_results]
+    return [row_pks[i] for i in order], [float(scores[i]) for i in order], scanned, len(candidate_pks)
+
+
+def run_similarity(pk, candidate_pks):
+    """Score image pk against all candidates with a single matrix pass and store the results."""
+    if pk in candidate_pks:
+        raise Exception("You are trying to compare an image with itself!")
+
+    query = np.array(get_reduced_representation(Image.objects.get(pk=pk)))
+    matrix, rows, row_pks = stack_reduced_representations(candidate_pks)
+    if not row_pks:
+        return 0
+    scores = pearson_against_matrix(query, matrix, rows=rows)
+    saved = save_similarity_scores(pk, row_pks, scores)
+    if settings.SIMILARITY_STORAGE == 'topk':
+        prune_to_top_k([pk] + row_pks)
+    return saved
@@ -0,0 +1,58 @@
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+# bumped when the set of searchable images changes, invalidates all cached results
+GLOBAL_VERSION_KEY = "similar_images:version"
+
+
+def _version_key(pk):
+    return "%s:%s" % (GLOBAL_VERSION_KEY, pk)
+
+
+def _new_version():
+    return uuid.uuid4().hex
+
+
+def get_similar_images_cache_key(pk, max_results):
+    """Cache key of the similar images of pk, changes whenever a comparison of pk is written."""
+    keys = [GLOBAL_VERSION_KEY, _version_key(pk)]
+    versions = cache.get_many(keys)
+    if len(versions) < len(keys):
+        for key in keys:
+            if key not in versions:
+                cache.add(key, _new_version(), None)
+        versions = cache.get_many(keys)
+    return "similar_images:%s:%s:%s:%s" % (pk, versions.get(GLOBAL_VERSION_KEY),
+                                          versions.get(_version_key(pk)), max_results)
+
+
+def get_cached_similar_images(pk, max_results, compute):
+    key = get_similar_images_cache_key(pk, max_results)
+    rows = cache.get(key)
+    if rows is None:
+        rows = compute(pk, max_results)
+        cache.set(key, rows, settings.SIMILAR_IMAGES_CACHE_TIMEOUT)
+    return rows
+
+
+def invalidate_similar_images(pks):
+    """Drop the cached results of the given images, call when their comparisons change."""
+    pks = set(pks)
+    if pks:
+        cache.set_many(dict((_version_key(pk), _new_version()) for pk in pks), None)
+
+
+def invalidate_all_similar_images():
+    cache.set(GLOBAL_VERSION_KEY, _new_version(), None)
+
+
+def invalidate_comparison_partners(pk):
+    """Drop the cached results of image pk and of every image it has been compared with."""
+    from neurovault.apps.statmaps.models import Comparison
+
+    pairs = Comparison.objects.filter(image1_id=pk).values_list('image2_id', flat=True)
+    partners = list(pairs) + list(Comparison.objects.filter(image2_id=pk).values_list('image1_id', flat=True))
+    invalidate_similar_images([pk] + partners)
@@ -18,7 +18,7 @@ class NeuroVaultStorage(FileSystemStorage):
             base_url = settings.PRIVATE_MEDIA_URL
         super(NeuroVaultStorage, self).__init__(location, base_url)
 
-    def url(self, name):
+    def _split_name(self, name):
         collection_id = None
         spath, file_name = os.path.split(name)
         urlsects = [v for v in spath.split('/') if v]
@@ -27,9 +27,14 @@ class NeuroVaultStorage(FileSystemStorage):
             if sect.isdigit():
                 collection_id = sect
                 break
-        cont_path = '/'.join(urlsects)
-        coll_model = apps.get_model('statmaps', 'Collection')
-        collection = coll_model.objects.get(id=collection_id)
+        return collection_id, '/'.join(urlsects), file_name
+
+    def url(self, name, collection=None):
+        """URL of a file, pass its collection if it is already loaded to save looking it up."""
+        collection_id, cont_path, file_name = self._split_name(name)
+        if collection is None or str(collection.id) != collection_id:
+            coll_model = apps.get_model('statmaps', 'Collection')
+            collection = coll_model.objects.get(id=collection_id)
         if collection.private:
             cid = collection.private_token
         else:
@@ -37,6 +42,14 @@ class NeuroVaultStorage(FileSystemStorage):
         return os.path.join(self.base_url, str(cid), cont_path, file_name)
 
 
+def get_file_url(field_file):
+    """field_file.url without a collection query when the collection of its instance is loaded."""
+    instance = getattr(field_file, 'instance', None)
+    if isinstance(field_file.storage, NeuroVaultStorage) and getattr(instance, 'collection_id', None):
+        return field_file.storage.url(field_file.name, collection=instance.collection)
+    return field_file.url
+
+
 class DoubleExtensionStorage(NeuroVaultStorage):
     _extensions = ["nii.gz", "nidm.zip"]
 
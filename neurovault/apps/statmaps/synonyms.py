@@ -0,0 +1,69 @@
+import json
+import logging
+import os
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class SynonymStore(object):
+    """Synonyms of atlas region names, downloaded from NIF by the build_synonym_store command.
+
+    Region queries look synonyms up here instead of asking the NIF services for every region
+    of the atlas. Terms which are not in the store only have themselves as synonym.
+    """
+
+    def __init__(self, synonyms=None):
+        self.synonyms = synonyms or {}
+        self._indexes = {}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.synonyms, f, indent=0, sort_keys=True)
+        os.rename(tmp_path, path)
+
+    def get(self, term):
+        return self.synonyms.get(term, [term])
+
+    def index(self, terms):
+        """Inverted index of the synonyms of terms: synonym -> terms it is a synonym of, in order."""
+        key = tuple(terms)
+        if key not in self._indexes:
+            missing = [term for term in terms if term not in self.synonyms]
+            if missing:
+                # never downloaded on the request path, run build_synonym_store to add them
+                logger.warning("%d of %d terms are not in the synonym store, they only match themselves: %s",
+                               len(missing), len(terms), ', '.join(missing))
+            index = {}
+            for term in terms:
+                for synonym in set(self.get(term)):
+                    index.setdefault(synonym, []).append(term)
+            self._indexes[key] = index
+        return self._indexes[key]
+
+
+_store = None
+_store_mtime = None
+
+
+def get_synonym_store():
+    """Store shared by the process, reloaded when it is rebuilt. Empty if it has not been built."""
+    global _store, _store_mtime
+    try:
+        mtime = os.stat(settings.SYNONYM_STORE_PATH).st_mtime
+    except OSError:
+        mtime = None
+    if _store is None or mtime != _store_mtime:
+        if mtime is None:
+            logger.warning("%s does not exist, run the build_synonym_store command. Atlas regions only "
+                           "match their own names until then.", settings.SYNONYM_STORE_PATH)
+        _store = SynonymStore.load(settings.SYNONYM_STORE_PATH) if mtime is not None else SynonymStore()
+        _store_mtime = mtime
+    return _store
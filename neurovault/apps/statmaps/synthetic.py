@@ -0,0 +1,225 @@
+import json
+import os
+
+import nibabel as nb
+import numpy as np
+from scipy import ndimage, stats
+from scipy.spatial import cKDTree
+
+from neurovault.apps.statmaps.resampling import STANDARD_GRIDS
+
+# kinds of maps the generator writes, with the map_type they should be uploaded as
+KINDS = {'Z': 'Z',
+         'T': 'T',
+         'thresholded': 'Z',
+         'parcellation': 'Pa',
+         'roi': 'R',
+         '4d': 'Other'}
+
+DEFAULT_MIX = {'Z': 0.4, 'T': 0.3, 'thresholded': 0.1, 'parcellation': 0.08, 'roi': 0.08, '4d': 0.04}
+
+GRID_NAMES = {1: 0, 2: 1}  # voxel size in mm -> index in STANDARD_GRIDS
+
+# files per subdirectory, keeps directory listings manageable for 100k images
+FILES_PER_DIRECTORY = 1000
+
+MANIFEST_FILENAME = "manifest.json"
+
+_brain_masks = {}
+
+
+def get_brain_mask(voxel_size):
+    """MNI152 brain mask on the standard grid with the given voxel size (1 or 2mm)."""
+    if voxel_size not in _brain_masks:
+        this_path = os.path.abspath(os.path.dirname(__file__))
+        mask = nb.load(os.path.join(this_path, "static", "anatomical", "MNI152_T1_2mm_brain_mask.nii.gz"))
+        mask = mask.get_data() > 0
+        if voxel_size == 1:
+            # every 2mm voxel covers 2x2x2 voxels of the 1mm grid
+            for axis in range(3):
+                mask = np.repeat(mask, 2, axis=axis)
+        _brain_masks[voxel_size] = mask
+    return _brain_masks[voxel_size]
+
+
+def smooth_field(mask, rng, fwhm_voxels):
+    """Gaussian random field with unit variance inside the mask, zero outside."""
+    field = ndimage.gaussian_filter(rng.standard_normal(mask.shape), fwhm_voxels / np.sqrt(8 * np.log(2)))
+    field /= field[mask].std()
+    field[np.logical_not(mask)] = 0
+    return field
+
+
+def add_activations(field, mask, rng, voxel_size, n_blobs=None):
+    """Adds a few Gaussian shaped activations (peak |z| between 3 and 8) inside the mask."""
+    if n_blobs is None:
+        n_blobs = rng.randint(2, 12)
+    sigma = rng.uniform(4, 10) / voxel_size
+    peaks = np.zeros(mask.shape)
+    candidates = np.flatnonzero(mask)
+    centres = rng.choice(candidates, n_blobs, replace=False)
+    peaks.flat[centres] = rng.uniform(3, 8, n_blobs) * rng.choice([-1, 1], n_blobs)
+    # a unit impulse peaks at 1 / (2 pi sigma^2)^(3/2) after smoothing
+    blobs = ndimage.gaussian_filter(peaks, sigma) * (2 * np.pi * sigma ** 2) ** 1.5
+    field += blobs * mask
+    return field
+
+
+def z_map(mask, rng, voxel_size):
+    field = smooth_field(mask, rng, rng.uniform(6, 12) / voxel_size)
+    return add_activations(field, mask, rng, voxel_size)
+
+
+def t_map(mask, rng, voxel_size, dof=None):
+    if dof is None:
+        dof = rng.randint(10, 100)
+    z = z_map(mask, rng, voxel_size)
+    p = np.clip(stats.norm.cdf(z[mask]), 1e-15, 1 - 1e-15)
+    t = np.zeros(mask.shape)
+    t[mask] = stats.t.ppf(p, dof)
+    return t
+
+
+def thresholded_map(mask, rng, voxel_size):
+    z = z_map(mask, rng, voxel_size)
+    z[np.abs(z) < rng.choice([2.3, 3.1])] = 0
+    return z
+
+
+def parcellation(mask, rng, voxel_size, n_parcels=None):
+    """Voronoi parcellation of the mask around randomly placed seeds."""
+    if n_parcels is None:
+        n_parcels = rng.randint(50, 400)
+    voxels = np.transpose(np.nonzero(mask))
+    seeds = voxels[rng.choice(len(voxels), n_parcels, replace=False)]
+    _, labels = cKDTree(seeds).query(voxels)
+    data = np.zeros(mask.shape, dtype=np.int16)
+    data[mask] = labels + 1
+    return data
+
+
+def roi(mask, rng, voxel_size, n_spheres=None):
+    """Binary mask of a few spheres (radius 4 to 12mm) inside the brain."""
+    if n_spheres is None:
+        n_spheres = rng.randint(1, 4)
+    data = np.zeros(mask.shape, dtype=np.uint8)
+    for centre in rng.choice(np.flatnonzero(mask), n_spheres, replace=False):
+        centre = np.unravel_index(centre, mask.shape)
+        radius = rng.uniform(4, 12) / voxel_size
+        # only the bounding box of the sphere is looked at
+        box = tuple(slice(max(0, int(c - radius)), int(c + radius) + 1) for c in centre)
+        offsets = np.ogrid[box]
+        distance = sum((offsets[axis] - centre[axis]) ** 2 for axis in range(3))
+        data[box][np.logical_and(distance <= radius ** 2, mask[box])] = 1
+    return data
+
+
+def afni_extension(labels):
+    """nifti1 header extension (code 4) holding AFNI sub-brick labels, see get_afni_subbrick_labels."""
+    content = ('<AFNI_attributes>\n'
+               '<AFNI_atr ni_type="String" ni_dimen="1" atr_name="BRICK_LABS" >\n'
+               ' "%s"\n'
+               '</AFNI_atr>\n'
+               '</AFNI_attributes>\n') % '~'.join(labels)
+    return nb.nifti1.Nifti1Extension(4, content)
+
+
+def afni_4d(mask, rng, voxel_size):
+    """3dDeconvolve style output: coefficient and t statistic sub-bricks per condition."""
+    n_conditions = rng.randint(1, 4)
+    bricks = []
+    labels = []
+    for condition in range(n_conditions):
+        t = t_map(mask, rng, voxel_size)
+        bricks += [t * rng.uniform(0.1, 2), t]
+        labels += ['cond%d#0_Coef' % (condition + 1), 'cond%d#0_Tstat' % (condition + 1)]
+    # AFNI writes sub-bricks along the 5th dimension
+    return np.concatenate([brick[:, :, :, np.newaxis, np.newaxis] for brick in bricks], axis=4), labels
+
+
+def generate_synthetic_map(kind, rng, voxel_size=2):
+    """Synthetic nifti image of the given kind (see KINDS) on a standard MNI grid."""
+    mask = get_brain_mask(voxel_size)
+    affine = STANDARD_GRIDS[GRID_NAMES[voxel_size]][0]
+    labels = None
+    if kind == 'Z':
+        data = z_map(mask, rng, voxel_size)
+    elif kind == 'T':
+        data = t_map(mask, rng, voxel_size)
+    elif kind == 'thresholded':
+        data = thresholded_map(mask, rng, voxel_size)
+    elif kind == 'parcellation':
+        data = parcellation(mask, rng, voxel_size)
+    elif kind == 'roi':
+        data = roi(mask, rng, voxel_size)
+    elif kind == '4d':
+        data, labels = afni_4d(mask, rng, voxel_size)
+    else:
+        raise ValueError("Unknown kind of map: %s" % kind)
+
+    if data.dtype == np.float64:
+        data = data.astype(np.float32)
+    nii = nb.Nifti1Image(data, affine)
+    if labels:
+        nii.get_header().extensions.append(afni_extension(labels))
+    return nii
+
+
+def get_map_rng(seed, i):
+    """Every map has its own stream, so any subset of a dataset can be regenerated."""
+    return np.random.RandomState([seed, i])
+
+
+def get_map_path(i, kind):
+    return os.path.join("%04d" % (i // FILES_PER_DIRECTORY), "%07d_%s.nii.gz" % (i, kind))
+
+
+def write_synthetic_dataset(output_dir, n_maps, seed=0, mix=None, one_mm_fraction=0.1, start=0, stop=None):
+    """Writes maps start to stop (default n_maps) of the dataset defined by seed and mix to output_dir.
+
+    Every map (its kind, grid and contents) is drawn from its own stream, so large datasets
+    can be written by several processes with disjoint ranges and grown later on.
+    Existing files are kept, an interrupted run can be resumed.
+    A manifest (path, kind, map_type, voxel size of every map) is written next to the maps.
+    Returns the manifest entries.
+    """
+    if mix is None:
+        mix = DEFAULT_MIX
+    if stop is None:
+        stop = n_maps
+    kinds = sorted(mix)
+    weights = np.array([mix[kind] for kind in kinds], dtype=np.float64)
+    weights /= weights.sum()
+
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    manifest = []
+    for i in range(n_maps):
+        rng = get_map_rng(seed, i)
+        kind = kinds[rng.choice(len(kinds), p=weights)]
+        voxel_size = 1 if rng.uniform() < one_mm_fraction else 2
+        path = get_map_path(i, kind)
+        manifest.append({'path': path, 'kind': kind, 'map_type': KINDS[kind], 'voxel_size': voxel_size})
+
+        full_path = os.path.join(output_dir, path)
+        if not start <= i < stop or os.path.exists(full_path):
+            continue
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        nii = generate_synthetic_map(kind, rng, voxel_size)
+        tmp_path = full_path.replace(".nii.gz", ".tmp.nii.gz")
+        nb.save(nii, tmp_path)
+        os.rename(tmp_path, full_path)
+
+    # every process of a split run writes the same manifest
+    manifest_path = os.path.join(output_dir, MANIFEST_FILENAME)
+    tmp_path = "%s.%d.tmp" % (manifest_path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump({'seed': seed, 'mix': mix, 'one_mm_fraction': one_mm_fraction, 'maps': manifest}, f, indent=1)
+    os.rename(tmp_path, manifest_path)
+    return manifest
+
+
+def load_manifest(output_dir):
+    with open(os.path.join(output_dir, MANIFEST_FILENAME)) as f:
+        return json.load(f)
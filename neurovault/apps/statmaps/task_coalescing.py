@@ -0,0 +1,99 @@
+from functools import wraps
+
+from celery import current_app
+from django.conf import settings
+from django.core.cache import cache
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+
+
+def _state_key(task_name, pk):
+    return "task_coalescing:state:%s:%s" % (task_name, pk)
+
+
+def _rerun_key(task_name, pk):
+    return "task_coalescing:rerun:%s:%s" % (task_name, pk)
+
+
+def _counter_key(task_name):
+    return "task_coalescing:coalesced:%s" % task_name
+
+
+def _count_coalesced(task_name):
+    cache.add(_counter_key(task_name), 0, None)
+    try:
+        cache.incr(_counter_key(task_name))
+    except ValueError:
+        # evicted in the meantime
+        cache.set(_counter_key(task_name), 1, None)
+
+
+def enqueue_once(task, pk, priority=None):
+    """Queue task for image pk unless it is already queued or running for it.
+
+    Otherwise the job is flagged to run once more when it finishes (however many requests
+    came in meanwhile), since it may already have read the old state of the image. A request
+    more urgent than the queued job (e.g. an upload behind a bulk recalculation) is queued
+    again with its priority, the queued job then only repeats the work.
+    Returns True if a new job was queued. Without a priority the one of the task route is used.
+    """
+    state_key = _state_key(task.name, pk)
+    rerun_key = _rerun_key(task.name, pk)
+    queued_priority = settings.DEFAULT_TASK_PRIORITY if priority is None else priority
+    while True:
+        if cache.add(state_key, (QUEUED, queued_priority), settings.TASK_COALESCING_QUEUED_TIMEOUT):
+            # the new job sees the latest state anyway
+            cache.delete(rerun_key)
+            try:
+                task.apply_async([pk], priority=priority)
+            except Exception:
+                cache.delete(state_key)
+                raise
+            return True
+
+        state = cache.get(state_key)
+        if state is not None and state[0] == QUEUED and queued_priority < state[1]:
+            cache.set(state_key, (QUEUED, queued_priority), settings.TASK_COALESCING_QUEUED_TIMEOUT)
+            cache.delete(rerun_key)
+            task.apply_async([pk], priority=priority)
+            return True
+
+        # lower numbers are more urgent, the rerun keeps the most urgent request
+        rerun_priority = cache.get(rerun_key)
+        if rerun_priority is None or queued_priority < rerun_priority:
+            cache.set(rerun_key, queued_priority, settings.TASK_COALESCING_TIMEOUT)
+        if cache.get(state_key) is not None:
+            _count_coalesced(task.name)
+            return False
+        # the job finished before it could see the flag
+
+
+def coalesced(func):
+    """Marks the job of a task queued with enqueue_once as running and releases it when done.
+
+    Apply below @shared_task, the task name (module.function) is kept.
+    """
+    task_name = "%s.%s" % (func.__module__, func.__name__)
+
+    @wraps(func)
+    def wrapper(pk, *args, **kwargs):
+        state_key = _state_key(task_name, pk)
+        cache.set(state_key, (RUNNING, None), settings.TASK_COALESCING_TIMEOUT)
+        try:
+            return func(pk, *args, **kwargs)
+        finally:
+            cache.delete(state_key)
+            rerun_key = _rerun_key(task_name, pk)
+            rerun_priority = cache.get(rerun_key)
+            if rerun_priority is not None:
+                cache.delete(rerun_key)
+                enqueue_once(current_app.tasks[task_name], pk, priority=rerun_priority)
+    return wrapper
+
+
+def coalescing_stats(task_names):
+    """Number of jobs dropped or merged so far, per task name."""
+    counts = cache.get_many([_counter_key(task_name) for task_name in task_names])
+    return dict((task_name, counts.get(_counter_key(task_name), 0)) for task_name in task_names)
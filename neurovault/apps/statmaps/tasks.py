@@ -4,14 +4,14 @@ import nilearn
 from django.core.files.base import ContentFile
 from django.http import Http404
 from django.shortcuts import get_object_or_404
-from pybraincompare.compare.maths import calculate_correlation, calculate_pairwise_correlation
-from pybraincompare.compare.mrutils import resample_images_ref, make_binary_deletion_mask, make_binary_deletion_vector
+from pybraincompare.compare.maths import calculate_correlation
+from pybraincompare.compare.mrutils import resample_images_ref, make_binary_deletion_mask
 from pybraincompare.mr.datasets import get_data_directory
-from pybraincompare.mr.transformation import make_resampled_transformation_vector
 
 nilearn.EXPAND_PATH_WILDCARDS = False
 from nilearn.plotting import plot_glass_brain
 from celery import shared_task, Celery
+from celery.utils.log import get_task_logger
 from six import BytesIO
 import nibabel as nib
 import pylab as plt
@@ -22,7 +22,9 @@ import xml.etree.cElementTree as e
 from django.db import IntegrityError
 from django.core.files.uploadedfile import SimpleUploadedFile
 import re
+import time
 from django.conf import settings
+from neurovault.apps.statmaps.task_coalescing import coalesced
 
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'neurovault.settings')
@@ -30,6 +32,8 @@ app = Celery('neurovault')
 app.config_from_object('django.conf:settings')
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+logger = get_task_logger(__name__)
+
 @app.task(name='crawl_anima')
 def crawl_anima():
     import neurovault.apps.statmaps.models as models
@@ -149,6 +153,7 @@ def crawl_anima():
 # THUMBNAIL IMAGE GENERATION ###########################################################################
 
 @shared_task
+@coalesced
 def generate_glassbrain_image(image_pk):
     from neurovault.apps.statmaps.models import Image
     import matplotlib as mpl
@@ -180,12 +185,36 @@ def generate_glassbrain_image(image_pk):
 @shared_task
 def save_resampled_transformation_single(pk1, resample_dim=[4, 4, 4]):
     from neurovault.apps.statmaps.models import Image
+
+    img = get_object_or_404(Image, pk=pk1)
+    save_resampled_transformation(img, resample_dim)
+    return img
+
+
+# Backfills: images on the same standard grid share one cached resampling operator
+@shared_task
+def save_resampled_transformation_batch(pks, resample_dim=[4, 4, 4]):
+    from neurovault.apps.statmaps.models import Image
+
+    start = time.time()
+    saved = 0
+    for img in Image.objects.filter(pk__in=pks).order_by('pk'):
+        try:
+            save_resampled_transformation(img, resample_dim)
+            saved += 1
+        except Exception, e:
+            logger.error("Reduced representation of image %s failed: %s", img.pk, e)
+    logger.info("Saved %d of %d reduced representations in %.3fs", saved, len(pks), time.time() - start)
+    return saved
+
+
+def save_resampled_transformation(img, resample_dim=[4, 4, 4]):
+    from neurovault.apps.statmaps.resampling import make_reduced_representation
     from six import BytesIO
     import numpy as np
 
-    img = get_object_or_404(Image, pk=pk1)
     nii_obj = nib.load(img.file.path)   # standard_mask=True is default
-    image_vector = make_resampled_transformation_vector(nii_obj,resample_dim)
+    image_vector = make_reduced_representation(nii_obj, resample_dim)
 
     f = BytesIO()
     np.save(f, image_vector)
@@ -193,26 +222,92 @@ def save_resampled_transformation_single(pk1, resample_dim=[4, 4, 4]):
     content_file = ContentFile(f.read())
     img.reduced_representation.save("transform_%smm_%s.npy" %(resample_dim[0],img.pk), content_file)
 
-    return img
+    # keep the shared matrix of all reduced representations in sync
+    if list(resample_dim) == [4, 4, 4]:
+        from neurovault.apps.statmaps.vector_store import get_store
+        get_store().append(img.pk, image_vector)
+    return image_vector
 
 
 # SIMILARITY CALCULATION ##############################################################################
 
 @shared_task
+@coalesced
 def run_voxelwise_pearson_similarity(pk1):
     from neurovault.apps.statmaps.models import Image
     from neurovault.apps.statmaps.utils import get_images_to_compare_with
+    from neurovault.apps.statmaps.vector_store import get_reduced_representation
 
     imgs_pks = get_images_to_compare_with(pk1, for_generation=True)
     if imgs_pks:
-        image = Image.objects.get(pk=pk1)
-        # added for improved performance
-        if not image.reduced_representation or not os.path.exists(image.reduced_representation.path):
-            image = save_resampled_transformation_single(pk1)
+        # added for improved performance, chunks would otherwise race to create it
+        get_reduced_representation(Image.objects.get(pk=pk1))
+
+        # score candidates in blocks, one task (and one bulk upsert) per block
+        # chunks of an upload are as urgent as the upload itself
+        priority = (run_voxelwise_pearson_similarity.request.delivery_info or {}).get('priority')
+        chunk_size = settings.SIMILARITY_CHUNK_SIZE
+        for start in range(0, len(imgs_pks), chunk_size):
+            save_voxelwise_pearson_similarity_chunk.apply_async([pk1, imgs_pks[start:start + chunk_size]],
+                                                                priority=priority)
+
+
+# The data or the search eligibility of an existing map changed: its new reduced representation is
+# scored against all candidates in one job and its comparisons are overwritten, not deleted and
+# rebuilt. Only comparisons with images which are no longer candidates are deleted.
+@shared_task
+@coalesced
+def update_voxelwise_pearson_similarity(pk1):
+    from neurovault.apps.statmaps.models import Image
+    from neurovault.apps.statmaps.similarity import run_similarity, delete_comparisons_except
+    from neurovault.apps.statmaps.utils import get_images_to_compare_with
+
+    imgs_pks = get_images_to_compare_with(pk1, for_generation=True)
+    # e.g. all of them if the map is thresholded now
+    delete_comparisons_except(pk1, imgs_pks)
+    if not imgs_pks:
+        return 0
+    try:
+        save_resampled_transformation(Image.objects.get(pk=pk1))
+    except Image.DoesNotExist:
+        # image has been deleted in the meantime
+        return 0
+    start = time.time()
+    saved = run_similarity(pk1, imgs_pks)
+    logger.info("Updated %d comparisons of image %s in %.3fs", saved, pk1, time.time() - start)
+    return saved
+
+
+@shared_task
+def save_voxelwise_pearson_similarity_chunk(pk1, candidate_pks):
+    from neurovault.apps.statmaps.models import Image
+    from neurovault.apps.statmaps.similarity import pearson_against_matrix, save_similarity_scores, \
+        stack_reduced_representations, prune_to_top_k
+    from neurovault.apps.statmaps.vector_store import get_reduced_representation
+
+    if pk1 in candidate_pks:
+        raise Exception("You are trying to compare an image with itself!")
+
+    start = time.time()
+    try:
+        query = numpy.array(get_reduced_representation(Image.objects.get(pk=pk1)))
+    except Image.DoesNotExist:
+        # image has been deleted in the meantime
+        return 0
+    matrix, rows, row_pks = stack_reduced_representations(candidate_pks)
+    loaded = time.time()
+    scores = pearson_against_matrix(query, matrix, rows=rows)
+    scored = time.time()
+    saved = save_similarity_scores(pk1, row_pks, scores) if row_pks else 0
+    pruned = 0
+    if row_pks and settings.SIMILARITY_STORAGE == 'topk':
+        # update the neighbour lists of the query image and of every candidate it entered
+        pruned = prune_to_top_k([pk1] + row_pks)
+    logger.info("Similarity chunk for image %s: %d candidates, %d comparisons saved, %d pruned "
+                "(load %.3fs, score %.3fs, save %.3fs)", pk1, len(candidate_pks), saved, pruned,
+                loaded - start, scored - loaded, time.time() - scored)
+    return saved
 
-        # exclude single subject maps from analysis
-        for pk in imgs_pks:
-            save_voxelwise_pearson_similarity.apply_async([pk, pk1])  # Default uses reduced_representaion, reduced_representation = True
 
 @shared_task
 def save_voxelwise_pearson_similarity(pk1,pk2,resample_dim=[4,4,4],reduced_representaion=True):
@@ -222,10 +317,10 @@ def save_voxelwise_pearson_similarity(pk1,pk2,resample_dim=[4,4,4],reduced_repre
         save_voxelwise_pearson_similarity_reduced_representation(pk1,pk2)
 
 
-# Calculate pearson correlation from pickle files with brain masked vectors of image values
+# Calculate pearson correlation from brain masked vectors of image values
 def save_voxelwise_pearson_similarity_reduced_representation(pk1, pk2):
-    from neurovault.apps.statmaps.models import Similarity, Comparison
-    import numpy as np
+    from neurovault.apps.statmaps.similarity import pearson_against_matrix, save_similarity_scores, prune_to_top_k
+    from neurovault.apps.statmaps.vector_store import get_reduced_representation
 
     # We will always calculate Comparison 1 vs 2, never 2 vs 1
     if pk1 != pk2:
@@ -236,33 +331,19 @@ def save_voxelwise_pearson_similarity_reduced_representation(pk1, pk2):
             return
         image1 = sorted_images[0]
         image2 = sorted_images[1]
-        pearson_metric = Similarity.objects.get(similarity_metric="pearson product-moment correlation coefficient",
-                                                transformation="voxelwise")
-    
-        # Make sure we have a transforms for pks in question
-        if not image1.reduced_representation or not os.path.exists(image1.reduced_representation.path):
-            image1 = save_resampled_transformation_single(pk1) # cannot run this async
-
-        if not image2.reduced_representation or not os.path.exists(image1.reduced_representation.path):
-            image2 = save_resampled_transformation_single(pk2) # cannot run this async
 
-        # Load image pickles
-        image_vector1 = np.load(image1.reduced_representation.file)
-        image_vector2 = np.load(image2.reduced_representation.file)
+        # Load image vectors from the shared store, transforms are created if missing
+        image_vector1 = get_reduced_representation(image1)
+        image_vector2 = get_reduced_representation(image2)
 
-        # Calculate binary deletion vector mask (find 0s and nans)
-        mask = make_binary_deletion_vector([image_vector1,image_vector2])
-
-        # Calculate pearson
-        pearson_score = calculate_pairwise_correlation(image_vector1[mask==1],
-                                                       image_vector2[mask==1],
-                                                       corr_type="pearson")   
+        # Pearson on voxels which are not 0 or nan in both images
+        pearson_score = pearson_against_matrix(image_vector1, image_vector2.reshape(1, -1))[0]
 
         # Only save comparison if is not nan
-        if not numpy.isnan(pearson_score):     
-            Comparison.objects.update_or_create(image1=image1, image2=image2,
-                                                defaults={'similarity_metric': pearson_metric,
-                                                          'similarity_score': pearson_score})
+        if not numpy.isnan(pearson_score):
+            save_similarity_scores(image1.pk, [image2.pk], [pearson_score])
+            if settings.SIMILARITY_STORAGE == 'topk':
+                prune_to_top_k([image1.pk, image2.pk])
             return image1.pk,image2.pk,pearson_score
         else:
             print "Comparison returned NaN."
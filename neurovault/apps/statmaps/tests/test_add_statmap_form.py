@@ -6,7 +6,7 @@ from django.test import TestCase, Client
 
 from neurovault.apps.statmaps.forms import StatisticMapForm
 from neurovault.apps.statmaps.models import Collection,User, StatisticMap
-from neurovault.apps.statmaps.utils import detect_4D, split_4D_to_3D
+from neurovault.apps.statmaps.utils import detect_4D, split_4D_to_3D, get_data_hash, not_in_mni
 from .utils import clearDB
 
 
@@ -43,6 +43,28 @@ class AddStatmapsTests(TestCase):
             
             self.assertEqual(StatisticMap.objects.filter(collection=self.coll.pk)[0].name, "test map")
 
+    def testaddQAResults(self):
+            testpath = os.path.abspath(os.path.dirname(__file__))
+            fname = os.path.join(testpath,'test_data/statmaps/motor_lips.nii.gz')
+            nii = nb.load(fname)
+            for map_type in ['T', 'R', 'Other']:
+                post_dict = {
+                    'name': "test map %s" % map_type,
+                    'cognitive_paradigm_cogatlas': 'trm_4f24126c22011',
+                    'modality':'fMRI-BOLD',
+                    'map_type': map_type,
+                    'collection':self.coll.pk,
+                    'ignore_file_warning': True,
+                }
+                file_dict = {'file': SimpleUploadedFile(fname, open(fname).read())}
+                form = StatisticMapForm(post_dict, file_dict)
+                self.assertTrue(form.is_valid())
+                image = StatisticMap.objects.get(pk=form.save().pk)
+
+                # the results of the checks the form ran are saved as one set
+                self.assertEqual((image.not_mni, image.brain_coverage, image.perc_voxels_outside), not_in_mni(nii))
+                self.assertEqual(image.data_hash, get_data_hash(nii))
+
     def testaddAFNI(self):
 
             post_dict = {
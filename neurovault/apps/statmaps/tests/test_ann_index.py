@@ -0,0 +1,56 @@
+import shutil
+import tempfile
+
+import numpy
+from django.test import TestCase
+from numpy.testing import assert_almost_equal
+
+from neurovault.apps.statmaps.ann_index import ANNIndex
+from neurovault.apps.statmaps.similarity import pearson_against_matrix
+from neurovault.apps.statmaps.vector_store import ReducedRepresentationStore
+
+
+class ANNIndexTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.store = ReducedRepresentationStore(self.tmpdir)
+        rng = numpy.random.RandomState(0)
+        self.basis = rng.randn(10, 500)
+        vectors = numpy.dot(rng.randn(300, 10) ** 3, self.basis) + rng.randn(300, 500)
+        vectors[rng.rand(300, 500) < 0.2] = 0
+        for pk, vector in enumerate(vectors, 1):
+            self.store.append(pk, vector)
+        self.query = numpy.dot(rng.randn(10) ** 3, self.basis) + rng.randn(500)
+        self.index = ANNIndex.build(self.store, n_components=8, n_clusters=10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_probing_all_partitions_is_exact(self):
+        exact = pearson_against_matrix(self.query, self.store.matrix)
+        expected = numpy.argsort(-numpy.abs(exact))[:10] + 1
+        pks, scores = self.index.search(self.query, max_results=10, n_probe=10, rerank_factor=30,
+                                        store=self.store)
+        self.assertEqual(pks, expected.tolist())
+        assert_almost_equal(scores, exact[expected - 1])
+
+    def test_new_and_allowed_images(self):
+        # images added after the build are always searched
+        self.store.append(1000, self.query)
+        pks, scores = self.index.search(self.query, max_results=5, n_probe=1, rerank_factor=1,
+                                        store=self.store)
+        self.assertEqual(pks[0], 1000)
+        assert_almost_equal(scores[0], 1.0)
+
+        pks, _ = self.index.search(self.query, max_results=5, n_probe=10, rerank_factor=10,
+                                   allowed_pks=[1, 2, 3], store=self.store)
+        self.assertEqual(sorted(pks), [1, 2, 3])
+
+    def test_save_and_load(self):
+        path = "%s/index.npz" % self.tmpdir
+        self.index.save(path)
+        loaded = ANNIndex.load(path)
+        self.assertEqual(loaded.pks.tolist(), self.index.pks.tolist())
+        self.assertEqual(loaded.candidates(self.query, 20, 3).tolist(),
+                         self.index.candidates(self.query, 20, 3).tolist())
@@ -0,0 +1,62 @@
+import os
+
+from django.test import TestCase
+
+from neurovault.apps.statmaps.atlas_index import AtlasIndex, get_atlas_index, clear_atlas_indexes
+from neurovault.apps.statmaps.models import Collection, User
+from .utils import clearDB, save_atlas_form
+
+
+class AtlasIndexTest(TestCase):
+
+    def setUp(self):
+        data_path = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'test_data/api')
+        self.nii_path = os.path.join(data_path, 'VentralFrontal_thr75_summaryimage_2mm.nii.gz')
+        self.xml_path = os.path.join(data_path, 'VentralFrontal_thr75_summaryimage_2mm.xml')
+        self.unordered_xml_path = os.path.join(data_path, 'unordered_VentralFrontal_thr75_summaryimage_2mm.xml')
+        self.user = User.objects.create_user('atlas_index')
+        self.collection = Collection(owner=self.user, name="Atlas index")
+        self.collection.save()
+        clear_atlas_indexes()
+
+    def tearDown(self):
+        clearDB()
+        clear_atlas_indexes()
+
+    def test_voxel_to_region(self):
+        index = AtlasIndex.load(self.nii_path, open(self.xml_path).read())
+        self.assertEqual(index.voxel_to_region(58, -4, 18), '6v')
+        self.assertEqual(index.voxel_to_region('56.0', '20.0', '24.0'), 'fop')
+        self.assertEqual(index.voxel_to_region(0, 0, 0), 'none')
+        self.assertRaises(IndexError, index.voxel_to_region, 1000, 0, 0)
+        self.assertEqual(index.region_labels['6v'], index.regions.index('6v') + 1)
+
+    def test_label_order_does_not_matter(self):
+        ordered = AtlasIndex.load(self.nii_path, open(self.xml_path).read())
+        unordered = AtlasIndex.load(self.nii_path, open(self.unordered_xml_path).read())
+        self.assertEqual(ordered.label_names, unordered.label_names)
+        self.assertEqual(unordered.voxel_to_region(34, 18, 30), 'fop')
+
+    def test_region_voxels(self):
+        index = AtlasIndex.load(self.nii_path, open(self.xml_path).read())
+        voxels = index.region_voxels(['6v'])
+        self.assertEqual(voxels.shape[0], 3)
+        self.assertIn((58.0, -4.0, 18.0), zip(*voxels.tolist()))
+        for x, y, z in zip(*voxels.tolist())[::10]:
+            self.assertEqual(index.voxel_to_region(x, y, z), '6v')
+        self.assertIs(index.region_voxels(['6V']), index.label_voxels(index.region_labels['6v']))
+
+        both = index.region_voxels(['6v', 'fop'])
+        self.assertEqual(both.shape[1], voxels.shape[1] + index.region_voxels(['fop']).shape[1])
+        self.assertRaises(ValueError, index.region_voxels, ['not a region'])
+
+    def test_cached_until_files_change(self):
+        atlas = save_atlas_form(self.nii_path, self.xml_path, self.collection)
+        index = get_atlas_index(atlas)
+        self.assertIs(get_atlas_index(atlas), index)
+
+        stat = os.stat(atlas.label_description_file.path)
+        os.utime(atlas.label_description_file.path, (stat.st_atime, stat.st_mtime + 10))
+        reloaded = get_atlas_index(atlas)
+        self.assertIsNot(reloaded, index)
+        self.assertEqual(reloaded.regions, index.regions)
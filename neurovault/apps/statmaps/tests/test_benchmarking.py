@@ -0,0 +1,35 @@
+import json
+
+from django.test import TestCase
+
+from neurovault.apps.statmaps.benchmarking import BenchmarkSuite, compare_to_baseline, summarize
+
+
+class BenchmarkingTestCase(TestCase):
+
+    def test_summarize(self):
+        result = summarize([0.001 * i for i in range(1, 101)])
+        self.assertEqual(result['n'], 100)
+        self.assertAlmostEqual(result['p50_ms'], 50.5)
+        self.assertAlmostEqual(result['p99_ms'], 99.01)
+        self.assertAlmostEqual(result['throughput_per_s'], 100 / 5.05)
+        self.assertEqual(summarize([]), {'n': 0})
+
+    def test_failing_calls_are_counted(self):
+        suite = BenchmarkSuite(verbose=False)
+        result = suite.run('division', lambda x: 1 / x, [1, 0, 2])
+        self.assertEqual(result['n'], 2)
+        self.assertEqual(result['errors'], 1)
+        self.assertIn('ZeroDivisionError', result['first_error'])
+        self.assertGreater(result['peak_rss_mb'], 0)
+        self.assertIn(result['peak_rss_scope'], ['case', 'process'])
+        self.assertIn('rss_delta_mb', result)
+        self.assertEqual(json.loads(suite.to_json({'seed': 0}))['results']['division']['n'], 2)
+
+    def test_compare_to_baseline(self):
+        baseline = {'fast': {'p95_ms': 10.0}, 'slow': {'p95_ms': 10.0}, 'removed': {'p95_ms': 1.0}}
+        results = {'fast': {'p95_ms': 11.0}, 'slow': {'p95_ms': 13.0}, 'new': {'p95_ms': 100.0},
+                   'broken': {'n': 0}}
+        self.assertEqual(compare_to_baseline(results, baseline), [('slow', 10.0, 13.0)])
+        self.assertEqual(sorted(compare_to_baseline(results, baseline, tolerance=0.05)),
+                         [('fast', 10.0, 11.0), ('slow', 10.0, 13.0)])
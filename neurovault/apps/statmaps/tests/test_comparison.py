@@ -1,15 +1,23 @@
+import json
 import nibabel
 import numpy
 import os
 import shutil
 import tempfile
-from django.test import TestCase
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.urlresolvers import reverse
+from django.db.models import Q
+from django.test import TestCase, override_settings
 from numpy.testing import assert_almost_equal, assert_equal
 
 from neurovault.apps.statmaps.models import Comparison, Similarity, User, Collection, Image
-from neurovault.apps.statmaps.tasks import save_voxelwise_pearson_similarity, get_images_by_ordered_id, save_resampled_transformation_single
+from neurovault.apps.statmaps.tasks import save_voxelwise_pearson_similarity, get_images_by_ordered_id, save_resampled_transformation_single, \
+    save_voxelwise_pearson_similarity_chunk
+from neurovault.apps.statmaps.similarity import get_pair_similarity, save_similarity_scores
+from neurovault.apps.statmaps.vector_store import get_store
 from neurovault.apps.statmaps.tests.utils import clearDB, save_statmap_form
-from neurovault.apps.statmaps.utils import split_4D_to_3D, get_similar_images
+from neurovault.apps.statmaps.utils import split_4D_to_3D, get_similar_images, get_images_to_compare_with, \
+    get_existing_comparisons, count_existing_comparisons, get_similar_images_data
 
 
 class ComparisonTestCase(TestCase):
@@ -133,6 +141,51 @@ class ComparisonTestCase(TestCase):
         print comparison[0].similarity_score
         assert_almost_equal(comparison[0].similarity_score, 0.312548260435768,decimal=5)
         
+    def test_save_pearson_similarity_chunk(self):
+        with self.assertRaises(Exception):
+            save_voxelwise_pearson_similarity_chunk(self.pk1, [self.pk1, self.pk2])
+
+        Comparison.objects.all().delete()
+        for _ in range(2):
+            # running the same chunk twice updates the existing rows
+            saved = save_voxelwise_pearson_similarity_chunk(self.pk1, [self.pk1_copy, self.pk2])
+            self.assertEqual(saved, 2)
+            self.assertEqual(Comparison.objects.count(), 2)
+
+        image1, image2 = get_images_by_ordered_id(self.pk1, self.pk1_copy)
+        comparison = Comparison.objects.get(image1=image1, image2=image2)
+        self.assertAlmostEqual(comparison.similarity_score, 1.0)
+
+        image1, image2 = get_images_by_ordered_id(self.pk1, self.pk2)
+        comparison = Comparison.objects.get(image1=image1, image2=image2)
+        assert_almost_equal(comparison.similarity_score, 0.214495998015581, decimal=5)
+
+    def test_top_k_storage(self):
+        pks = [self.pk1, self.pk1_copy, self.pk2, self.pk3, self.pknan]
+        Comparison.objects.all().delete()
+        for i in range(1, len(pks)):
+            save_voxelwise_pearson_similarity_chunk(pks[i], pks[:i])
+        full_scores = dict(((c.image1_id, c.image2_id), c.similarity_score) for c in Comparison.objects.all())
+        self.assertGreater(len(full_scores), len(pks))
+
+        Comparison.objects.all().delete()
+        with override_settings(SIMILARITY_STORAGE='topk', SIMILARITY_TOP_K=1):
+            for i in range(1, len(pks)):
+                save_voxelwise_pearson_similarity_chunk(pks[i], pks[:i])
+
+        # every image keeps its best neighbour, nothing outside the top 1 of both images survives
+        stored = set((c.image1_id, c.image2_id) for c in Comparison.objects.all())
+        self.assertLessEqual(len(stored), len(pks))
+        for pk in pks:
+            own = dict((pair, score) for pair, score in full_scores.items() if pk in pair)
+            best = max(own, key=lambda pair: abs(own[pair]))
+            self.assertIn(best, stored)
+
+        # pairs which are not stored are computed on demand
+        missing = [pair for pair in full_scores if pair not in stored][0]
+        image1, image2 = get_images_by_ordered_id(*missing)
+        assert_almost_equal(get_pair_similarity(image1, image2), full_scores[missing], decimal=5)
+
     def test_private_to_public_switch(self):
         private_collection1 = Collection(name='privateCollection1',owner=self.u1, private=True,
                                         DOI='10.3389/fninf.2015.00099')
@@ -188,6 +241,42 @@ class ComparisonTestCase(TestCase):
         comparison = Comparison.objects.filter(image1=image1,image2=image2)
         self.assertEqual(len(comparison), 1)
 
+    def test_search_eligibility(self):
+        collection1 = Collection(name='Collection1', owner=self.u1, DOI='10.3389/fninf.2015.00099')
+        collection1.save()
+        collection2 = Collection(name='Collection2', owner=self.u1, DOI='10.3389/fninf.2015.00089')
+        collection2.save()
+
+        app_path = os.path.abspath(os.path.dirname(__file__))
+        image1 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/all.nii.gz'),
+                                   collection=collection1,
+                                   image_name="image1")
+        image2 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/motor_lips.nii.gz'),
+                                   collection=collection2,
+                                   image_name="image2")
+        self.assertTrue(Image.objects.get(pk=image1.pk).is_search_eligible)
+        self.assertEqual(count_existing_comparisons(image2.pk), Comparison.objects.filter(
+            Q(image1__pk=image2.pk) | Q(image2__pk=image2.pk)).count())
+        self.assertTrue(get_existing_comparisons(image2.pk).filter(
+            Q(image1__pk=image1.pk) | Q(image2__pk=image1.pk)).exists())
+
+        collection1.private = True
+        collection1.save()
+        self.assertFalse(Image.objects.get(pk=image1.pk).is_search_eligible)
+        self.assertNotIn(image1.pk, get_images_to_compare_with(image2.pk))
+        self.assertFalse(get_existing_comparisons(image2.pk).filter(
+            Q(image1__pk=image1.pk) | Q(image2__pk=image1.pk)).exists())
+
+        collection1.private = False
+        collection1.DOI = None
+        collection1.save()
+        self.assertFalse(Image.objects.get(pk=image1.pk).is_search_eligible)
+
+        collection1.DOI = '10.3389/fninf.2015.00099'
+        collection1.save()
+        self.assertTrue(Image.objects.get(pk=image1.pk).is_search_eligible)
+        self.assertIn(image1.pk, get_images_to_compare_with(image2.pk))
+
     def test_get_similar_images(self):
         collection1 = Collection(name='Collection1', owner=self.u1,
                                  DOI='10.3389/fninf.2015.00099')
@@ -210,3 +299,98 @@ class ComparisonTestCase(TestCase):
         print "Success for this test means the pandas DataFrame shows the copy in first position with score of 1"
         self.assertEqual(similar_images['image_id'][0], int(image2.pk))
         self.assertEqual(similar_images['score'][0], 1)
+        self.assertEqual(similar_images['collection_name'][0], 'Collection2')
+        self.assertEqual(similar_images['tag'][0], [str(Image.objects.get(pk=image2.pk).map_type)])
+
+        response = json.loads(self.client.get(reverse('find_similar_json', args=[image1.pk])).content)
+        self.assertEqual(response['columns'], list(similar_images.columns))
+        self.assertEqual(response['data'][0][1], int(image2.pk))
+
+    def test_find_similar_json_n_probe(self):
+        url = reverse('find_similar_json', args=[self.pk1]) + '?mode=approximate&n_probe=%s'
+        for n_probe in ['abc', '0', '-3', '1.5']:
+            self.assertEqual(self.client.get(url % n_probe).status_code, 400)
+        # more partitions than the index has are clamped
+        self.assertEqual(self.client.get(url % '100000').status_code, 200)
+
+    def test_similar_images_cache(self):
+        collection1 = Collection(name='Collection1', owner=self.u1, DOI='10.3389/fninf.2015.00099')
+        collection1.save()
+        collection2 = Collection(name='Collection2', owner=self.u1, DOI='10.3389/fninf.2015.00089')
+        collection2.save()
+
+        app_path = os.path.abspath(os.path.dirname(__file__))
+        image1 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/all.nii.gz'),
+                                   collection=collection1,
+                                   image_name="image1")
+        image2 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/all.nii.gz'),
+                                   collection=collection2,
+                                   image_name="image2")
+
+        self.assertEqual(get_similar_images_data(image1.pk)[0][4], 1)
+        # cached scores, only the metadata of the similar images is queried
+        with self.assertNumQueries(1):
+            self.assertEqual(get_similar_images_data(image1.pk)[0][4], 1)
+
+        # metadata edits of the similar images show up without invalidating the scores
+        image2.name = "image2 renamed"
+        image2.save()
+        collection2.name = "Collection2 renamed"
+        collection2.save()
+        self.assertEqual(get_similar_images_data(image1.pk)[0][:3], ["Collection2 renamed", image2.pk, "image2 renamed"])
+
+        # writing a comparison of the image invalidates its cached results
+        save_similarity_scores(image1.pk, [image2.pk], [0.5])
+        self.assertEqual(get_similar_images_data(image1.pk)[0][4], 0.5)
+        self.assertEqual(get_similar_images_data(image2.pk)[0][4], 0.5)
+
+        Image.objects.get(pk=image2.pk).delete()
+        self.assertEqual(get_similar_images_data(image1.pk), [])
+
+    def test_file_replacement(self):
+        collection1 = Collection(name='Collection1', owner=self.u1, DOI='10.3389/fninf.2015.00099')
+        collection1.save()
+        collection2 = Collection(name='Collection2', owner=self.u1, DOI='10.3389/fninf.2015.00089')
+        collection2.save()
+
+        app_path = os.path.abspath(os.path.dirname(__file__))
+        image1 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/all.nii.gz'),
+                                   collection=collection1,
+                                   image_name="image1")
+        image2 = save_statmap_form(image_path=os.path.join(app_path, 'test_data/statmaps/all.nii.gz'),
+                                   collection=collection2,
+                                   image_name="image2")
+        comparison = Comparison.objects.get(image1=image1, image2=image2)
+        self.assertEqual(comparison.similarity_score, 1)
+        self.assertIsNotNone(Image.objects.get(pk=image2.pk).data_hash)
+
+        # the same data in a new file keeps the comparisons and the reduced representation
+        image2 = Image.objects.get(pk=image2.pk)
+        image2.file = SimpleUploadedFile('all_copy.nii.gz',
+                                         open(os.path.join(app_path, 'test_data/statmaps/all.nii.gz')).read())
+        image2.save()
+        self.assertEqual(Comparison.objects.get(image1=image1, image2=image2).pk, comparison.pk)
+        self.assertIn(image2.pk, get_store())
+
+        # new data updates the existing comparison in place
+        image2 = Image.objects.get(pk=image2.pk)
+        image2.file = SimpleUploadedFile('motor_lips.nii.gz',
+                                         open(os.path.join(app_path, 'test_data/statmaps/motor_lips.nii.gz')).read())
+        image2.save()
+        updated = Comparison.objects.get(image1=image1, image2=image2)
+        self.assertEqual(updated.pk, comparison.pk)
+        self.assertNotAlmostEqual(updated.similarity_score, 1)
+        self.assertIn(image2.pk, get_store())
+
+        # a thresholded map is no longer compared with anything
+        nii = nibabel.load(os.path.join(app_path, 'test_data/statmaps/all.nii.gz'))
+        data = numpy.zeros(nii.shape[:3])
+        data[20:30, 20:30, 20:30] = nii.get_data()[20:30, 20:30, 20:30]
+        thresholded_path = os.path.join(self.tmpdir, 'thresholded.nii.gz')
+        nibabel.save(nibabel.Nifti1Image(data, nii.get_affine()), thresholded_path)
+        image2 = Image.objects.get(pk=image2.pk)
+        image2.file = SimpleUploadedFile('thresholded.nii.gz', open(thresholded_path).read())
+        image2.perc_bad_voxels = None
+        image2.save()
+        self.assertTrue(Image.objects.get(pk=image2.pk).is_thresholded)
+        self.assertFalse(Comparison.objects.filter(Q(image1=image2) | Q(image2=image2)).exists())
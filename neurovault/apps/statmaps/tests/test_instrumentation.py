@@ -0,0 +1,79 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, Client, override_settings
+
+from neurovault.apps.statmaps.instrumentation import install_cache_counters, install_query_counters, \
+    start_request_stats, stop_request_stats
+
+
+class RecordHandler(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(json.loads(record.getMessage()))
+
+
+class RequestInstrumentationTestCase(TestCase):
+
+    def setUp(self):
+        self.handler = RecordHandler()
+        logging.getLogger('neurovault.instrumentation').addHandler(self.handler)
+        self.profile_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        logging.getLogger('neurovault.instrumentation').removeHandler(self.handler)
+        shutil.rmtree(self.profile_dir)
+
+    def test_cache_counters(self):
+        install_cache_counters()
+        cache.set('instrumented', 1)
+        stats = start_request_stats()
+        cache.get('instrumented')
+        cache.get('not there')
+        self.assertEqual(cache.get('not there', 'default'), 'default')
+        cache.get_many(['instrumented', 'not there'])
+        stop_request_stats()
+        self.assertEqual((stats.cache_hits, stats.cache_misses), (2, 3))
+
+    def test_query_counters(self):
+        install_query_counters()
+        install_query_counters()
+        # a full queries log does not change the count
+        connection.queries_log.extend({'sql': '', 'time': '0'} for _ in range(connection.queries_limit))
+        stats = start_request_stats()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+            cursor.executemany("SELECT %s", [(1,), (2,)])
+        stop_request_stats()
+        self.assertEqual(stats.db_queries, 2)
+        self.assertGreaterEqual(stats.db_time, 0)
+
+    def test_requests_are_logged(self):
+        with self.settings(REQUEST_INSTRUMENTATION=True, REQUEST_PROFILE_SAMPLE_RATE=1.0,
+                           REQUEST_PROFILE_DIR=self.profile_dir):
+            response = Client().get('/api/collections/')
+        self.assertEqual(response.status_code, 200)
+
+        record = self.handler.records[-1]
+        self.assertEqual(record['path'], '/api/collections/')
+        self.assertEqual(record['status'], 200)
+        self.assertIn('CollectionViewSet', record['view'])
+        self.assertGreater(record['db_queries'], 0)
+        for key in ['wall_time_ms', 'db_time_ms', 'cache_hits', 'cache_misses', 'mni_mask_cache_hits',
+                    'mni_mask_cache_misses']:
+            self.assertIn(key, record)
+        self.assertTrue(os.path.exists(record['profile']))
+
+    @override_settings(REQUEST_INSTRUMENTATION=False)
+    def test_disabled_by_default(self):
+        Client().get('/api/collections/')
+        self.assertEqual(self.handler.records, [])
@@ -0,0 +1,53 @@
+import networkx as nx
+from django.test import TestCase
+
+from neurovault.apps.statmaps.ontology import OntologyGraph, get_ontology_graph
+
+
+class OntologyGraphTest(TestCase):
+
+    def setUp(self):
+        graph = nx.DiGraph()
+        for node, name in [('brain', 'brain'), ('frontal', 'frontal lobe'), ('mfg', 'middle frontal gyrus'),
+                           ('sfg', 'superior frontal gyrus'), ('part', 'part of middle frontal gyrus')]:
+            graph.add_node(node, name=name)
+        graph.add_edges_from([('brain', 'frontal'), ('frontal', 'mfg'), ('frontal', 'sfg'), ('mfg', 'part')])
+        self.ontology = OntologyGraph(graph)
+        self.index = {'middle frontal gyrus': ['mfg'], 'superior frontal gyrus': ['sfg']}
+
+    def test_name_index(self):
+        self.assertEqual(self.ontology.node_ids['frontal lobe'], 'frontal')
+        self.assertNotIn('not a region', self.ontology.node_ids)
+
+    def test_matches(self):
+        self.assertEqual(sorted(self.ontology.matches('brain', self.index)), ['mfg', 'sfg'])
+        self.assertEqual(self.ontology.matches('part', self.index), [])
+        self.assertEqual(self.ontology.matches('part', self.index, 'parents'), ['mfg'])
+
+    def test_matches_are_memoized_per_index(self):
+        self.ontology.matches('brain', self.index)
+        memo = self.ontology._memo(self.index, 'children')
+        self.assertEqual(sorted(memo['frontal']), ['mfg', 'sfg'])
+        # results do not share state with the memo
+        self.ontology.matches('frontal', self.index).append('changed')
+        self.assertEqual(sorted(self.ontology.matches('frontal', self.index)), ['mfg', 'sfg'])
+
+        other_index = {'frontal lobe': ['frontal']}
+        self.assertEqual(self.ontology.matches('brain', other_index), ['frontal'])
+
+    def test_cycles(self):
+        self.ontology.graph.add_edge('part', 'brain')
+        self.assertEqual(self.ontology.matches('part', {}), [])
+
+    def test_cycles_do_not_memoize_partial_matches(self):
+        self.ontology.graph.add_node('x', name='x')
+        self.ontology.graph.add_node('y', name='y')
+        self.ontology.graph.add_edges_from([('x', 'y'), ('y', 'x'), ('y', 'sfg')])
+        self.assertEqual(self.ontology.matches('y', self.index), ['sfg'])
+        # searched from y, the cycle cut x off from the matches of y
+        self.assertEqual(self.ontology.matches('x', self.index), ['sfg'])
+
+    def test_loaded_once(self):
+        graph = get_ontology_graph()
+        self.assertIs(get_ontology_graph(), graph)
+        self.assertGreater(len(graph.node_ids), 0)
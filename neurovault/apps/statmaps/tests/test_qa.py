@@ -3,9 +3,12 @@ import os
 import nibabel as nb
 import numpy as np
 from django.test import TestCase
+from nilearn.image import resample_img
 
+from neurovault.apps.statmaps.instrumentation import start_request_stats, stop_request_stats
 from neurovault.apps.statmaps.models import BaseStatisticMap
-from neurovault.apps.statmaps.utils import is_thresholded, infer_map_type
+from neurovault.apps.statmaps.utils import is_thresholded, infer_map_type, not_in_mni, compute_qa_metrics, \
+    clear_mni_mask_cache, mni_mask_cache_info, get_mni_mask
 
 
 class QATest(TestCase):
@@ -35,4 +38,70 @@ class QATest(TestCase):
     def testInferMapType(self):
         self.assertEquals(infer_map_type(self.roi_map), BaseStatisticMap.R)
         self.assertEquals(infer_map_type(self.parcellation), BaseStatisticMap.Pa)
-        self.assertEquals(infer_map_type(self.brain), BaseStatisticMap.OTHER)
\ No newline at end of file
+        self.assertEquals(infer_map_type(self.brain), BaseStatisticMap.OTHER)
+
+    def testComputeQAMetrics(self):
+        for nii in [self.roi_map, self.parcellation, self.brain]:
+            metrics = compute_qa_metrics(nii)
+            is_thr, ratio_bad = is_thresholded(nii)
+            not_mni, brain_coverage, perc_voxels_outside = not_in_mni(nii)
+            self.assertEquals(metrics['is_thresholded'], is_thr)
+            self.assertAlmostEqual(metrics['perc_bad_voxels'], ratio_bad*100.0)
+            self.assertEquals(metrics['not_mni'], not_mni)
+            self.assertAlmostEqual(metrics['brain_coverage'], brain_coverage)
+            self.assertAlmostEqual(metrics['perc_voxels_outside'], perc_voxels_outside)
+            self.assertEquals(metrics['map_type'], infer_map_type(nii))
+            self.assertEquals(sorted(compute_qa_metrics(nii, ['thresholded']).keys()),
+                              ['is_thresholded', 'perc_bad_voxels'])
+
+    def testInferMapTypeMatchesValueLoop(self):
+        def infer_map_type_loop(data):
+            unique_values = np.unique(data[np.logical_not(np.logical_or(data == 0, np.isnan(data)))])
+            if len(unique_values) == 1:
+                return BaseStatisticMap.R
+            elif len(unique_values) > 1200:
+                return BaseStatisticMap.OTHER
+            for val in unique_values:
+                if not(isinstance(val, np.integer) or (isinstance(val, np.floating) and float(val).is_integer())):
+                    return BaseStatisticMap.OTHER
+                if (data == val).sum() == 1:
+                    return BaseStatisticMap.OTHER
+            return BaseStatisticMap.Pa
+
+        rng = np.random.RandomState(0)
+        for i, dtype in enumerate([np.int16, np.int32, np.float32, np.float64] * 50):
+            data = rng.randint(0, i % 40 + 1, size=(10, 10, 10)).astype(dtype)
+            if i % 3 == 1 and data.dtype.kind == 'f':
+                data[0, 0, 0] = 0.5
+            elif i % 3 == 2 and data.dtype.kind == 'f':
+                data[0, 0, 0] = np.nan
+            nii = nb.Nifti1Image(data, affine=np.eye(4))
+            self.assertEquals(infer_map_type(nii), infer_map_type_loop(data))
+
+    def testNotInMNIMaskCache(self):
+        clear_mni_mask_cache()
+        stats = start_request_stats()
+        first = not_in_mni(self.roi_map)
+        self.assertEquals(mni_mask_cache_info()['misses'], 1)
+        self.assertEquals(not_in_mni(self.roi_map), first)
+        self.assertEquals(mni_mask_cache_info()['hits'], 1)
+        stop_request_stats()
+        self.assertEquals((stats.mni_mask_hits, stats.mni_mask_misses), (1, 1))
+
+        # a grid with more voxels than the mask is compared on the mask grid
+        mask_nii = get_mni_mask()
+        data = np.zeros((120, 140, 120))
+        data[20:100, 30:110, 20:90] = 1
+        affine = np.diag([1.5, 1.5, 1.5, 1])
+        affine[:3, 3] = [-90, -126, -72]
+        nii = nb.Nifti1Image(data, affine)
+        excursion_set = resample_img(nii, target_affine=mask_nii.get_affine(), target_shape=mask_nii.shape,
+                                     interpolation='nearest').get_data() != 0
+        brain_mask = mask_nii.get_data() > 0
+        _, brain_coverage, perc_voxels_outside = not_in_mni(nii)
+        self.assertAlmostEqual(brain_coverage,
+                               np.logical_and(excursion_set, brain_mask).sum()/float(brain_mask.sum())*100.0)
+        self.assertAlmostEqual(perc_voxels_outside,
+                               np.logical_and(excursion_set, ~brain_mask).sum()/float(excursion_set.sum())*100.0)
+        self.assertEquals(not_in_mni(nii)[1:], (brain_coverage, perc_voxels_outside))
+        self.assertEquals(mni_mask_cache_info()['misses'], 2)
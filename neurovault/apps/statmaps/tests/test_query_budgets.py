@@ -0,0 +1,71 @@
+import json
+import os
+
+from django.core.cache import cache
+from django.test import TestCase
+
+from neurovault.apps.statmaps.models import Collection, StatisticMap, User
+from .utils import clearDB, save_statmap_form, QueryBudgetMixin
+
+
+class QueryBudgetTest(QueryBudgetMixin, TestCase):
+    """The hot datatable and index views make a fixed number of queries, whatever they render."""
+
+    def setUp(self):
+        self.image_path = os.path.join(os.path.abspath(os.path.dirname(__file__)),
+                                       'test_data/statmaps/motor_lips.nii.gz')
+        self.user = User.objects.create_user('budget', None, 'pwd')
+        self.client.login(username='budget', password='pwd')
+        self.n_collections = 0
+        self.collection = self.add_collection(n_images=1)
+
+    def tearDown(self):
+        clearDB()
+
+    def add_collection(self, n_images=0):
+        self.n_collections += 1
+        collection = Collection(owner=self.user, name="Budget %d" % self.n_collections,
+                                DOI='10.3389/fninf.2015.%05d' % self.n_collections)
+        collection.save()
+        for i in range(n_images):
+            save_statmap_form(self.image_path, collection, image_name="map %d" % i)
+        return collection
+
+    def add_images(self, n_images=3):
+        for i in range(n_images):
+            save_statmap_form(self.image_path, self.collection, image_name="more %d" % i)
+
+    def test_public_collections_json(self):
+        self.assertDoesNotGrow('/collections/json', lambda: [self.add_collection(2) for _ in range(3)])
+        self.assertWithinBudget('/collections/json', max_queries=5)
+
+    def test_my_collections_json(self):
+        self.assertDoesNotGrow('/my_collections/json', lambda: [self.add_collection(2) for _ in range(3)])
+        # session, user, permissions and the datatable queries
+        self.assertWithinBudget('/my_collections/json', max_queries=10)
+
+    def test_images_in_collection_json(self):
+        url = '/collections/%d/json' % self.collection.pk
+        self.assertDoesNotGrow(url, self.add_images)
+        self.assertWithinBudget(url, max_queries=10)
+
+    def test_find_similar_json(self):
+        image = StatisticMap.objects.filter(collection=self.collection)[0]
+        url = '/images/%d/find_similar/json/' % image.pk
+        self.client.get(url)
+
+        def measure_uncached():
+            cache.clear()
+            return self.measure(url)
+        # comparisons are only made with maps of other collections
+        self.add_collection(1)
+        before = measure_uncached()
+        for _ in range(3):
+            self.add_collection(1)
+        after = measure_uncached()
+        self.assertEqual(before, after, "(queries, filesystem calls) of %s went from %s to %s" % (url, before, after))
+        self.assertEqual(len(json.loads(self.client.get(url).content)['data']), 4)
+
+    def test_index(self):
+        self.assertDoesNotGrow('/', lambda: [self.add_collection(1) for _ in range(3)])
+        self.assertWithinBudget('/', max_queries=6, max_filesystem_calls=20)
@@ -0,0 +1,37 @@
+import nibabel as nb
+import numpy as np
+from django.test import TestCase
+from numpy.testing import assert_almost_equal, assert_array_equal
+from pybraincompare.mr.transformation import make_resampled_transformation_vector
+from scipy import ndimage
+
+from neurovault.apps.statmaps.resampling import STANDARD_GRIDS, get_resampling_operator, \
+    make_reduced_representation
+
+
+class ResamplingTestCase(TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        affine, shape = STANDARD_GRIDS[1]
+        data = ndimage.gaussian_filter(rng.randn(*shape), 3)
+        # thresholded map with missing values
+        data[np.abs(data) < 0.5 * data.std()] = 0
+        data[:5] = np.nan
+        self.standard_nii = nb.Nifti1Image(data, affine)
+
+    def test_standard_grid_matches_generic_transformation(self):
+        self.assertIsNotNone(get_resampling_operator(self.standard_nii.get_affine(), self.standard_nii.shape))
+        expected = make_resampled_transformation_vector(self.standard_nii, [4, 4, 4])
+        vector = make_reduced_representation(self.standard_nii, [4, 4, 4])
+        self.assertEqual(vector.shape, expected.shape)
+        assert_array_equal(np.isnan(vector), np.isnan(expected))
+        assert_almost_equal(vector[~np.isnan(vector)], expected[~np.isnan(expected)])
+
+    def test_other_grids_use_generic_transformation(self):
+        affine = self.standard_nii.get_affine().copy()
+        affine[:3, 3] += 1
+        nii = nb.Nifti1Image(self.standard_nii.get_data(), affine)
+        self.assertIsNone(get_resampling_operator(nii.get_affine(), nii.shape))
+        assert_array_equal(make_reduced_representation(nii, [4, 4, 4]),
+                           make_resampled_transformation_vector(nii, [4, 4, 4]))
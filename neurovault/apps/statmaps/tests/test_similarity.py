@@ -0,0 +1,40 @@
+import numpy
+from django.test import TestCase
+from numpy.testing import assert_almost_equal
+from pybraincompare.compare.maths import calculate_pairwise_correlation
+from pybraincompare.compare.mrutils import make_binary_deletion_vector
+
+from neurovault.apps.statmaps.similarity import pearson_against_matrix
+
+
+class SimilarityEngineTestCase(TestCase):
+
+    def setUp(self):
+        rng = numpy.random.RandomState(42)
+        self.matrix = rng.randn(25, 400).astype(numpy.float32)
+        self.matrix[rng.rand(25, 400) < 0.3] = 0
+        self.matrix[rng.rand(25, 400) < 0.1] = numpy.nan
+        self.query = rng.randn(400)
+        self.query[rng.rand(400) < 0.2] = numpy.nan
+        self.query[rng.rand(400) < 0.2] = 0
+
+    def test_matches_pairwise_pearson(self):
+        scores = pearson_against_matrix(self.query, self.matrix, block_size=4)
+        self.assertEqual(scores.shape, (25,))
+        for row, score in zip(self.matrix, scores):
+            row = row.astype(numpy.float64)
+            mask = make_binary_deletion_vector([self.query, row])
+            expected = calculate_pairwise_correlation(self.query[mask == 1], row[mask == 1],
+                                                      corr_type="pearson")
+            assert_almost_equal(score, expected, decimal=6)
+
+    def test_identical_and_empty_rows(self):
+        self.matrix[0] = self.query
+        self.matrix[1] = 0
+        scores = pearson_against_matrix(self.query, self.matrix)
+        assert_almost_equal(scores[0], 1.0)
+        self.assertTrue(numpy.isnan(scores[1]))
+
+    def test_shape_mismatch(self):
+        with self.assertRaises(ValueError):
+            pearson_against_matrix(self.query[:10], self.matrix)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+
+import networkx as nx
+from django.test import TestCase, override_settings
+
+from neurovault.apps.statmaps.ontology import OntologyGraph
+from neurovault.apps.statmaps.synonyms import SynonymStore, get_synonym_store
+from neurovault.apps.statmaps.voxel_query_functions import toAtlas
+
+
+class SynonymStoreTest(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'synonyms.json')
+        self.store = SynonymStore({'middle frontal gyrus': ['mfg', 'gyrus frontalis medius', 'middle frontal gyrus'],
+                                   'precentral gyrus': ['prcg', 'precentral gyrus']})
+        self.regions = ['middle frontal gyrus', 'precentral gyrus', 'insula']
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        index = self.store.index(self.regions)
+        self.assertEqual(index['mfg'], ['middle frontal gyrus'])
+        self.assertEqual(index['precentral gyrus'], ['precentral gyrus'])
+        # terms without stored synonyms name themselves
+        self.assertEqual(index['insula'], ['insula'])
+        self.assertNotIn('nothing', index)
+        self.assertIs(self.store.index(self.regions), index)
+
+    def test_to_atlas(self):
+        graph = nx.DiGraph()
+        graph.add_node('frontal', name='frontal lobe')
+        graph.add_node('mfg', name='gyrus frontalis medius')
+        graph.add_node('other', name='something else')
+        graph.add_edge('frontal', 'mfg')
+        graph.add_edge('frontal', 'other')
+        graph = OntologyGraph(graph)
+        index = self.store.index(self.regions)
+
+        self.assertEqual(toAtlas('mfg', graph, self.regions, index), ['middle frontal gyrus'])
+        self.assertEqual(toAtlas('frontal lobe', graph, self.regions, index), ['middle frontal gyrus'])
+        self.assertEqual(toAtlas('something else', graph, self.regions, index), 'none')
+        self.assertRaises(ValueError, toAtlas, 'not in graph', graph, self.regions, index)
+
+    def test_get_synonym_store(self):
+        with override_settings(SYNONYM_STORE_PATH=self.path):
+            self.assertEqual(get_synonym_store().synonyms, {})
+            self.store.save(self.path)
+            # reloaded when the file changes
+            os.utime(self.path, (0, 0))
+            self.assertEqual(get_synonym_store().synonyms, self.store.synonyms)
+            self.assertEqual(SynonymStore.load(self.path).get('mfg'), ['mfg'])
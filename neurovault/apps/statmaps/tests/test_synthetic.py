@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+
+import nibabel as nb
+import numpy as np
+from django.core.management import call_command
+from django.test import TestCase
+from numpy.testing import assert_array_equal
+
+from neurovault.apps.statmaps.models import BaseStatisticMap
+from neurovault.apps.statmaps.synthetic import generate_synthetic_map, get_map_rng, load_manifest, \
+    write_synthetic_dataset
+from neurovault.apps.statmaps.utils import compute_qa_metrics, detect_4D, get_afni_subbrick_labels
+
+
+class SyntheticMapsTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_maps_pass_qa_as_their_kind(self):
+        for kind, map_type, thresholded in [('Z', BaseStatisticMap.OTHER, False),
+                                            ('T', BaseStatisticMap.OTHER, False),
+                                            ('thresholded', None, True),
+                                            ('parcellation', BaseStatisticMap.Pa, False),
+                                            ('roi', BaseStatisticMap.R, True)]:
+            metrics = compute_qa_metrics(generate_synthetic_map(kind, np.random.RandomState(0)))
+            if map_type is not None:
+                self.assertEqual(metrics['map_type'], map_type, kind)
+            self.assertEqual(metrics['is_thresholded'], thresholded, kind)
+            self.assertFalse(metrics['not_mni'], kind)
+
+    def test_afni_4d(self):
+        nii = generate_synthetic_map('4d', np.random.RandomState(0))
+        path = os.path.join(self.tmpdir, 'afni.nii.gz')
+        nb.save(nii, path)
+        nii = nb.load(path)
+        self.assertTrue(detect_4D(nii))
+        labels = get_afni_subbrick_labels(nii)
+        self.assertEqual(len(labels), nii.shape[-1])
+        self.assertEqual(labels[:2], ['cond1#0_Coef', 'cond1#0_Tstat'])
+
+    def test_dataset_is_reproducible(self):
+        first = os.path.join(self.tmpdir, 'first')
+        second = os.path.join(self.tmpdir, 'second')
+        call_command('generate_synthetic_maps', first, count=4, seed=3, mix='Z=1,roi=1')
+        # written in two parts
+        write_synthetic_dataset(second, 4, seed=3, mix={'Z': 1, 'roi': 1}, stop=2)
+        manifest = write_synthetic_dataset(second, 4, seed=3, mix={'Z': 1, 'roi': 1}, start=2)
+
+        self.assertEqual(load_manifest(first)['maps'], manifest)
+        for entry in manifest:
+            self.assertIn(entry['kind'], ['Z', 'roi'])
+            assert_array_equal(nb.load(os.path.join(first, entry['path'])).get_data(),
+                               nb.load(os.path.join(second, entry['path'])).get_data())
+
+        # a different seed gives different maps
+        other = generate_synthetic_map(manifest[0]['kind'], get_map_rng(4, 0), manifest[0]['voxel_size'])
+        self.assertFalse(np.array_equal(other.get_data(),
+                                        nb.load(os.path.join(first, manifest[0]['path'])).get_data()))
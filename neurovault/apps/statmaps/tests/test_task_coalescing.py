@@ -0,0 +1,90 @@
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.test import TestCase
+
+from neurovault.apps.statmaps.task_coalescing import enqueue_once, coalesced, coalescing_stats, \
+    _state_key, QUEUED
+from neurovault.apps.statmaps.tasks import generate_glassbrain_image, run_voxelwise_pearson_similarity
+from neurovault.celery import nvcelery
+
+runs = []
+
+
+@shared_task
+@coalesced
+def coalesced_test_task(pk):
+    runs.append(pk)
+    if len(runs) == 1:
+        # requested twice more while running
+        enqueue_once(coalesced_test_task, pk)
+        enqueue_once(coalesced_test_task, pk)
+
+
+plain_runs = []
+
+
+@shared_task
+@coalesced
+def plain_coalesced_test_task(pk):
+    plain_runs.append(pk)
+
+
+class TaskCoalescingTestCase(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        del runs[:]
+        del plain_runs[:]
+
+    def test_queued_job_drops_duplicates(self):
+        cache.set(_state_key(coalesced_test_task.name, 1), (QUEUED, settings.DEFAULT_TASK_PRIORITY))
+        self.assertFalse(enqueue_once(coalesced_test_task, 1))
+        self.assertFalse(enqueue_once(coalesced_test_task, 1))
+        self.assertEqual(runs, [])
+        self.assertEqual(coalescing_stats([coalesced_test_task.name])[coalesced_test_task.name], 2)
+
+        # other images are not affected
+        self.assertTrue(enqueue_once(coalesced_test_task, 2))
+        self.assertEqual(runs, [2, 2])
+
+    def test_running_job_runs_once_more(self):
+        self.assertTrue(enqueue_once(coalesced_test_task, 1))
+        self.assertEqual(runs, [1, 1])
+        self.assertEqual(coalescing_stats([coalesced_test_task.name])[coalesced_test_task.name], 2)
+
+        # released when done
+        self.assertTrue(enqueue_once(coalesced_test_task, 1))
+        self.assertEqual(runs, [1, 1, 1])
+
+    def test_request_while_queued_is_not_lost(self):
+        # the worker may have picked up the job and read the image before marking it as running
+        cache.set(_state_key(plain_coalesced_test_task.name, 1), (QUEUED, settings.DEFAULT_TASK_PRIORITY))
+        self.assertFalse(enqueue_once(plain_coalesced_test_task, 1))
+        plain_coalesced_test_task(1)
+        self.assertEqual(plain_runs, [1, 1])
+        self.assertIsNone(cache.get(_state_key(plain_coalesced_test_task.name, 1)))
+
+    def test_urgent_request_is_not_queued_behind_bulk_job(self):
+        state_key = _state_key(plain_coalesced_test_task.name, 1)
+        cache.set(state_key, (QUEUED, settings.BULK_TASK_PRIORITY))
+        self.assertFalse(enqueue_once(plain_coalesced_test_task, 1, priority=settings.BULK_TASK_PRIORITY))
+        self.assertEqual(plain_runs, [])
+
+        self.assertTrue(enqueue_once(plain_coalesced_test_task, 1, priority=settings.INTERACTIVE_TASK_PRIORITY))
+        self.assertEqual(plain_runs, [1])
+        self.assertIsNone(cache.get(state_key))
+
+    def test_routing(self):
+        route = nvcelery.amqp.router.route({}, generate_glassbrain_image.name)
+        self.assertEqual(route['queue'].name, 'thumbnails')
+        self.assertEqual(route['priority'], settings.DEFAULT_TASK_PRIORITY)
+
+        route = nvcelery.amqp.router.route({'priority': settings.INTERACTIVE_TASK_PRIORITY},
+                                           run_voxelwise_pearson_similarity.name)
+        self.assertEqual(route['queue'].name, 'similarity')
+        self.assertEqual(route['priority'], settings.INTERACTIVE_TASK_PRIORITY)
+
+        # a job queued without a priority keeps the one of its route
+        route = nvcelery.amqp.router.route({'priority': None}, run_voxelwise_pearson_similarity.name)
+        self.assertEqual(route['priority'], settings.DEFAULT_TASK_PRIORITY)
@@ -0,0 +1,52 @@
+import shutil
+import tempfile
+
+import numpy
+from django.test import TestCase
+from numpy.testing import assert_array_equal
+
+from neurovault.apps.statmaps.vector_store import ReducedRepresentationStore
+
+
+class ReducedRepresentationStoreTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.writer = ReducedRepresentationStore(self.tmpdir)
+        self.reader = ReducedRepresentationStore(self.tmpdir)
+        for pk in range(1, 6):
+            self.writer.append(pk, numpy.arange(10) + pk)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_append_is_visible_to_other_instances(self):
+        self.assertEqual(len(self.reader), 5)
+        assert_array_equal(self.reader.get(3), numpy.arange(10) + 3)
+        self.assertIsNone(self.reader.get(99))
+
+    def test_replace_and_remove(self):
+        self.writer.append(3, numpy.zeros(10))
+        assert_array_equal(self.reader.get(3), numpy.zeros(10))
+        self.assertEqual(self.reader.matrix.shape, (6, 10))
+
+        self.assertTrue(self.writer.remove(2))
+        self.assertFalse(self.writer.remove(2))
+        self.assertEqual(self.reader.live_pks(), [1, 3, 4, 5])
+
+    def test_compact(self):
+        self.writer.append(3, numpy.zeros(10))
+        self.writer.remove(2)
+        old_matrix = self.reader.matrix
+        self.assertEqual(self.writer.compact(), 2)
+        self.assertEqual(self.writer.compact(), 0)
+
+        self.assertEqual(self.reader.matrix.shape, (4, 10))
+        assert_array_equal(self.reader.get(5), numpy.arange(10) + 5)
+        assert_array_equal(self.reader.get(3), numpy.zeros(10))
+        # views created before compaction stay valid
+        assert_array_equal(old_matrix[4], numpy.arange(10) + 5)
+
+    def test_dimension_mismatch(self):
+        with self.assertRaises(ValueError):
+            self.writer.append(10, numpy.ones(3))
@@ -2,6 +2,10 @@ from neurovault.apps.statmaps.forms import StatisticMapForm, AtlasForm, NIDMResu
 from neurovault.apps.statmaps.models import Collection, Image
 from django.core.files.uploadedfile import SimpleUploadedFile
 from neurovault.settings import PRIVATE_MEDIA_ROOT
+from contextlib import contextmanager
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+import __builtin__
 import shutil
 import os
 
@@ -81,3 +85,56 @@ def save_nidm_form(zip_file,collection,name=None):
     form = NIDMResultsForm(post_dict, file_dict)
     return form.save()
 
+
+@contextmanager
+def count_filesystem_calls():
+    """Counts os.stat, os.lstat and open calls made inside the block, yields a dict of the counts."""
+    counts = {'stat': 0, 'open': 0}
+    patched = [(os, 'stat', 'stat'), (os, 'lstat', 'stat'), (__builtin__, 'open', 'open')]
+    originals = [getattr(module, name) for module, name, _ in patched]
+
+    def counting(original, key):
+        def wrapper(*args, **kwargs):
+            counts[key] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+    for (module, name, key), original in zip(patched, originals):
+        setattr(module, name, counting(original, key))
+    try:
+        yield counts
+    finally:
+        for (module, name, _), original in zip(patched, originals):
+            setattr(module, name, original)
+
+
+class QueryBudgetMixin(object):
+    """Asserts on the number of SQL queries and filesystem calls a GET request makes.
+
+    Budgets are meant to catch N+1 regressions: they are small constants that do not
+    depend on the number of rows rendered.
+    """
+
+    def measure(self, url):
+        with CaptureQueriesContext(connection) as queries, count_filesystem_calls() as fs_calls:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), fs_calls['stat'] + fs_calls['open']
+
+    def assertWithinBudget(self, url, max_queries, max_filesystem_calls=0):
+        n_queries, n_fs_calls = self.measure(url)
+        self.assertLessEqual(n_queries, max_queries,
+                             "%s made %d queries, budget is %d" % (url, n_queries, max_queries))
+        self.assertLessEqual(n_fs_calls, max_filesystem_calls,
+                             "%s made %d filesystem calls, budget is %d" % (url, n_fs_calls,
+                                                                            max_filesystem_calls))
+        return n_queries, n_fs_calls
+
+    def assertDoesNotGrow(self, url, grow):
+        """The query and filesystem call counts of url stay the same after calling grow()."""
+        # warm up per-process caches (content types, templates) first
+        self.client.get(url)
+        before = self.measure(url)
+        grow()
+        after = self.measure(url)
+        self.assertEqual(before, after, "(queries, filesystem calls) of %s went from %s to %s" % (url, before, after))
@@ -1,4 +1,5 @@
 import errno
+import hashlib
 import os
 import pickle
 import random
@@ -6,10 +7,13 @@ import shutil
 import string
 import subprocess
 import tempfile
+import threading
 import urllib2
 import zipfile
 from ast import literal_eval
+from collections import OrderedDict
 from datetime import datetime,date
+from gzip import GzipFile
 from subprocess import CalledProcessError
 
 import cortex
@@ -26,8 +30,10 @@ from django.db.models import Q
 from django.template.loader import render_to_string
 from lxml import etree
 
+from neurovault.apps.statmaps.instrumentation import current_request_stats
 from neurovault.apps.statmaps.models import Collection, NIDMResults, StatisticMap, Comparison, NIDMResultStatisticMap, \
-    BaseStatisticMap
+    BaseStatisticMap, Image
+from neurovault.apps.statmaps.similarity_cache import get_cached_similar_images
 
 
 # see CollectionRedirectMiddleware
@@ -413,11 +419,13 @@ def format_image_collection_names(image_name,collection_name,total_length,map_ty
    else: return "%s : %s [%s]" %(image_name,collection_name,map_type)
 
 #checks if map is thresholded
-def is_thresholded(nii_obj, thr=0.85):
-    data = nii_obj.get_data()
-    zero_mask = (data == 0)
-    nan_mask = (np.isnan(data))
-    missing_mask = zero_mask | nan_mask
+def get_missing_mask(data):
+    return np.logical_or(data == 0, np.isnan(data))
+
+
+def is_thresholded(nii_obj, thr=0.85, missing_mask=None):
+    if missing_mask is None:
+        missing_mask = get_missing_mask(nii_obj.get_data())
     ratio_bad = float(missing_mask.sum())/float(missing_mask.size)
     if ratio_bad > thr:
         return (True, ratio_bad)
@@ -426,44 +434,107 @@ def is_thresholded(nii_obj, thr=0.85):
 
 
 #checks if map is a parcellation or ROI/mask
-def infer_map_type(nii_obj):
+def infer_map_type(nii_obj, missing_mask=None):
     data = nii_obj.get_data()
-    zero_mask = (data == 0)
-    nan_mask = (np.isnan(data))
-    missing_mask = zero_mask | nan_mask
-    unique_values = np.unique(data[np.logical_not(missing_mask)])
+    if missing_mask is None:
+        missing_mask = get_missing_mask(data)
+    # one counting pass instead of a full volume comparison per value
+    unique_values, counts = np.unique(data[np.logical_not(missing_mask)], return_counts=True)
     if len(unique_values) == 1:
         map_type = BaseStatisticMap.R
     elif len(unique_values) > 1200:
         map_type = BaseStatisticMap.OTHER
-    else:
+    elif len(unique_values) == 0:
         map_type = BaseStatisticMap.Pa
-        for val in unique_values:
-            if not(isinstance(val, np.integer) or (isinstance(val, np.floating) and float(val).is_integer())):
-                map_type = BaseStatisticMap.OTHER
-                break
-            if (data == val).sum() == 1:
-                map_type = BaseStatisticMap.OTHER
-                break
+    elif np.issubdtype(unique_values.dtype, np.integer):
+        # parcellations have integer labels covering more than one voxel each
+        map_type = BaseStatisticMap.OTHER if (counts == 1).any() else BaseStatisticMap.Pa
+    elif np.issubdtype(unique_values.dtype, np.floating):
+        integer_values = np.logical_and(np.isfinite(unique_values),
+                                        unique_values == np.floor(unique_values))
+        if not integer_values.all() or (counts == 1).any():
+            map_type = BaseStatisticMap.OTHER
+        else:
+            map_type = BaseStatisticMap.Pa
+    else:
+        map_type = BaseStatisticMap.OTHER
     return map_type
 
 import nibabel as nb
 from nilearn.image import resample_img
-def not_in_mni(nii, plot=False):
-    this_path = os.path.abspath(os.path.dirname(__file__))
-    mask_nii = nb.load(os.path.join(this_path, "static", 'anatomical','MNI152_T1_2mm_brain_mask.nii.gz'))
 
-    #resample to the smaller one
-    if np.prod(nii.shape) > np.prod(mask_nii.shape):
-        nan_mask = np.isnan(nii.get_data())
-        if nan_mask.sum() > 0:
-            nii.get_data()[nan_mask] = 0
-        nii = resample_img(nii, target_affine=mask_nii.get_affine(), target_shape=mask_nii.get_shape(),interpolation='nearest')
-    else:
-        mask_nii = resample_img(mask_nii, target_affine=nii.get_affine(), target_shape=nii.get_shape(),interpolation='nearest')
+# number of (affine, shape) grids for which the resampled MNI brain mask is kept
+MNI_MASK_CACHE_SIZE = 16
+
+_mni_mask = None
+_mni_mask_cache = OrderedDict()
+_mni_mask_cache_lock = threading.Lock()
+_mni_mask_cache_stats = {'hits': 0, 'misses': 0}
+
 
-    brain_mask = mask_nii.get_data() > 0
-    excursion_set = np.logical_not(np.logical_or(nii.get_data() == 0, np.isnan(nii.get_data())))
+def get_mni_mask():
+    global _mni_mask
+    if _mni_mask is None:
+        this_path = os.path.abspath(os.path.dirname(__file__))
+        _mni_mask = nb.load(os.path.join(this_path, "static", 'anatomical','MNI152_T1_2mm_brain_mask.nii.gz'))
+        _mni_mask.get_data()
+    return _mni_mask
+
+
+def mni_mask_cache_info():
+    with _mni_mask_cache_lock:
+        return dict(_mni_mask_cache_stats, size=len(_mni_mask_cache), max_size=MNI_MASK_CACHE_SIZE)
+
+
+def clear_mni_mask_cache():
+    with _mni_mask_cache_lock:
+        _mni_mask_cache.clear()
+        _mni_mask_cache_stats.update(hits=0, misses=0)
+
+
+def _resample_mni_mask_to_grid(affine, shape):
+    """The MNI brain mask on a (smaller) image grid, or for images with more voxels than
+    the mask the image voxel that nearest neighbour resampling picks for every mask voxel
+    (-1 outside of the image)."""
+    mask_nii = get_mni_mask()
+    if np.prod(shape) > np.prod(mask_nii.shape):
+        voxel_ids = np.arange(1, np.prod(shape[:3]) + 1, dtype=np.float64).reshape(shape[:3])
+        voxel_ids = resample_img(nb.Nifti1Image(voxel_ids, affine), target_affine=mask_nii.get_affine(),
+                                 target_shape=mask_nii.get_shape(), interpolation='nearest')
+        return np.rint(voxel_ids.get_data()).astype(np.int64) - 1
+    else:
+        mask_nii = resample_img(mask_nii, target_affine=affine, target_shape=shape[:3], interpolation='nearest')
+        return mask_nii.get_data() > 0
+
+
+def get_mni_mask_for_grid(affine, shape):
+    """LRU cached _resample_mni_mask_to_grid, most uploads share a handful of grids."""
+    key = (np.round(affine, 6).tostring(), tuple(shape[:3]), np.prod(shape) > np.prod(get_mni_mask().shape))
+    stats = current_request_stats()
+    with _mni_mask_cache_lock:
+        if key in _mni_mask_cache:
+            _mni_mask_cache_stats['hits'] += 1
+            if stats is not None:
+                stats.mni_mask_hits += 1
+            value = _mni_mask_cache.pop(key)
+            _mni_mask_cache[key] = value
+            return value
+        _mni_mask_cache_stats['misses'] += 1
+        if stats is not None:
+            stats.mni_mask_misses += 1
+
+    value = _resample_mni_mask_to_grid(affine, shape)
+    with _mni_mask_cache_lock:
+        _mni_mask_cache[key] = value
+        while len(_mni_mask_cache) > MNI_MASK_CACHE_SIZE:
+            _mni_mask_cache.popitem(last=False)
+    return value
+
+
+def not_in_mni(nii, plot=False, missing_mask=None):
+    if missing_mask is None:
+        missing_mask = get_missing_mask(nii.get_data())
+    excursion_set = np.logical_not(missing_mask)
 
     # deals with AFNI files
     if len(excursion_set.shape) == 5:
@@ -471,6 +542,19 @@ def not_in_mni(nii, plot=False):
     # deal with 4D files
     elif len(excursion_set.shape) == 4:
         excursion_set = excursion_set[:, :, :, 0]
+
+    #resample to the smaller one
+    grid_mask = get_mni_mask_for_grid(nii.get_affine(), nii.shape)
+    if grid_mask.dtype == np.bool_:
+        brain_mask = grid_mask
+    else:
+        # nearest neighbour resampling of the excursion set to the mask grid
+        brain_mask = get_mni_mask().get_data() > 0
+        inside = grid_mask >= 0
+        resampled = np.zeros(grid_mask.shape, dtype=np.bool_)
+        resampled[inside] = excursion_set.ravel()[grid_mask[inside]]
+        excursion_set = resampled
+
     in_brain_voxels = np.logical_and(excursion_set, brain_mask).sum()
     out_of_brain_voxels = np.logical_and(excursion_set, np.logical_not(brain_mask)).sum()
 
@@ -495,6 +579,40 @@ def not_in_mni(nii, plot=False):
     return ret, perc_mask_covered, perc_voxels_outside_of_mask
 
 
+def get_data_hash(nii):
+    """SHA1 of the voxel values (after scaling) and the affine, independent of the file encoding."""
+    data = nii.get_data()
+    sha1 = hashlib.sha1()
+    sha1.update(str(data.shape))
+    sha1.update(np.asarray(nii.get_affine(), dtype=np.float64).tostring())
+    # one slice at a time, to not hold a float64 copy of the whole volume
+    for i in range(data.shape[0]):
+        sha1.update(np.ascontiguousarray(data[i], dtype=np.float64).tostring())
+    return sha1.hexdigest()
+
+
+QA_CHECKS = ('thresholded', 'mni', 'map_type', 'data_hash')
+
+
+def compute_qa_metrics(nii, checks=QA_CHECKS):
+    """Runs the given QA checks of a map on a single load of its data, sharing its missing-voxel mask."""
+    metrics = {}
+    missing_mask = None
+    if 'thresholded' in checks or 'mni' in checks or 'map_type' in checks:
+        missing_mask = get_missing_mask(nii.get_data())
+    if 'thresholded' in checks:
+        metrics['is_thresholded'], ratio_bad = is_thresholded(nii, missing_mask=missing_mask)
+        metrics['perc_bad_voxels'] = ratio_bad*100.0
+    if 'mni' in checks:
+        metrics['not_mni'], metrics['brain_coverage'], metrics['perc_voxels_outside'] = \
+            not_in_mni(nii, missing_mask=missing_mask)
+    if 'map_type' in checks:
+        metrics['map_type'] = infer_map_type(nii, missing_mask=missing_mask)
+    if 'data_hash' in checks:
+        metrics['data_hash'] = get_data_hash(nii)
+    return metrics
+
+
 # QUERY FUNCTIONS -------------------------------------------------------------------------------
 
 def is_search_compatible(pk):
@@ -521,16 +639,23 @@ def get_images_to_compare_with(pk1, for_generation=False):
         return []
 
     img = Image.objects.get(pk=pk1)
+    if not (for_generation and img.collection.DOI is not None):
+        qs = Image.objects.filter(is_search_eligible=True).exclude(collection=img.collection).exclude(pk=pk1)
+        return list(qs.values_list('pk', flat=True))
+
+    # maps of published collections are also compared with public maps without a DOI
     image_pks = []
     for cls in [StatisticMap, NIDMResultStatisticMap]:
         qs = cls.objects.filter(collection__private=False, is_thresholded=False)
-        if not (for_generation and img.collection.DOI is not None):
-            qs = qs.exclude(collection__DOI__isnull=True)
         qs = qs.exclude(collection=img.collection)
         qs = qs.exclude(pk=pk1).exclude(analysis_level='S').exclude(map_type='R').exclude(map_type='Pa')
         image_pks += list(qs.values_list('pk', flat=True))
     return image_pks
 
+# Images a map which is not stored in NeuroVault (search by upload) can be compared with
+def get_searchable_image_pks():
+    return list(Image.objects.filter(is_search_eligible=True).values_list('pk', flat=True))
+
 # Returns number of total comparisons, with public, not thresholded maps
 def count_existing_comparisons(pk1):
     return get_existing_comparisons(pk1).count()
@@ -549,37 +674,99 @@ def count_processing_comparisons(pk1):
 
 # Returns existing comparisons for specific pk, or entire database
 def get_existing_comparisons(pk1):
-    possible_images_to_compare_with_pks = get_images_to_compare_with(pk1) + [pk1]
-    comparisons = Comparison.objects.filter(Q(image1__pk=pk1) | Q(image2__pk=pk1))
-    comparisons = comparisons.filter(image1__id__in=possible_images_to_compare_with_pks,
-                                     image2__id__in=possible_images_to_compare_with_pks)
-    comparisons = comparisons.exclude(image1__pk=pk1, image2__pk=pk1)
+    if not is_search_compatible(pk1):
+        return Comparison.objects.none()
+    collection_id = Image.objects.filter(pk=pk1).values_list('collection_id', flat=True)[0]
+    # the other image has to be eligible and in another collection (joins on the indexed flag)
+    comparisons = Comparison.objects.filter(
+        (Q(image1__pk=pk1, image2__is_search_eligible=True) & ~Q(image2__collection_id=collection_id)) |
+        (Q(image2__pk=pk1, image1__is_search_eligible=True) & ~Q(image1__collection_id=collection_id)))
     return comparisons
 
+# Columns of the similar images table (split orient, as used by find_similar_json)
+SIMILAR_IMAGES_COLUMNS = ['collection_name', 'image_id', 'name', 'png_img_path', 'score', 'tag']
+
+SIMILAR_IMAGE_FIELDS = ['id', 'name', 'thumbnail', 'collection_id', 'collection__name',
+                        'collection__private', 'collection__private_token',
+                        'statisticmap__map_type', 'nidmresultstatisticmap__map_type']
+
+
+def _similar_image_row(values, score):
+    if not values['thumbnail']:
+        return None
+    map_type = values['statisticmap__map_type'] or values['nidmresultstatisticmap__map_type']
+    # the storage only needs the privacy of the collection, which came with the row
+    collection = Collection(id=values['collection_id'], private=values['collection__private'],
+                            private_token=values['collection__private_token'])
+    thumbnail_storage = Image._meta.get_field('thumbnail').storage
+    return [values['collection__name'], values['id'], values['name'],
+            thumbnail_storage.url(values['thumbnail'], collection=collection), score, [str(map_type)]]
+
+
+def get_similar_image_rows(scored_pks):
+    """Rows of (pk, score) pairs, in order, with the current metadata of the images from one query."""
+    pks = [image_pk for image_pk, _ in scored_pks]
+    images = dict((values['id'], values) for values in
+                  Image.objects.filter(pk__in=pks).values(*SIMILAR_IMAGE_FIELDS))
+    rows = []
+    for image_pk, score in scored_pks:
+        row = _similar_image_row(images[image_pk], score) if image_pk in images else None
+        if row is not None:
+            rows.append(row)
+    return rows
+
+
+# Rows of the most similar images with existing comparisons. Only the scores are cached, until one
+# of the comparisons changes, so that renamed images or collections show up right away.
+def get_similar_images_data(pk, max_results=100):
+    return get_similar_image_rows(get_cached_similar_images(pk, max_results, _get_similar_image_scores))
+
+
+def _get_similar_image_scores(pk, max_results):
+    comparisons = get_existing_comparisons(pk).extra(select={"abs_score": "abs(similarity_score)"}).order_by(
+        "-abs_score").values_list('abs_score', 'image1_id', 'image2_id', 'similarity_score')[0:max_results]  # "-" indicates descending
+    # pick the image we are comparing with
+    return [(image2_id if image1_id == pk else image1_id, score) for _, image1_id, image2_id, score in comparisons]
+
+
 # Returns existing comparisons for specific pk in pd format for
 def get_similar_images(pk, max_results=100):
-    comparisons = get_existing_comparisons(pk).extra(select={"abs_score": "abs(similarity_score)"}).order_by(
-        "-abs_score")[0:max_results]  # "-" indicates descending
-
-    comparisons_pd = pd.DataFrame({'image_id': [],
-                                   'score': [],
-                                   'png_img_path': [],
-                                   'tag': [],
-                                   'name': [],
-                                   'collection_name': []
-                                   })
-
-    for comp in comparisons:
-        # pick the image we are comparing with
-        image = [image for image in [comp.image1, comp.image2] if image.id != pk][0]
-        if hasattr(image, "map_type") and image.thumbnail:
-            df = pd.DataFrame({'image_id': [image.pk],
-                               'score': [comp.similarity_score],
-                               'png_img_path': [image.get_thumbnail_url()],
-                               'tag': [[str(image.map_type)]],
-                               'name': [image.name],
-                               'collection_name': [image.collection.name]
-                               })
-        comparisons_pd = comparisons_pd.append(df, ignore_index=True)
-
-    return comparisons_pd
+    return pd.DataFrame(get_similar_images_data(pk, max_results), columns=SIMILAR_IMAGES_COLUMNS)
+
+def load_uploaded_nifti(uploaded_file):
+    """Load an uploaded .nii or .nii.gz file in memory. Raises ValueError for anything else."""
+    _, _, ext = split_filename(uploaded_file.name)
+    if ext.lower() not in [".nii.gz", ".nii"]:
+        raise ValueError("File has to be .nii or .nii.gz")
+    uploaded_file.seek(0)
+    fileobj = uploaded_file.file
+    if ext.lower() == ".nii.gz":
+        fileobj = GzipFile(filename=uploaded_file.name, mode='rb', fileobj=fileobj)
+    try:
+        nii = nib.Nifti1Image.from_file_map({'image': nib.FileHolder(uploaded_file.name, fileobj)})
+        data = np.asarray(nii.get_data())
+    except Exception, e:
+        raise ValueError("Could not read the file as NIfTI: %s" % e)
+    if len(data.shape) < 3 or any(dim > 1 for dim in data.shape[3:]):
+        raise ValueError("Only 3D maps can be searched, the file has shape %s" % str(data.shape))
+    return nib.Nifti1Image(data.reshape(data.shape[:3]), nii.get_affine())
+
+
+def get_similar_images_approximate_data(pk, max_results=100, n_probe=None):
+    from neurovault.apps.statmaps.ann_index import get_ann_index
+    from neurovault.apps.statmaps.vector_store import get_reduced_representation
+
+    index = get_ann_index()
+    if index is None:
+        # index not built yet
+        return get_similar_images_data(pk, max_results)
+
+    query = np.array(get_reduced_representation(Image.objects.get(pk=pk)))
+    result_pks, scores = index.search(query, max_results=max_results, n_probe=n_probe,
+                                      allowed_pks=get_images_to_compare_with(pk))
+    return get_similar_image_rows(zip(result_pks, scores))
+
+
+def get_similar_images_approximate(pk, max_results=100, n_probe=None):
+    return pd.DataFrame(get_similar_images_approximate_data(pk, max_results, n_probe),
+                        columns=SIMILAR_IMAGES_COLUMNS)
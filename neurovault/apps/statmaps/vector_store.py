@@ -0,0 +1,201 @@
+import fcntl
+import os
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+
+TOMBSTONE = -1
+INDEX_FILENAME = "index.npz"
+LOCK_FILENAME = "store.lock"
+
+
+class ReducedRepresentationStore(object):
+    """Append-only matrix with the reduced representations of all images.
+
+    The store directory contains:
+        vectors_<generation>.f32  raw float32 rows, one per stored vector
+        index.npz                 pk of every row (TOMBSTONE for removed rows), dim and generation
+
+    Rows are never modified in place: replacing or removing a vector tombstones its old row.
+    The data is written before the index is atomically swapped, so readers never see rows
+    which are not on disk. Writers serialize on a lock file. compact() copies the live rows
+    into a new generation, processes still mapping the old file keep a valid view of it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.dim = None
+        self.generation = 0
+        self._index_stat = None
+        self._row_pks = np.empty(0, dtype=np.int64)
+        self._rows = {}
+        self._matrix = None
+
+    @property
+    def index_path(self):
+        return os.path.join(self.path, INDEX_FILENAME)
+
+    def data_path(self, generation=None):
+        if generation is None:
+            generation = self.generation
+        return os.path.join(self.path, "vectors_%d.f32" % generation)
+
+    @contextmanager
+    def _lock(self):
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+        with open(os.path.join(self.path, LOCK_FILENAME), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def refresh(self):
+        """Reload the index if another process has changed it."""
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            # no store yet (or it has been removed)
+            if self._index_stat is not None:
+                self.__init__(self.path)
+            return
+        index_stat = (stat.st_ino, stat.st_mtime, stat.st_size)
+        if index_stat == self._index_stat:
+            return
+        with np.load(self.index_path) as index:
+            self._row_pks = index['pks']
+            self.dim = int(index['dim'])
+            self.generation = int(index['generation'])
+        self._rows = dict((pk, row) for row, pk in enumerate(self._row_pks.tolist()) if pk != TOMBSTONE)
+        self._matrix = None
+        self._index_stat = index_stat
+
+    def _write_index(self, row_pks, dim, generation):
+        tmp_path = os.path.join(self.path, "%s.%d.tmp" % (INDEX_FILENAME, os.getpid()))
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, pks=np.asarray(row_pks, dtype=np.int64), dim=dim, generation=generation)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(tmp_path, self.index_path)
+        self.refresh()
+
+    @property
+    def matrix(self):
+        """Read only (rows x dim) view of the store, including tombstoned rows."""
+        self.refresh()
+        if self._matrix is None:
+            if len(self._row_pks) == 0:
+                self._matrix = np.empty((0, self.dim or 0), dtype=np.float32)
+            else:
+                self._matrix = np.memmap(self.data_path(), dtype=np.float32, mode='r',
+                                         shape=(len(self._row_pks), self.dim))
+        return self._matrix
+
+    def __contains__(self, pk):
+        self.refresh()
+        return pk in self._rows
+
+    def __len__(self):
+        self.refresh()
+        return len(self._rows)
+
+    def live_pks(self):
+        self.refresh()
+        return sorted(self._rows.keys())
+
+    def get(self, pk):
+        self.refresh()
+        row = self._rows.get(pk)
+        if row is None:
+            return None
+        return self.matrix[row]
+
+    def rows_for(self, pks):
+        """Return the matrix rows holding the given pks and the pks they belong to."""
+        self.refresh()
+        found = [pk for pk in pks if pk in self._rows]
+        return np.array([self._rows[pk] for pk in found], dtype=np.int64), found
+
+    def append(self, pk, vector):
+        vector = np.asarray(vector, dtype=np.float32).ravel()
+        with self._lock():
+            self.refresh()
+            dim = self.dim if self.dim is not None else vector.shape[0]
+            if vector.shape[0] != dim:
+                raise ValueError("Vector of length %d does not fit in a store of dimension %d"
+                                 % (vector.shape[0], dim))
+            row_pks = self._row_pks.copy()
+            row_pks[row_pks == pk] = TOMBSTONE
+
+            # anything past the last indexed row is left over from an interrupted append
+            data_path = self.data_path()
+            with open(data_path, 'r+b' if os.path.exists(data_path) else 'wb') as f:
+                f.seek(len(row_pks) * dim * vector.itemsize)
+                f.write(vector.tostring())
+                f.truncate()
+                f.flush()
+                os.fsync(f.fileno())
+
+            self._write_index(np.append(row_pks, pk), dim, self.generation)
+
+    def remove(self, pk):
+        with self._lock():
+            self.refresh()
+            if pk not in self._rows:
+                return False
+            row_pks = self._row_pks.copy()
+            row_pks[row_pks == pk] = TOMBSTONE
+            self._write_index(row_pks, self.dim, self.generation)
+        return True
+
+    def compact(self, block_size=1024):
+        """Drop tombstoned rows. Returns the number of rows removed."""
+        with self._lock():
+            self.refresh()
+            live = np.flatnonzero(self._row_pks != TOMBSTONE)
+            removed = len(self._row_pks) - len(live)
+            if removed == 0:
+                return 0
+            old_path = self.data_path()
+            generation = self.generation + 1
+            with open(self.data_path(generation), 'wb') as f:
+                matrix = self.matrix
+                for start in range(0, len(live), block_size):
+                    f.write(np.ascontiguousarray(matrix[live[start:start + block_size]]).tostring())
+                f.flush()
+                os.fsync(f.fileno())
+            self._write_index(self._row_pks[live], self.dim, generation)
+            os.remove(old_path)
+        return removed
+
+
+_store = None
+
+
+def get_store():
+    global _store
+    if _store is None:
+        _store = ReducedRepresentationStore(os.path.join(settings.PRIVATE_MEDIA_ROOT,
+                                                         "reduced_representations"))
+    return _store
+
+
+def get_reduced_representation(image):
+    """Reduced representation of an image, read from the shared store.
+
+    Images which predate the store are added from their .npy file, images without any
+    reduced representation get it calculated.
+    """
+    store = get_store()
+    vector = store.get(image.pk)
+    if vector is None:
+        if image.reduced_representation and os.path.exists(image.reduced_representation.path):
+            store.append(image.pk, np.load(image.reduced_representation.path))
+        else:
+            from neurovault.apps.statmaps.tasks import save_resampled_transformation_single
+            save_resampled_transformation_single(image.pk)
+        vector = store.get(image.pk)
+    return vector
@@ -17,6 +17,8 @@ import zipstream
 from collections import OrderedDict
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import PermissionDenied, ObjectDoesNotExist
 from django.core.files.base import ContentFile
 from django.db.models import Q
@@ -38,21 +40,26 @@ from sendfile import sendfile
 from sklearn.externals import joblib
 from xml.dom import minidom
 
-import neurovault
 from neurovault import settings
 from neurovault.apps.statmaps.ahba import calculate_gene_expression_similarity
+from neurovault.apps.statmaps.ann_index import get_ann_index
+from neurovault.apps.statmaps.atlas_index import get_atlas_index
 from neurovault.apps.statmaps.forms import CollectionForm, UploadFileForm, SimplifiedStatisticMapForm,NeuropowerStatisticMapForm,\
     StatisticMapForm, EditStatisticMapForm, OwnerCollectionForm, EditAtlasForm, AtlasForm, \
     EditNIDMResultStatisticMapForm, NIDMResultsForm, NIDMViewForm, AddStatisticMapForm
 from neurovault.apps.statmaps.models import Collection, Image, Atlas, StatisticMap, NIDMResults, NIDMResultStatisticMap, \
     CognitiveAtlasTask, CognitiveAtlasContrast, BaseStatisticMap
-from neurovault.apps.statmaps.tasks import save_resampled_transformation_single
+from neurovault.apps.statmaps.ontology import get_ontology_graph
+from neurovault.apps.statmaps.similarity import get_pair_similarity
+from neurovault.apps.statmaps.storage import get_file_url
+from neurovault.apps.statmaps.synonyms import get_synonym_store
+from neurovault.apps.statmaps.vector_store import get_reduced_representation
 from neurovault.apps.statmaps.utils import split_filename, generate_pycortex_volume, \
     generate_pycortex_static, generate_url_token, HttpRedirectException, get_paper_properties, \
     get_file_ctime, detect_4D, split_4D_to_3D, splitext_nii_gz, mkdir_p, \
     send_email_notification, populate_nidm_results, get_server_url, populate_feat_directory, \
     detect_feat_directory, format_image_collection_names, is_search_compatible, \
-    get_similar_images
+    get_similar_images_data, get_similar_images_approximate_data, SIMILAR_IMAGES_COLUMNS
 from neurovault.apps.statmaps.voxel_query_functions import *
 from . import image_metadata
 
@@ -807,43 +814,33 @@ def papaya_js_embed(request, pk, iframe=None):
 
 @csrf_exempt
 def atlas_query_region(request):
-    # this query is significantly faster (from 2-4 seconds to <1 second) if the synonyms don't need to be queried
-    # i was previously in contact with NIF and it seems like it wouldn't be too hard to download all the synonym data
+    # synonyms come from the local store (see the build_synonym_store command), not from NIF
     search = request.GET.get('region','')
     atlas = request.GET.get('atlas','').replace('\'', '')
     collection = name=request.GET.get('collection','')
-    neurovault_root = os.path.dirname(os.path.dirname(os.path.realpath(neurovault.__file__)))
     try:
         collection_object = Collection.objects.filter(name=collection)[0]
     except IndexError:
         return JSONResponse('error: could not find collection: %s' % collection, status=400)
     try:
         atlas_object = Atlas.objects.filter(name=atlas, collection=collection_object)[0]
-        atlas_image = atlas_object.file
-        atlas_xml = atlas_object.label_description_file
     except IndexError:
         return JSONResponse('could not find %s' % atlas, status=400)
     if request.method == 'GET':
-        atlas_xml.open()
-        root = ET.fromstring(atlas_xml.read())
-        atlas_xml.close()
-        atlasRegions = [x.text.lower() for x in root.find('data').findall('label')]
+        atlas_index = get_atlas_index(atlas_object)
+        atlasRegions = atlas_index.regions
         if search in atlasRegions:
             searchList = [search]
         else:
-            synonymsDict = {}
-            with open(os.path.join(neurovault_root, 'neurovault/apps/statmaps/NIFgraph.pkl'),'rb') as input:
-                graph = joblib.load(input)
-            for atlasRegion in atlasRegions:
-                synonymsDict[atlasRegion] = getSynonyms(atlasRegion)
+            synonymIndex = get_synonym_store().index(atlasRegions)
             try:
-                searchList = toAtlas(search, graph, atlasRegions, synonymsDict)
+                searchList = toAtlas(search, get_ontology_graph(), atlasRegions, synonymIndex)
             except ValueError:
                 return JSONResponse('error: region not in atlas or ontology', status=400)
             if searchList == 'none':
                 return JSONResponse('error: could not map specified region to region in specified atlas', status=400)
         try:
-            data = {'voxels':getAtlasVoxels(searchList, atlas_image, atlas_xml)}
+            data = {'voxels':getAtlasVoxels(searchList, atlas_index).tolist()}
         except ValueError:
             return JSONResponse('error: region not in atlas', status=400)
 
@@ -863,12 +860,10 @@ def atlas_query_voxel(request):
         return JSONResponse('error: could not find collection: %s' % collection, status=400)
     try:
         atlas_object = Atlas.objects.filter(name=atlas, collection=collection_object)[0]
-        atlas_image = atlas_object.file
-        atlas_xml = atlas_object.label_description_file
     except IndexError:
         return JSONResponse('error: could not find atlas: %s' % atlas, status=400)
     try:
-        data = voxelToRegion(X,Y,Z,atlas_image, atlas_xml)
+        data = get_atlas_index(atlas_object).voxel_to_region(X, Y, Z)
     except IndexError:
         return JSONResponse('error: one or more coordinates are out of range', status=400)
     return JSONResponse(data)
@@ -897,15 +892,9 @@ def compare_images(request,pk1,pk2):
             "IMAGE_2_LINK":"/images/%s" % (image2.pk)
     }
 
-    # create reduced representation in case it's not there
-    if not image1.reduced_representation or not os.path.exists(image1.reduced_representation.path):
-        image1 = save_resampled_transformation_single(image1.id) # cannot run this async
-    if not image2.reduced_representation or not os.path.exists(image2.reduced_representation.path):
-        image2 = save_resampled_transformation_single(image2.id) # cannot run this async
-
-    # Load image vectors from npy files
-    image_vector1 = np.load(image1.reduced_representation.file)
-    image_vector2 = np.load(image2.reduced_representation.file)
+    # Load image vectors from the shared store (created in case they are not there)
+    image_vector1 = np.array(get_reduced_representation(image1), dtype=np.float64)
+    image_vector2 = np.array(get_reduced_representation(image2), dtype=np.float64)
 
     # Load atlas pickle, containing vectors of atlas labels, colors, and values for same voxel dimension (4mm)
     this_path = os.path.abspath(os.path.dirname(__file__))
@@ -932,7 +921,10 @@ def compare_images(request,pk1,pk2):
     # Add atlas svg to the image, and prepare html for rendering
     html = [h.replace("[coronal]",atlas_svg) for h in html_snippet]
     html = [h.strip("\n").replace("[axial]","").replace("[sagittal]","") for h in html]
-    context = {'html': html}
+    # Whole brain score, computed on demand if the pair is not stored (top-k similarity storage)
+    similarity_score = get_pair_similarity(image1, image2)
+    context = {'html': html,
+               'similarity_score': None if np.isnan(similarity_score) else similarity_score}
 
     # Determine if either image is thresholded
     threshold_status = np.array([image_names[i] for i in range(0,2) if images[i].is_thresholded])
@@ -978,6 +970,9 @@ def find_similar_json(request, pk, collection_cid=None):
     max_results = int(request.GET.get('q', '100'))
     if max_results > limit:
         max_results = limit
+    mode = request.GET.get('mode', 'exact')
+    if mode not in ['exact', 'approximate']:
+        return JSONResponse('error: mode has to be exact or approximate.', status=400)
 
     image1 = get_image(pk, None, request)
     pk = int(pk)
@@ -985,12 +980,26 @@ def find_similar_json(request, pk, collection_cid=None):
     # Search only enabled if the image is not thresholded
     if image1.is_thresholded:
         return JSONResponse('error: Image comparison is not enabled for thresholded images.', status=400)
+    elif mode == 'approximate':
+        n_probe = request.GET.get('n_probe')
+        if n_probe:
+            try:
+                n_probe = int(n_probe)
+            except ValueError:
+                n_probe = 0
+            if n_probe < 1:
+                return JSONResponse('error: n_probe has to be a positive integer.', status=400)
+            index = get_ann_index()
+            if index is not None:
+                n_probe = min(n_probe, len(index.centroids))
+        else:
+            n_probe = None
+        data = get_similar_images_approximate_data(pk, max_results, n_probe=n_probe)
     else:
-        similar_images = get_similar_images(pk, max_results)
+        data = get_similar_images_data(pk, max_results)
 
-    dict = similar_images.to_dict("split")
-    del dict["index"]
-    return JSONResponse(dict)
+    # same layout as DataFrame.to_dict("split") without the index
+    return JSONResponse({'columns': SIMILAR_IMAGES_COLUMNS, 'data': data})
 
 def gene_expression(request, pk, collection_cid=None):
     '''view_image returns main view to see an image and associated meta data. If the image is in a collection with a DOI and has a generated thumbnail, it is a contender for image comparison, and a find similar button is exposed.
@@ -1015,10 +1024,7 @@ def gene_expression_json(request, pk, collection_cid=None):
     if image.is_thresholded:
         raise Http404
 
-    if not image.reduced_representation or not os.path.exists(image.reduced_representation.path):
-        image = save_resampled_transformation_single(image.id)
-
-    map_data = np.load(image.reduced_representation.file)
+    map_data = np.array(get_reduced_representation(image), dtype=np.float64)
     expression_results = calculate_gene_expression_similarity(map_data)
     dict = expression_results.to_dict("split")
     del dict["index"]
@@ -1042,6 +1048,24 @@ class JSONResponse(HttpResponse):
         super(JSONResponse, self).__init__(content, **kwargs)
 
 
+def get_nidm_viewer_url(nidm_results):
+    """URL of the map shown for a NIDM result, its zip is only parsed again after the result was saved."""
+    key = "nidm_viewer_url:%d:%s" % (nidm_results.pk, nidm_results.modify_date.isoformat())
+    map_url = cache.get(key)
+    if map_url is None:
+        try:
+            excursion_sets = Graph(
+                nidm_results.zip_file.path).get_excursion_set_maps().values()
+            map_url = nidm_results.get_absolute_url() + "/" + str(excursion_sets[0].file.path)
+        except KeyError:
+            maps = Graph(
+                nidm_results.zip_file.path).get_statistic_maps()
+            map_url = nidm_results.get_absolute_url() + "/" + str(
+                maps[0].file.path)
+        cache.set(key, map_url, None)
+    return map_url
+
+
 class ImagesInCollectionJson(BaseDatatableView):
     columns = ['file.url', 'pk', 'name', 'polymorphic_ctype.name', 'is_valid']
     order_columns = ['','pk', 'name', 'polymorphic_ctype.name', '']
@@ -1051,34 +1075,30 @@ class ImagesInCollectionJson(BaseDatatableView):
         # these are simply objects displayed in datatable
         # You should not filter data returned here by any filter values entered by user. This is because
         # we need some base queryset to count total number of records.
-        collection = get_collection(self.kwargs['cid'], self.request)
-        return collection.basecollectionitem_set.all()
+        self.collection = get_collection(self.kwargs['cid'], self.request)
+        return self.collection.basecollectionitem_set.all()
 
     def render_column(self, row, column):
-        if row.polymorphic_ctype.name == "statistic map":
+        # content types are cached by the manager, row.polymorphic_ctype would be a query per row
+        ctype_name = ContentType.objects.get_for_id(row.polymorphic_ctype_id).name
+        # all rows belong to the same collection
+        row.collection = self.collection
+        if ctype_name == "statistic map":
             type = row.get_map_type_display()
         else:
-            type = row.polymorphic_ctype.name
+            type = ctype_name
 
         # We want to render user as a custom column
         if column == 'file.url':
             if isinstance(row, Image):
-                return '<a class="btn btn-default viewimage" onclick="viewimage(this)" filename="%s" type="%s"><i class="fa fa-lg fa-eye"></i></a>'%(filepath_to_uri(row.file.url), type)
+                return '<a class="btn btn-default viewimage" onclick="viewimage(this)" filename="%s" type="%s"><i class="fa fa-lg fa-eye"></i></a>'%(filepath_to_uri(get_file_url(row.file)), type)
             elif isinstance(row, NIDMResults):
-                try:
-                    excursion_sets = Graph(
-                        row.zip_file.path).get_excursion_set_maps().values()
-                    map_url = row.get_absolute_url() + "/" + str(excursion_sets[0].file.path)
-                except KeyError:
-                    maps = Graph(
-                        row.zip_file.path).get_statistic_maps()
-                    map_url = row.get_absolute_url() + "/" + str(
-                        maps[0].file.path)
+                map_url = get_nidm_viewer_url(row)
                 return '<a class="btn btn-default viewimage" onclick="viewimage(this)" filename="%s" type="%s"><i class="fa fa-lg fa-eye"></i></a>' % (map_url, type)
         elif column == 'polymorphic_ctype.name':
             return type
         elif column == 'is_valid':
-            if row.polymorphic_ctype.name == "nidm results":
+            if ctype_name == "nidm results":
                 return True
             else:
                 return row.is_valid
@@ -1134,18 +1154,19 @@ class AtlasesAndParcellationsJson(BaseDatatableView):
         # we need some base queryset to count total number of records.
         qs = Image.objects.instance_of(Atlas) | Image.objects.instance_of(StatisticMap).filter(statisticmap__map_type=BaseStatisticMap.Pa)
         qs = qs.filter(collection__private=False).exclude(collection__DOI__isnull=True)
-        return qs
+        return qs.select_related('collection')
 
 
     def render_column(self, row, column):
-        if row.polymorphic_ctype.name == "statistic map":
+        ctype_name = ContentType.objects.get_for_id(row.polymorphic_ctype_id).name
+        if ctype_name == "statistic map":
             type = row.get_map_type_display()
         else:
-            type = row.polymorphic_ctype.name
+            type = ctype_name
 
         # We want to render user as a custom column
         if column == 'file.url':
-            return '<a class="btn btn-default viewimage" onclick="viewimage(this)" filename="%s" type="%s"><i class="fa fa-lg fa-eye"></i></a>'%(filepath_to_uri(row.file.url), type)
+            return '<a class="btn btn-default viewimage" onclick="viewimage(this)" filename="%s" type="%s"><i class="fa fa-lg fa-eye"></i></a>'%(filepath_to_uri(get_file_url(row.file)), type)
         elif column == 'polymorphic_ctype.name':
             return type
         if column == 'collection.authors' and row.collection.authors:
@@ -1183,7 +1204,8 @@ class PublicCollectionsJson(BaseDatatableView):
             else:
                 return ""
         elif column == 'n_images':
-            return row.basecollectionitem_set.count()
+            # annotated in filter_queryset
+            return row.n_images
         else:
             return super(PublicCollectionsJson, self).render_column(row, column)
 
@@ -1194,7 +1216,8 @@ class PublicCollectionsJson(BaseDatatableView):
         search = self.request.GET.get(u'search[value]', None)
         if search:
             qs = qs.filter(Q(name__icontains=search)| Q(description__icontains=search))
-        return qs
+        # one grouped query instead of a count per row
+        return qs.annotate(n_images=Count('basecollectionitem'))
 
 class MyCollectionsJson(PublicCollectionsJson):
 
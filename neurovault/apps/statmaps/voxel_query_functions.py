@@ -1,60 +1,22 @@
 
-import nibabel
 import xml.etree.ElementTree as ET
-import numpy
-import os.path
-from __builtin__ import True
 import urllib2
-import networkx as nx
-import cPickle as pickle
-import numpy.linalg as npl
 
+from neurovault.apps.statmaps.atlas_index import AtlasIndex
 
 
 
-def getAtlasVoxels(regions, atlas_image, atlas_xml):
-	atlas_xml.open()
-	root = ET.fromstring(atlas_xml.read())
-	atlas_xml.close()
-	atlas=nibabel.load(atlas_image.path)
-	atlas_data = atlas.get_data()
-	aff = atlas.get_affine()
-	atlas_mask = numpy.zeros(atlas_data.shape)
-	for line in root.find('data').findall('label'):
-		name = line.text.replace("'",'').rstrip(' ').lower()
-		if name in [region.lower() for region in regions]:
-			index = int(line.get('index')) + 1
-			atlas_mask[atlas_data==index] = True
-	if atlas_mask.sum() != 0:
-		voxels = numpy.where(atlas_mask)
-		voxelsmm = [[],[],[]]
-		for i in range(len(voxels[0])):
-			XYZ = [voxels[0][i],voxels[1][i],voxels[2][i]]
-			XYZmm = nibabel.affines.apply_affine(aff, XYZ)
-			voxelsmm[0].append(XYZmm[0])
-			voxelsmm[1].append(XYZmm[1])
-			voxelsmm[2].append(XYZmm[2])
 
-		return voxelsmm
-	else:
-		raise ValueError('"{region}" not in "{atlas_xml}"'.format(region=region, atlas_xml=atlas_xml))
+def getAtlasVoxels(regions, atlas_index):
+	# (3, n) array of the mm coordinates of the voxels of the regions, raises ValueError if there are none
+	return atlas_index.region_voxels(regions)
 
 def voxelToRegion(X,Y,Z, atlas_image, atlas_xml):
+	# loads the atlas for a single lookup, views use the cached get_atlas_index instead
 	atlas_xml.open()
-	root = ET.fromstring(atlas_xml.read())
+	xml_string = atlas_xml.read()
 	atlas_xml.close()
-	atlas=nibabel.load(atlas_image.path)
-	aff = atlas.get_affine()
-	atlas_data = atlas.get_data()
-	XYZ = [float(X),float(Y),float(Z)]
-	XYZmm = nibabel.affines.apply_affine(npl.inv(aff), XYZ)
-	Xmm, Ymm, Zmm, = XYZmm[0], XYZmm[1], XYZmm[2]
-	atlasRegions = [x.text.lower() for x in root.find('data').findall('label')]
-	index = int(atlas_data[Xmm,Ymm,Zmm]) - 1
-	if index == -1:
-		return 'none'
-	else:
-		return atlasRegions[index]
+	return AtlasIndex.load(atlas_image.path, xml_string).voxel_to_region(X, Y, Z)
 	
 def getSynonyms(keyword):
 	keywordQuery = keyword
@@ -74,45 +36,27 @@ def getSynonyms(keyword):
 	syn_list.append(keyword)
 	return syn_list
 
-def findNodes(graph, startNode, atlasRegions, synonymsDict, direction = 'children'):
-	matches = [key for key in synonymsDict.keys() if graph.node[startNode]['name'] in synonymsDict[key]]
-	if matches != []:
-		return matches
-	else:
-		matchingRelatives = []
-		if direction == 'parents':
-			for child in graph.predecessors_iter(startNode):
-				matchingRelatives += findNodes(graph, child, atlasRegions, synonymsDict, direction)
-		else:
-			for child in graph.successors_iter(startNode):
-				matchingRelatives += findNodes(graph, child, atlasRegions, synonymsDict, direction)
-		return matchingRelatives
-
-
-def toAtlas(region, graph, atlasRegions, synonymsDict):
-	final_list = []
+def toAtlas(region, ontology, atlasRegions, synonymIndex):
+	# ontology is an OntologyGraph (get_ontology_graph()), synonymIndex maps synonyms to the atlas
+	# regions they name (SynonymStore.index(atlasRegions))
 	# checking if region or synonyms exist in atlas. if so, simply return region
-	for atlasRegion in atlasRegions:
-		if region in synonymsDict[atlasRegion]:
-			final_list.append(atlasRegion)
+	final_list = list(synonymIndex.get(region, []))
 	if final_list != []: 
 		return final_list
 
 	# checking recursively for child matches. if it finds any, return them
-	try:
-		region_id = [n for n,d in graph.nodes_iter(data=True) if d['name'] == region][0]
-	except IndexError:
+	region_id = ontology.node_ids.get(region)
+	if region_id is None:
 		raise ValueError('"{region}" not in graph'.format(region=region))
-	matchingChildren = findNodes(graph, region_id, atlasRegions, synonymsDict, 'children')
+	matchingChildren = ontology.matches(region_id, synonymIndex, 'children')
 	if len(matchingChildren) > 0:
 		return matchingChildren
 
 	# checking recursively for parent matches. if it finds any, return them
 	else:
-		matchingParents = findNodes(graph, region_id, atlasRegions, synonymsDict, 'parents')
+		matchingParents = ontology.matches(region_id, synonymIndex, 'parents')
 		if len(matchingParents) > 0:
 			return matchingParents
 
 	# otherwise, return 'none'
 	return 'none'
-
@@ -92,6 +92,7 @@ STATICFILES_FINDERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    'neurovault.apps.statmaps.middleware.RequestInstrumentationMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -194,6 +195,31 @@ INSTALLED_APPS = (
 #     }
 # }
 
+# per request wall time, SQL queries, cache hits and bytes read, logged as JSON lines to
+# the neurovault.instrumentation logger (see RequestInstrumentationMiddleware)
+REQUEST_INSTRUMENTATION = os.environ.get('REQUEST_INSTRUMENTATION', '') == '1'
+# fraction of the instrumented requests run under cProfile
+REQUEST_PROFILE_SAMPLE_RATE = float(os.environ.get('REQUEST_PROFILE_SAMPLE_RATE', 0))
+REQUEST_PROFILE_DIR = os.environ.get('REQUEST_PROFILE_DIR', '/var/www/image_data/profiles')
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'level': 'INFO',
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'neurovault.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
+
 AUTHENTICATION_BACKENDS = (
     'django.contrib.auth.backends.ModelBackend',
     'social.backends.facebook.FacebookOAuth2',
@@ -268,9 +294,14 @@ PRIVATE_MEDIA_REDIRECT_HEADER = 'X-Accel-Redirect'
 
 PYCORTEX_DATASTORE = os.path.join(BASE_DIR,'pycortex_data')
 
+# shared by all uwsgi and celery processes, uses the redis instance of the celery broker
 CACHES = {
             'default': {
-                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                'BACKEND': 'django_redis.cache.RedisCache',
+                'LOCATION': 'redis://redis:6379/1',
+                'OPTIONS': {
+                    'CLIENT_CLASS': 'django_redis.client.DefaultClient',
+                }
             },
             "file_resubmit": {
                 'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
@@ -297,9 +328,41 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_DEFAULT_QUEUE = 'default'
+# one queue per workload class, each served by its own workers (see docker-compose.yml):
+# thumbnails (cheap glass brains), similarity (reduced representations and comparisons),
+# ingest (external imports such as crawl_anima)
 CELERY_QUEUES = (
     Queue('default', Exchange('default'), routing_key='default'),
+    Queue('thumbnails', Exchange('thumbnails'), routing_key='thumbnails'),
+    Queue('similarity', Exchange('similarity'), routing_key='similarity'),
+    Queue('ingest', Exchange('ingest'), routing_key='ingest'),
 )
+
+# with the redis broker 0 is the highest priority; jobs triggered by a user's upload are
+# queued with INTERACTIVE_TASK_PRIORITY, bulk recalculations with BULK_TASK_PRIORITY
+INTERACTIVE_TASK_PRIORITY = 0
+DEFAULT_TASK_PRIORITY = 5
+BULK_TASK_PRIORITY = 9
+BROKER_TRANSPORT_OPTIONS = {'priority_steps': list(range(10))}
+
+
+def _route(queue):
+    return {'queue': queue, 'routing_key': queue, 'priority': DEFAULT_TASK_PRIORITY}
+
+CELERY_ROUTES = {
+    'neurovault.apps.statmaps.tasks.generate_glassbrain_image': _route('thumbnails'),
+    'neurovault.apps.statmaps.tasks.save_resampled_transformation_single': _route('similarity'),
+    'neurovault.apps.statmaps.tasks.save_resampled_transformation_batch': _route('similarity'),
+    'neurovault.apps.statmaps.tasks.run_voxelwise_pearson_similarity': _route('similarity'),
+    'neurovault.apps.statmaps.tasks.update_voxelwise_pearson_similarity': _route('similarity'),
+    'neurovault.apps.statmaps.tasks.save_voxelwise_pearson_similarity_chunk': _route('similarity'),
+    'neurovault.apps.statmaps.tasks.save_voxelwise_pearson_similarity': _route('similarity'),
+    'crawl_anima': _route('ingest'),
+}
+
+# set per worker: long similarity jobs should not sit prefetched behind each other,
+# thumbnail workers can take several at once
+CELERYD_PREFETCH_MULTIPLIER = int(os.environ.get('CELERYD_PREFETCH_MULTIPLIER', 1))
 CELERY_IMPORTS = ('neurovault.apps.statmaps.tasks', )
 
 CELERYBEAT_SCHEDULE = {
@@ -311,6 +374,39 @@ CELERYBEAT_SCHEDULE = {
 
 CELERY_TIMEZONE = 'Europe/Berlin'
 
+# number of candidate images scored (and upserted) by one similarity task
+SIMILARITY_CHUNK_SIZE = 500
+
+# 'full' stores every pairwise comparison, 'topk' only the SIMILARITY_TOP_K best neighbours
+# of every image (requires PostgreSQL), other pairs are computed on demand
+SIMILARITY_STORAGE = 'full'
+SIMILARITY_TOP_K = 500
+
+# approximate search (find_similar_json?mode=approximate): partitions visited per query (more is
+# slower but finds more of the exact top matches) and candidates re-ranked exactly per result
+SIMILARITY_ANN_N_PROBE = 16
+SIMILARITY_ANN_RERANK_FACTOR = 4
+
+# maximum time (seconds) a search by upload (/api/similarity_search) may take, the
+# results are marked as partial if not all maps could be scanned
+SIMILARITY_SEARCH_TIME_BUDGET = 5.0
+
+# maximum number of coordinates of one batch atlas query (/api/atlases/atlas_query_voxels)
+ATLAS_QUERY_MAX_COORDINATES = 100000
+
+# synonyms of atlas region names used by atlas_query_region, written by build_synonym_store
+SYNONYM_STORE_PATH = os.path.join(BASE_DIR, 'apps/statmaps/NIFsynonyms.json')
+
+# seconds find_similar_json results are kept in the cache, they are also invalidated
+# whenever a comparison of the image is written or removed
+SIMILAR_IMAGES_CACHE_TIMEOUT = 60 * 60
+
+# seconds a similarity or thumbnail job counts as running for its image; duplicates
+# requested in that time are merged into one more run after it
+TASK_COALESCING_TIMEOUT = 60 * 60
+# seconds a job counts as queued, short so that a lost message does not block its image for long
+TASK_COALESCING_QUEUED_TIMEOUT = 10 * 60
+
 ANONYMOUS_USER_ID = -1
 
 DEFAULT_OAUTH_APPLICATION_ID = -1
@@ -353,6 +449,7 @@ if "test" in sys.argv or "benchmark" in sys.argv:
     PRIVATE_MEDIA_ROOT = test_media_root
     CELERY_ALWAYS_EAGER = True
     CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+    CACHES['default'] = {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
 
 
 TAGGIT_CASE_INSENSITIVE=True
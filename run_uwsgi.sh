@@ -16,4 +16,7 @@ if [ ! -d "/var/www/image_data/images" ]; then
     echo "GENERATING GLASSBRAINS AND SIMILARITY MEASURES"
     python manage.py trigger_comparisons
 fi
+# synonyms of atlas regions missing from the store are downloaded in the background, region
+# queries never ask NIF themselves
+python manage.py build_synonym_store &
 uwsgi uwsgi.ini
\ No newline at end of file
@@ -0,0 +1,38 @@
+# Times infer_map_type on synthetic 2mm and 1mm parcellations and ROI masks
+import os
+import timeit
+
+import django
+import nibabel as nb
+import numpy as np
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "neurovault.settings")
+django.setup()
+
+from neurovault.apps.statmaps.utils import infer_map_type
+
+
+def parcellation(shape, n_labels, rng):
+    data = np.zeros(shape, dtype=np.int16)
+    inside = rng.rand(*shape) < 0.5
+    data[inside] = rng.randint(1, n_labels + 1, size=inside.sum())
+    return data
+
+
+def roi_mask(shape, rng):
+    data = np.zeros(shape, dtype=np.float32)
+    data[rng.rand(*shape) < 0.1] = 1
+    return data
+
+
+rng = np.random.RandomState(0)
+cases = [("2mm parcellation (100 labels)", parcellation((91, 109, 91), 100, rng)),
+         ("2mm parcellation (1000 labels)", parcellation((91, 109, 91), 1000, rng)),
+         ("1mm parcellation (1000 labels)", parcellation((182, 218, 182), 1000, rng)),
+         ("2mm ROI mask", roi_mask((91, 109, 91), rng)),
+         ("1mm ROI mask", roi_mask((182, 218, 182), rng))]
+
+for name, data in cases:
+    nii = nb.Nifti1Image(data, affine=np.eye(4))
+    seconds = min(timeit.repeat(lambda: infer_map_type(nii), number=1, repeat=3))
+    print "%-32s %-4s %.3fs" % (name, infer_map_type(nii), seconds)
@@ -11,7 +11,9 @@ import os
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "neurovault.settings")
 django.setup()
 
+from django.conf import settings
 from neurovault.apps.statmaps.models import Similarity, Comparison, Image, Collection
+from neurovault.apps.statmaps.task_coalescing import enqueue_once
 from neurovault.apps.statmaps.tasks import run_voxelwise_pearson_similarity
 
 # Images should have the "transform" field after applying migrations (I think)
@@ -35,4 +37,4 @@ for img in Image.objects.all():
 for collection in Collection.objects.filter(DOI__isnull=False):
     for image in collection.basecollectionitem_set.instance_of(Image).all():
       print "Calculating pearson similarity for images %s" %image
-      run_voxelwise_pearson_similarity.apply_async([image.pk])
+      enqueue_once(run_voxelwise_pearson_similarity, image.pk, priority=settings.BULK_TASK_PRIORITY)